@@ -9,6 +9,7 @@ from .dashboard import router as dashboard_router
 from .medhistory import router as medhistory_router
 from .labs import router as labs_router
 from .share import router as share_router
+from .metrics import router as metrics_router
 
 def get_all_routers():
     return [
@@ -22,5 +23,6 @@ def get_all_routers():
         dashboard_router,
         medhistory_router,
         labs_router,
-        share_router
+        share_router,
+        metrics_router
     ]
\ No newline at end of file
@@ -1,21 +1,22 @@
 from fastapi import Depends, HTTPException, status, APIRouter, Request
-from sqlmodel import Session, select
+from sqlmodel import Session
+from sqlalchemy import delete
 import uuid
 
-from ..models import Allergy, AllergyResponse, AllergyCreate, AllergyUpdate, Allergens, Reactions, Severity, AllergensResponse, ReactionsResponse, SeverityResponse, User
-from ..utils import get_session, validate_session, limiter
+from ..models import Allergy, AllergyResponse, AllergyCreate, AllergyUpdate, Allergens, Reactions, Severity, AllergyAllergensLink, AllergyReactionsLink, AllergensResponse, ReactionsResponse, SeverityResponse
+from ..utils import get_session, validate_session, lookup_cache, lookup_response, rate_limit, json_response, serialize_rows, select_allergy_rows, allergy_row
 
 router = APIRouter()
 
 ### Allergy endpoints
 # Get all allergies
 @router.get("/me/allergies", response_model=list[AllergyResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 def get_allergies(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Get all allergies for the logged in user. This will be used to display the allergies in the allergies page of the application.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -31,41 +32,28 @@ def get_allergies(request: Request, user_id: uuid.UUID = Depends(validate_sessio
         status: 200 OK: Allergies retrieved successfully
     """
     
-    # Get the session ID from the request cookie and get the user id from the database
-    user = session.get(User, user_id)
+    # Get all the allergies for the user, with their allergens and reactions aggregated by the database
+    result = serialize_rows(select_allergy_rows(user_id), allergy_row, session)
     
-    if not user.allergies:
+    if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No allergies found for this user")
     
-    # Get all the allergies for the user
-    result = []
-    for allergy in user.allergies:
-        result.append({
-            "id": allergy.id,
-            "date_diagnosed": allergy.date_diagnosed,
-            "allergens": [allergen.name for allergen in allergy.allergens],
-            "reactions": [reaction.name for reaction in allergy.reactions],
-            "severity": allergy.severity.name,
-            "notes": allergy.notes,
-            "date_added": allergy.date_added
-        })
-    
-    return result
+    return json_response(result)
 
 # Add an allergy
 @router.post("/me/allergies", status_code=status.HTTP_201_CREATED, response_model=AllergyResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def add_allergy(allergy: AllergyCreate, request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Add an allergy for the logged in user. This will be used to add a new allergy to the database.
 
     Args:
         allergy (AllergyCreate): Contains allergy data: date_diagnosed as str, allergens as list[str], reactions as list[str], severity as str, notes as str.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
     Raises:
-        HTTPException: 404 NOT FOUND if the severity, allergens or reactions are not found in the database.
+        HTTPException: 404 NOT FOUND if the severity is not found in the database, or if no allergens or reactions are given. Allergens and reactions that don't exist yet are created.
         HTTPException: 500 INTERNAL SERVER ERROR if an error occurs when adding the allergy.
 
     Returns:
@@ -80,54 +68,48 @@ def add_allergy(allergy: AllergyCreate, request: Request, user_id: uuid.UUID = D
         status: 201 CREATED: Allergy added successfully
     """
     
-    # Get the session ID from the request cookie and get the user id from the database
-    user = session.get(User, user_id)
-    
-    # Find the severity from the database from the severity name passed in the request
-    severity = session.exec(select(Severity).where(Severity.name == allergy.severity)).first()
+    # Find the severity from the lookup cache from the severity name passed in the request
+    severity = lookup_cache.get(Severity, allergy.severity, session)
     
     if not severity:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Severity not found")
     
-    # Find the allergens from the database from the allergen names passed in the request. Needs to be a list of allergen names
-    allergens = []
-    for allergen_name in allergy.allergens:
-        allergen_db = session.exec(select(Allergens).where(Allergens.name == allergen_name)).first()
-        allergens.append(allergen_db)
-        
-    if not allergens:
+    if not allergy.allergens:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Allergens not found")
     
-    # Find the reactions from the database from the reaction names passed in the request. Needs to be a list of reaction names
-    reactions = []
-    for reaction_name in allergy.reactions:
-        reaction_db = session.exec(select(Reactions).where(Reactions.name == reaction_name)).first()
-        reactions.append(reaction_db)
-    
-    if not reactions:
+    if not allergy.reactions:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reactions not found")    
     
     
     try: 
+        # Find the allergens and reactions from the names passed in the request with one query per list, and create the ones that don't exist yet
+        allergen_ids = lookup_cache.get_or_create_ids(Allergens, allergy.allergens, session)
+        reaction_ids = lookup_cache.get_or_create_ids(Reactions, allergy.reactions, session)
+        
         new_allergy = Allergy(
             date_diagnosed = allergy.date_diagnosed,
-            user = user,
-            allergens = allergens,
-            reactions = reactions,
-            severity = severity,
+            user_id = user_id,
+            severity_id = severity["id"],
             notes = allergy.notes,
             )
-            
+        
+        # Link the allergens and reactions by their IDs, without loading their rows
         session.add(new_allergy)
+        session.add_all([AllergyAllergensLink(allergy_id=new_allergy.id, allergen_id=allergen_id) for allergen_id in allergen_ids.values()])
+        session.add_all([AllergyReactionsLink(allergy_id=new_allergy.id, reaction_id=reaction_id) for reaction_id in reaction_ids.values()])
         session.commit()
         session.refresh(new_allergy)
         
+        # Add the allergens and reactions created by this request to the lookup cache, now that they are committed
+        lookup_cache.remember(Allergens, [{"id": allergen_id, "name": name} for name, allergen_id in allergen_ids.items()])
+        lookup_cache.remember(Reactions, [{"id": reaction_id, "name": name} for name, reaction_id in reaction_ids.items()])
+        
         allergy_response = AllergyResponse(
             id = new_allergy.id,
             date_diagnosed = new_allergy.date_diagnosed,
-            allergens = [allergen.name for allergen in new_allergy.allergens],
-            reactions = [reaction.name for reaction in new_allergy.reactions],
-            severity = new_allergy.severity.name,
+            allergens = list(allergen_ids),
+            reactions = list(reaction_ids),
+            severity = severity["name"],
             notes = new_allergy.notes,
             date_added = new_allergy.date_added
         )
@@ -141,13 +123,13 @@ def add_allergy(allergy: AllergyCreate, request: Request, user_id: uuid.UUID = D
     
 # Delete an allergy
 @router.delete("/me/allergies/{allergy_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def delete_allergy(allergy_id: uuid.UUID, request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Delete an allergy for the logged in user. This will be used to delete an allergy from the database.
 
     Args:
         allergy_id (uuid.UUID): ID of the allergy to delete.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -185,14 +167,14 @@ def delete_allergy(allergy_id: uuid.UUID, request: Request, user_id: uuid.UUID =
 
 # Update an allergy
 @router.patch("/me/allergies/{allergy_id}", status_code=status.HTTP_200_OK, response_model=AllergyResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_allergy(allergy_id: uuid.UUID, allergy_new: AllergyUpdate, request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Update an allergy for the logged in user. This will be used to update an allergy in the database.
 
     Args:
         allergy_id (uuid.UUID): ID of the allergy to update.
         allergy_new (AllergyUpdate): Contains allergy data, with all fields as optional: date_diagnosed as str, allergens as list[str], reactions as list[str], severity as str, notes as str.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -226,39 +208,41 @@ def update_allergy(allergy_id: uuid.UUID, allergy_new: AllergyUpdate, request: R
     allergy_data = allergy_new.model_dump(exclude_unset=True)
     
     # Check whether the updated fields are not None and update the allergy in the database for those fields which have values
-    if allergy_data["severity"] is not None:
-        severity_name = allergy_data.pop("severity")
-        severity = session.exec(select(Severity).where(Severity.name == severity_name)).first()
+    # The severity, allergens and reactions are found in the lookup cache and set by their IDs
+    severity_name = allergy_data.pop("severity", None)
+    if severity_name is not None:
+        severity_id = lookup_cache.get_id(Severity, severity_name, session)
         
-        if severity:
-            allergy_db.severity = severity
-    
+        if severity_id:
+            allergy_db.severity_id = severity_id
     
-    if allergy_data["allergens"] is not None:
-        allergens = []
-        for allergen_name in allergy_data["allergens"]:
-            allergen_db = session.exec(select(Allergens).where(Allergens.name == allergen_name)).first()
-            allergens.append(allergen_db)
-            
-        if allergens:
-            allergy_db.allergens = allergens
-        
     
-    if allergy_data["reactions"] is not None:
-        reactions = []
-        for reaction_name in allergy_data["reactions"]:
-            reaction_db = session.exec(select(Reactions).where(Reactions.name == reaction_name)).first()
-            reactions.append(reaction_db)
-            
-        if reactions:
-            allergy_db.reactions = reactions   
+    allergen_names = allergy_data.pop("allergens", None)
+    reaction_names = allergy_data.pop("reactions", None)
             
     try: 
+        # Replace the allergens and reactions, with one query per list and the names that don't exist yet created
+        if allergen_names:
+            allergen_ids = lookup_cache.get_or_create_ids(Allergens, allergen_names, session)
+            session.execute(delete(AllergyAllergensLink).where(AllergyAllergensLink.allergy_id == allergy_db.id))
+            session.add_all([AllergyAllergensLink(allergy_id=allergy_db.id, allergen_id=allergen_id) for allergen_id in allergen_ids.values()])
+            
+        if reaction_names:
+            reaction_ids = lookup_cache.get_or_create_ids(Reactions, reaction_names, session)
+            session.execute(delete(AllergyReactionsLink).where(AllergyReactionsLink.allergy_id == allergy_db.id))
+            session.add_all([AllergyReactionsLink(allergy_id=allergy_db.id, reaction_id=reaction_id) for reaction_id in reaction_ids.values()])
+        
         allergy_db.sqlmodel_update(allergy_data)
         session.add(allergy_db)
         session.commit()
         session.refresh(allergy_db)
         
+        # Add the allergens and reactions created by this request to the lookup cache, now that they are committed
+        if allergen_names:
+            lookup_cache.remember(Allergens, [{"id": allergen_id, "name": name} for name, allergen_id in allergen_ids.items()])
+        if reaction_names:
+            lookup_cache.remember(Reactions, [{"id": reaction_id, "name": name} for name, reaction_id in reaction_ids.items()])
+        
         allergy_response = AllergyResponse(
             id = allergy_db.id,
             date_diagnosed = allergy_db.date_diagnosed,
@@ -277,37 +261,41 @@ def update_allergy(allergy_id: uuid.UUID, allergy_new: AllergyUpdate, request: R
     
 # Get all allergens
 @router.get("/allergens", response_model=list[AllergensResponse], status_code=status.HTTP_200_OK)
-def get_allergens(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_allergens(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """
-    Retrieves all allergens from the database.
+    Retrieves all allergens from the lookup cache.
 
     This endpoint requires user authentication but doesn't filter results by user.
-    The user_id parameter is only used for session validation.
+    The user_id parameter is only used for session validation. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): The ID of the authenticated user (used for validation only)
         session (Session): The database session
         
     Returns:
         list[AllergensResponse]: A list of all allergen records
     """
-    allergens = session.exec(select(Allergens)).all()
-    
-    if not allergens:
+    if not lookup_cache.all(Allergens, session):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No allergens found")
     
-    return allergens
+    return lookup_response(request, Allergens, AllergensResponse, session)
 
 # Get all reactions
 @router.get("/reactions", response_model=list[ReactionsResponse], status_code=status.HTTP_200_OK)
-def get_reactions(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_reactions(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """
-    Retrieves all reactions from the database.
+    Retrieves all reactions from the lookup cache.
     
     This endpoint requires user authentication but doesn't filter results by user.
-    The user_id parameter is only used for session validation.
+    The user_id parameter is only used for session validation. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): The ID of the authenticated user (used for validation only)
         session (Session): The database session
 
@@ -315,32 +303,31 @@ def get_reactions(user_id: uuid.UUID = Depends(validate_session), session: Sessi
         list[ReactionsResponse]: A list of all reaction records
     """
     
-    reactions = session.exec(select(Reactions)).all()
-    
-    if not reactions:
+    if not lookup_cache.all(Reactions, session):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No reactions found")
     
-    return reactions
+    return lookup_response(request, Reactions, ReactionsResponse, session)
 
 # Get all severities
 @router.get("/severities", response_model=list[SeverityResponse], status_code=status.HTTP_200_OK)
-def get_severities(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_severities(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """
-    Retrieve all severity levels from the database.
+    Retrieve all severity levels from the lookup cache.
 
     This endpoint requires a valid user session but does not use the user_id for filtering,
-    as severity levels are global and not user-specific.
+    as severity levels are global and not user-specific. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): User ID from the validated session token (unused but required for authorization)
         session (Session): Database session
         
     Returns:
         list[SeverityResponse]: List of all severity levels
     """
-    severities = session.exec(select(Severity)).all()
-    
-    if not severities:
+    if not lookup_cache.all(Severity, session):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No severities found")
     
-    return severities
\ No newline at end of file
+    return lookup_response(request, Severity, SeverityResponse, session)
\ No newline at end of file
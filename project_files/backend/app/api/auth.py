@@ -4,20 +4,20 @@ import uuid
 
 from ..models import User, UserAuth, AuthSession
 from ..utils import get_session, validate_session, create_session, end_session, create_hash, verify_hash
-from ..utils import limiter
+from ..utils import limiter, rate_limit
 
 router = APIRouter()
 
 # Login endpoint
 @router.post("/login", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 async def login(login_data: UserAuth, response: Response, request: Request, session: Session = Depends(get_session)):
     """ Login endpoint. Will be used to check the received credentials from login page and create a session for the user if they are correct.
 
     Args:
         login_data (UserAuth): Contains login data: email as EmailStr and password as str.
         response (Response): Response is automatically used by the endpoint to set the session cookie in the response.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
     Raises:
@@ -65,12 +65,13 @@ async def login(login_data: UserAuth, response: Response, request: Request, sess
 # Register endpoint
 @router.post("/register", status_code=status.HTTP_201_CREATED)
 @limiter.limit("3/hour")
+@rate_limit("bcrypt")
 def register(register_data: UserAuth, request: Request, session: Session = Depends(get_session)):
     """ Register endpoint. Will be used to register a new user in the database. 
 
     Args:
         register_data (UserAuth): Contains register data: email as EmailStr, password as str and name as str.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
     Raises:
@@ -108,13 +109,13 @@ def register(register_data: UserAuth, request: Request, session: Session = Depen
 
 # Logout endpoint
 @router.post("/logout", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 async def logout(response: Response, request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Logout endpoint. Will be used to log out the user by deleting the cookie in the frontend and delete the session from the database.
 
     Args:
         response (Response): Response is automatically used by the endpoint to delete the session cookie in the response.
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address, also to get the session ID from the cookie.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address, also to get the session ID from the cookie.
         user_id (uuid.UUID): User ID of the logged in user, received from the dependency injection. Used to check if the user is logged in and to check if the user is trying to log out their own session.
         session (Session): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -4,14 +4,14 @@ from sqlmodel import Session
 import uuid
 
 from ..models import User, FileUpload, FileResponse
-from ..utils import validate_file, save_file, get_connected_record, decrypt_file, get_session, validate_session, limiter
+from ..utils import validate_file, save_file, get_connected_record, decrypt_file, record_file_bytes, get_session, validate_session, rate_limit
 
 router = APIRouter()
 
 ### File endpoints
 # Upload a file
 @router.post("/upload/{record_type}/{record_id}", status_code=status.HTTP_201_CREATED)
-@limiter.limit("5/minute")
+@rate_limit("write")
 async def upload_file(
                 request: Request,
                 file: UploadFile, 
@@ -23,7 +23,7 @@ async def upload_file(
     """ Upload a file and associate it with a specific record (vaccine or medical history). The file will be encrypted and stored securely.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         file (UploadFile): The file to be uploaded.
         record_type (str): Type of record to associate the file with ('vaccine' or 'medicalhistory').
         record_id (uuid.UUID): ID of the record to associate the file with.
@@ -85,7 +85,7 @@ async def upload_file(
     
 # Get a file by ID
 @router.get("/files/{record_type}/{record_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 async def get_file(
     request: Request,
     record_type: str,
@@ -96,7 +96,7 @@ async def get_file(
     """ Retrieve a file associated with a specific record (vaccine or medical history). The file will be decrypted before streaming to the client.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         record_type (str): Type of record the file is associated with ('vaccine' or 'medicalhistory').
         record_id (uuid.UUID): ID of the record the file is associated with.
         user_id (User): User object of the logged in user. This is automatically used by the endpoint to validate access rights.
@@ -135,6 +135,7 @@ async def get_file(
             encrypted_content = f.read()
             
         decrypted_content = decrypt_file(encrypted_content)
+        record_file_bytes(len(decrypted_content))
 
         yield decrypted_content
     
@@ -147,7 +148,7 @@ async def get_file(
 
 # Get file metadata
 @router.get("/files/{record_type}/{record_id}/metadata", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 async def get_file_metadata(
     request: Request,
     record_type: str,
@@ -159,7 +160,7 @@ async def get_file_metadata(
     This provides information about the file without downloading the actual file content.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         record_type (str): Type of record the file is associated with ('vaccine' or 'medicalhistory').
         record_id (uuid.UUID): ID of the record the file is associated with.
         user_id (User): User object of the logged in user. This is automatically used by the endpoint to validate access rights.
@@ -1,21 +1,23 @@
-from fastapi import Depends, HTTPException, status, APIRouter, Request
-from sqlmodel import Session, select
+from fastapi import Depends, HTTPException, status, APIRouter, Request, Query
+from sqlmodel import Session
+from datetime import date
+from typing import Literal
 import uuid
 
-from ..models import User, HealthData, HealthDataResponse, HealthDataType, HealthDataTypeResponse, SimpleHealthDataCreate, BloodPressureCreate, HealthDataUpdate
-from ..utils import get_session, validate_session, limiter
+from ..models import HealthData, HealthDataResponse, HealthDataType, HealthDataTypeResponse, SimpleHealthDataCreate, BloodPressureCreate, HealthDataUpdate, HealthDataSummaryResponse, HealthDataBulkResponse, HealthDataAggregateResponse
+from ..utils import get_session, validate_session, rate_limit, get_vitals_summary, get_vitals_aggregate, lookup_cache, lookup_response, ingest_healthdata, CSV_CONTENT_TYPES, NDJSON_CONTENT_TYPES, INGEST_MAX_BYTES, json_response, serialize_rows, select_healthdata_rows, healthdata_row
 
 router = APIRouter()
 
 ### Health Data endpoints
 # Get all health data
 @router.get("/me/healthdata", response_model=list[HealthDataResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 def get_healthdata(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Get all health data for the logged in user. This will be used to display the health data in the health data page of the application.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -34,50 +36,103 @@ def get_healthdata(request: Request, user_id: uuid.UUID = Depends(validate_sessi
         status: 200 OK: Health data retrieved successfully
     """
     
-    # Get user from the database based on the user_id from the session cookie
-    user = session.get(User, user_id)
+    # Get the user's health data joined with its type, newest first
+    # The trend of each measurement against the normal range of its type is computed by the database
+    # For blood pressure, the value is empty and the systolic and diastolic values are included instead
+    result = serialize_rows(select_healthdata_rows(user_id), healthdata_row, session)
     
-    result = []
+    return json_response(result)
+
+# Get the statistics of each health data type
+@router.get("/me/healthdata/summary", response_model=list[HealthDataSummaryResponse], status_code=status.HTTP_200_OK)
+@rate_limit("read")
+def get_healthdata_summary(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+    """ Get the statistics of each health data type recorded by the logged in user. This will be used to display an overview of the vitals without fetching every measurement.
+
+    Args:
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
+        session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
+
+    Returns:
+        result: List with one entry for each health data type the user has recorded, with the following fields:
+            - name: str: Name of the health data type
+            - unit: str: Unit of measurement
+            - normal_range: str: Normal range for this health data type
+            - count: int: Number of measurements
+            - trend: str: Whether the latest measurement is above ('up'), below ('down') or within ('stable') the normal range
+            - latest: HealthDataResponse: The latest measurement
+            - value_min, value_max, value_mean: float: Statistics of all the measurements (systolic values for blood pressure)
+            - value_rolling_mean: float: Mean of the most recent measurements
+            - diastolic_min, diastolic_max, diastolic_mean, diastolic_rolling_mean: float: Same statistics for the diastolic values (blood pressure only)
+        status: 200 OK: Health data summary retrieved successfully
+    """
     
-    # Iterate through the user's health data and append to the result list
-    # If the health data type is "Tensiune arterială", include systolic and diastolic values
-    # Otherwise, include the regular value
-    # Also include the normal range for each health data type
-    for healthdata in user.healthdata:
-        if healthdata.type.name == "Tensiune arterială":
-            result.append({
-                "id": healthdata.id,
-                "name": healthdata.type.name,
-                "unit": healthdata.type.unit,
-                "value_systolic": healthdata.value_systolic,
-                "value_diastolic": healthdata.value_diastolic,
-                "date_recorded": healthdata.date_recorded,
-                "notes": healthdata.notes,
-                "date_added": healthdata.date_added,
-                "normal_range": healthdata.type.normal_range
-            })
-        else:
-            result.append({
-                "id": healthdata.id,
-                "name": healthdata.type.name,
-                "unit": healthdata.type.unit,
-                "value": healthdata.value,
-                "date_recorded": healthdata.date_recorded,
-                "notes": healthdata.notes,
-                "date_added": healthdata.date_added,
-                "normal_range": healthdata.type.normal_range
-            })
+    return get_vitals_summary(user_id, session)
+
+# Get the statistics of a health data type over time buckets
+@router.get("/me/healthdata/aggregate", response_model=HealthDataAggregateResponse, status_code=status.HTTP_200_OK)
+@rate_limit("read")
+def get_healthdata_aggregate(
+    request: Request,
+    type_name: str = Query(alias="type"),
+    bucket: Literal["day", "week", "month"] = "day",
+    start: date | None = None,
+    end: date | None = None,
+    user_id: uuid.UUID = Depends(validate_session),
+    session: Session = Depends(get_session)
+):
+    """ Get the min, max, mean and count of a health data type for the logged in user, grouped by day, week or month.
     
-    return result
+    This endpoint is used to graph long histories of a health data type without sending every measurement.
+    The grouping is done by the database, and for blood pressure the systolic and diastolic values are aggregated separately.
+
+    Args:
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
+        type_name (str): Name of the health data type to aggregate, passed as the 'type' query parameter.
+        bucket (str, optional): Size of the time buckets, one of 'day', 'week' or 'month'. Defaults to 'day'.
+        start (date, optional): Only include measurements on or after this date.
+        end (date, optional): Only include measurements on or before this date.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
+        session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
+
+    Raises:
+        HTTPException: 404 NOT FOUND if the health data type is not found in the database.
+
+    Returns:
+        HealthDataAggregateResponse: Object with the following fields:
+            - name: str: Name of the health data type
+            - unit: str: Unit of measurement
+            - normal_range: str: Normal range for this health data type
+            - bucket: str: Size of the time buckets
+            - buckets: list: Statistics of each bucket with measurements, oldest first:
+                - bucket_start: str: First day of the bucket
+                - count: int: Number of measurements
+                - value_min, value_max, value_mean: float: Statistics of the values (systolic values for blood pressure)
+                - diastolic_min, diastolic_max, diastolic_mean: float: Statistics of the diastolic values (blood pressure only)
+        status: 200 OK: Health data aggregate retrieved successfully
+    """
+    data_type = lookup_cache.get(HealthDataType, type_name, session)
+    
+    if not data_type:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Health data type not found")
+    
+    return HealthDataAggregateResponse(
+        name = data_type["name"],
+        unit = data_type["unit"],
+        normal_range = data_type["normal_range"],
+        bucket = bucket,
+        buckets = get_vitals_aggregate(user_id, data_type["id"], bucket, session, start, end)
+    )
 
 # Add health data - simple
 @router.post("/me/healthdata", status_code=status.HTTP_201_CREATED, response_model=HealthDataResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def add_healthdata(request: Request, healthdata: SimpleHealthDataCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Add a simple health data measurement for the logged in user. This will be used to add a new health data entry to the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         healthdata (SimpleHealthDataCreate): Contains health data: name as str, value as float, date_recorded as str, and optional notes as str.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -96,14 +151,12 @@ def add_healthdata(request: Request, healthdata: SimpleHealthDataCreate, user_id
             - notes: str: Notes about the measurement
             - date_added: str: Date when the data was added to the database
             - normal_range: str: Normal range for this health data type
+            - trend: str: Whether the measurement is above ('up'), below ('down') or within ('stable') the normal range
         status: 201 CREATED: Health data added successfully
     """
     
-    # Get user from the database based on the user_id from the session cookie
-    user = session.get(User, user_id)
-    
-    # Get the data type - simple or complex (blood pressure)
-    data_type = session.exec(select(HealthDataType).where(HealthDataType.name == healthdata.name)).first()
+    # Get the data type - simple or complex (blood pressure) - from the lookup cache
+    data_type = lookup_cache.get(HealthDataType, healthdata.name, session)
     
     if not data_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Health data type not found")
@@ -112,29 +165,21 @@ def add_healthdata(request: Request, healthdata: SimpleHealthDataCreate, user_id
         new_healthdata = HealthData(
             value = healthdata.value,
             date_recorded = healthdata.date_recorded,
-            user = user,
-            type = data_type,
+            user_id = user_id,
+            type_id = data_type["id"],
             )
         
         if healthdata.notes:
             new_healthdata.notes = healthdata.notes
             
+        # The ID is read before the commit, which expires the object
+        healthdata_id = new_healthdata.id
         session.add(new_healthdata)
         session.commit()
-        session.refresh(new_healthdata)
         
-        healthdata_response = HealthDataResponse(
-            id = new_healthdata.id,
-            name = new_healthdata.type.name,
-            unit = new_healthdata.type.unit,
-            value = new_healthdata.value,
-            date_recorded = new_healthdata.date_recorded,
-            notes = new_healthdata.notes,
-            date_added = new_healthdata.date_added,
-            normal_range = new_healthdata.type.normal_range
-        )
-        
-        return healthdata_response
+        # Read the new measurement back with the same query as the list, so the response has its trend
+        row = session.exec(select_healthdata_rows(user_id).where(HealthData.id == healthdata_id)).one()
+        return json_response(healthdata_row(row), status_code=status.HTTP_201_CREATED)
     
     except Exception as e:
         session.rollback()
@@ -143,12 +188,12 @@ def add_healthdata(request: Request, healthdata: SimpleHealthDataCreate, user_id
     
 # Add health data - blood pressure
 @router.post("/me/healthdata/bp", status_code=status.HTTP_201_CREATED, response_model=HealthDataResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def add_complex_healthdata(request: Request, healthdata: BloodPressureCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Add a blood pressure measurement for the logged in user. This will be used to add a new blood pressure entry to the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         healthdata (BloodPressureCreate): Contains blood pressure data: name as str, value_systolic as float, value_diastolic as float, date_recorded as str, and optional notes as str.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -168,12 +213,11 @@ def add_complex_healthdata(request: Request, healthdata: BloodPressureCreate, us
             - notes: str: Notes about the measurement
             - date_added: str: Date when the data was added to the database
             - normal_range: str: Normal range for this health data type
+            - trend: str: Whether the measurement is above ('up'), below ('down') or within ('stable') the normal range
         status: 201 CREATED: Health data added successfully
     """
-    user = session.get(User, user_id)
-    
     # Same as above, but for blood pressure
-    data_type = session.exec(select(HealthDataType).where(HealthDataType.name == healthdata.name)).first()
+    data_type = lookup_cache.get(HealthDataType, healthdata.name, session)
     
     if not data_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Health data type not found")
@@ -183,43 +227,77 @@ def add_complex_healthdata(request: Request, healthdata: BloodPressureCreate, us
             value_systolic = healthdata.value_systolic,
             value_diastolic = healthdata.value_diastolic,
             date_recorded = healthdata.date_recorded,
-            user = user,
-            type = data_type,
+            user_id = user_id,
+            type_id = data_type["id"],
             )
         
         if healthdata.notes:
             new_healthdata.notes = healthdata.notes
                 
+        # The ID is read before the commit, which expires the object
+        healthdata_id = new_healthdata.id
         session.add(new_healthdata)
         session.commit()
-        session.refresh(new_healthdata)
         
-        healthdata_response = HealthDataResponse(
-            id = new_healthdata.id,
-            name = new_healthdata.type.name,
-            unit = new_healthdata.type.unit,
-            value_systolic = new_healthdata.value_systolic,
-            value_diastolic = new_healthdata.value_diastolic,
-            date_recorded = new_healthdata.date_recorded,
-            notes = new_healthdata.notes,
-            date_added = new_healthdata.date_added,
-            normal_range = new_healthdata.type.normal_range
-        )
-        return healthdata_response
+        # Read the new measurement back with the same query as the list, so the response has its trend
+        row = session.exec(select_healthdata_rows(user_id).where(HealthData.id == healthdata_id)).one()
+        return json_response(healthdata_row(row), status_code=status.HTTP_201_CREATED)
 
     except Exception as e:
         session.rollback()
         print(f"Error adding health data: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to add health data")
     
+# Add health data in bulk - device exports
+@router.post("/me/healthdata/bulk", status_code=status.HTTP_201_CREATED, response_model=HealthDataBulkResponse)
+@rate_limit("write")
+async def add_healthdata_bulk(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+    """ Add many health data measurements at once for the logged in user. This will be used to import the exports of home devices such as blood pressure monitors and scales.
+
+    The body is CSV (text/csv) with a header line, or NDJSON (application/x-ndjson) with one JSON object per line, and can mix simple and blood pressure readings.
+    Each reading has the same fields as the single reading endpoints: name, value or value_systolic and value_diastolic, date_recorded and optional notes.
+    The body is parsed as it is streamed and the readings are inserted in batches, each batch in its own transaction.
+
+    Args:
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address. The body is streamed from the request.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
+        session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
+
+    Raises:
+        HTTPException: 415 UNSUPPORTED MEDIA TYPE if the body is not CSV or NDJSON.
+        HTTPException: 413 REQUEST ENTITY TOO LARGE if the Content-Length of the body is bigger than the upload limit.
+
+    Returns:
+        result: Object with the following fields:
+            - inserted: int: Number of readings added
+            - errors: list: Readings that were not added, with their row number and the reason
+        status: 201 CREATED: Health data added successfully
+    """
+    
+    # Get the content type without parameters such as the charset
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    
+    if content_type not in CSV_CONTENT_TYPES + NDJSON_CONTENT_TYPES:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Body must be CSV or NDJSON")
+    
+    # Reject big uploads before reading them, the size is also checked while streaming if the header is missing
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > INGEST_MAX_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Upload is too large")
+    
+    # A body going over the limit while streaming is imported up to the limit, with an error for the remaining rows
+    inserted, errors = await ingest_healthdata(request.stream(), content_type, user_id, session)
+    
+    return HealthDataBulkResponse(inserted=inserted, errors=errors)
+    
 # Delete health data
 @router.delete("/me/healthdata/{healthdata_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def delete_healthdata(request: Request, healthdata_id: uuid.UUID, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Delete a health data entry for the logged in user. This will be used to remove a health data entry from the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         healthdata_id (uuid.UUID): ID of the health data entry to delete.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -249,12 +327,12 @@ def delete_healthdata(request: Request, healthdata_id: uuid.UUID, user_id: uuid.
 
 # Update health data
 @router.patch("/me/healthdata/{healthdata_id}", response_model=HealthDataResponse, status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_healthdata(request: Request, healthdata_id: uuid.UUID, healthdata_new: HealthDataUpdate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Update a health data entry for the logged in user. This will be used to modify an existing health data entry in the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         healthdata_id (uuid.UUID): ID of the health data entry to update.
         healthdata_new (HealthDataUpdate): Contains updated health data fields. All fields are optional.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
@@ -277,6 +355,7 @@ def update_healthdata(request: Request, healthdata_id: uuid.UUID, healthdata_new
             - notes: str: Notes about the measurement
             - date_added: str: Date when the data was added to the database
             - normal_range: str: Normal range for this health data type
+            - trend: str: Whether the measurement is above ('up'), below ('down') or within ('stable') the normal range
         status: 200 OK: Health data updated successfully
     """
     healthdata_db = session.get(HealthData, healthdata_id)
@@ -290,32 +369,18 @@ def update_healthdata(request: Request, healthdata_id: uuid.UUID, healthdata_new
     healthdata_data = healthdata_new.model_dump(exclude_unset=True)
     
     if "name" in healthdata_data:
-        data_type = session.exec(select(HealthDataType).where(HealthDataType.name == healthdata_data["name"])).first()
-        healthdata_data["type"] = data_type
+        type_id = lookup_cache.get_id(HealthDataType, healthdata_data.pop("name"), session)
+        if type_id:
+            healthdata_data["type_id"] = type_id
               
     try:
         healthdata_db.sqlmodel_update(healthdata_data)
         session.add(healthdata_db)
         session.commit()
-        session.refresh(healthdata_db)
-        
-        updated_healthdata = HealthDataResponse(
-            id = healthdata_db.id,
-            name = healthdata_db.type.name,
-            unit = healthdata_db.type.unit,
-            normal_range = healthdata_db.type.normal_range,
-            date_recorded = healthdata_db.date_recorded,
-            notes = healthdata_db.notes,
-            date_added = healthdata_db.date_added
-        )    
-        
-        if healthdata_db.value:
-            updated_healthdata.value = healthdata_db.value
-        elif healthdata_db.value_diastolic and healthdata_db.value_systolic:
-            updated_healthdata.value_systolic = healthdata_db.value_systolic
-            updated_healthdata.value_diastolic = healthdata_db.value_diastolic
         
-        return updated_healthdata
+        # Read the measurement back with the same query as the list, so the response has its trend
+        row = session.exec(select_healthdata_rows(user_id).where(HealthData.id == healthdata_id)).one()
+        return json_response(healthdata_row(row))
     except Exception as e:
         session.rollback()
         print(f"Error updating health data: {e}")
@@ -323,19 +388,22 @@ def update_healthdata(request: Request, healthdata_id: uuid.UUID, healthdata_new
     
 # Get all health data types
 @router.get("/healthdata/types", response_model=list[HealthDataTypeResponse], status_code=status.HTTP_200_OK)
-def get_healthdata_types(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
-    """ Retrieve all available health data types from the database.
+@rate_limit("lookup")
+def get_healthdata_types(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+    """ Retrieve all available health data types from the lookup cache.
 
     This endpoint requires a valid user session but does not use the user_id for filtering,
-    as health data types are global and not user-specific.
+    as health data types are global and not user-specific. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): User ID from the validated session token (unused but required for authorization)
-        session (Session): Database session
+        session (Session): Database session, only used if the lookup cache is not loaded
 
     Returns:
         list[HealthDataTypeResponse]: List of all health data types with their units and normal ranges
         status: 200 OK: Health data types retrieved successfully
+        status: 304 NOT MODIFIED: Health data types did not change since the ETag in If-None-Match
     """
-    healthdata_types = session.exec(select(HealthDataType)).all()
-    return healthdata_types
\ No newline at end of file
+    return lookup_response(request, HealthDataType, HealthDataTypeResponse, session)
\ No newline at end of file
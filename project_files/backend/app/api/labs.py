@@ -1,16 +1,18 @@
-from fastapi import Depends, HTTPException, status, APIRouter, Request
-from sqlmodel import Session, select
+from fastapi import Depends, HTTPException, status, APIRouter, Request, Query
+from sqlmodel import Session, select, col
+from sqlalchemy import insert
+from datetime import date, datetime
 import uuid
 
-from ..models import LabResult, LabTest, LabsCreate, MedicalHistory, User, LabTestResponse, LabResultResponse, MedicalHistoryResponseLab
-from ..utils import get_connected_record, decrypt_file, get_session, validate_session, read_file, extract_with_llm, check_is_numeric, sort_by_date, limiter
+from ..models import LabResult, LabTest, LabsCreate, MedicalHistory, LabTestResponse, LabSeriesResponse
+from ..utils import get_connected_record, decrypt_file, get_session, validate_session, read_file, extract_with_llm, check_is_numeric, numeric_value_columns, downsample_lttb, get_or_create_lab_tests, lab_range_columns, rate_limit, json_response, select_labresult_rows, group_lab_tests
 
 
 router = APIRouter()
 
 # Extract lab tests from uploaded file
 @router.post('/labtests/extract/{medicalhistory_id}', status_code=status.HTTP_200_OK) 
-@limiter.limit("5/minute")
+@rate_limit("llm")
 async def extract_lab_tests(request: Request, medicalhistory_id: uuid.UUID, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Extract lab test data from a file associated with a medical history record.
     
@@ -18,7 +20,7 @@ async def extract_lab_tests(request: Request, medicalhistory_id: uuid.UUID, user
     The file is retrieved from the database, decrypted, and processed to identify lab tests, values, and reference ranges.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medicalhistory_id (uuid.UUID): ID of the medical history record containing the file to analyze.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -56,7 +58,7 @@ async def extract_lab_tests(request: Request, medicalhistory_id: uuid.UUID, user
 
 # Create the lab test records in the database
 @router.post('/me/labtests/', status_code=status.HTTP_201_CREATED)
-@limiter.limit("5/minute")
+@rate_limit("write")
 async def create_lab_tests(request: Request, extraction_result: LabsCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Create lab test records in the database based on extracted data.
     
@@ -64,7 +66,7 @@ async def create_lab_tests(request: Request, extraction_result: LabsCreate, user
     It creates or updates lab test definitions as needed and records the individual test results for the user.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         extraction_result (LabsCreate): Contains extracted lab test data including:
             - medicalhistory_id: UUID of the associated medical history record
             - date_collection: Date when the lab tests were collected
@@ -83,7 +85,6 @@ async def create_lab_tests(request: Request, extraction_result: LabsCreate, user
         status: 201 CREATED: Lab tests created successfully
     """
     medhistory = session.get(MedicalHistory, extraction_result.medicalhistory_id)
-    user = session.get(User, user_id)
     
     if not medhistory:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Medical history not found")
@@ -92,33 +93,33 @@ async def create_lab_tests(request: Request, extraction_result: LabsCreate, user
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this medical history")
     
     try:
-        # Check if extract lab test name already exists, if not create it in the database
-        for lab_item in extraction_result.lab_tests:
-            lab_test = session.exec(select(LabTest).where(LabTest.name == lab_item.name)).first()
-            
-            if not lab_test:
-                lab_test = LabTest(
-                    name = lab_item.name,
-                    code = lab_item.code,
-                )
-                session.add(lab_test)
-                session.flush() # Use flush to get the id of the newly created lab_test
-            
-            # Create the lab result record in the database
-            lab_result = LabResult(
-                value = lab_item.value,
-                is_numeric = check_is_numeric(lab_item.value),
-                unit = lab_item.unit,
-                reference_range = lab_item.reference_range,
-                date_collection = extraction_result.date_collection,
-                test = lab_test,
-                medicalhistory = medhistory,
-                user = user,
-                method = lab_item.method
-            )
-            
-            session.add(lab_result)
-            session.flush()
+        # Resolve all the extracted lab test names at once, creating the ones that don't exist yet in the database
+        test_ids = get_or_create_lab_tests(extraction_result.lab_tests, session)
+        
+        # Build all the lab result rows and insert them with a single bulk insert instead of flushing each one
+        # The id and date_added defaults are not applied by bulk inserts, so they are set here
+        date_added = datetime.now()
+        lab_results = [
+            {
+                "id": uuid.uuid4(),
+                "value": lab_item.value,
+                "is_numeric": check_is_numeric(lab_item.value),
+                **numeric_value_columns(lab_item.value),
+                "unit": lab_item.unit,
+                "reference_range": lab_item.reference_range,
+                **lab_range_columns(lab_item.reference_range),
+                "method": lab_item.method,
+                "date_collection": extraction_result.date_collection,
+                "date_added": date_added,
+                "test_id": test_ids[lab_item.name],
+                "user_id": user_id,
+                "medicalhistory_id": medhistory.id,
+            }
+            for lab_item in extraction_result.lab_tests
+        ]
+        
+        if lab_results:
+            session.execute(insert(LabResult), lab_results)
             
         session.commit()
         
@@ -133,16 +134,16 @@ async def create_lab_tests(request: Request, extraction_result: LabsCreate, user
 
 # Get all lab tests for the user    
 @router.get('/me/labtests/', response_model=list[LabTestResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 async def get_lab_tests(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Retrieve all lab tests and their results for the logged in user.
     
-    This endpoint fetches all lab test types that have results for the user, along with the
-    complete history of results for each test type. Results are organized by test type and
-    sorted chronologically, allowing for tracking changes in values over time.
+    This endpoint fetches all of the user's lab results in a single query, ordered by collection date,
+    and groups them by lab test type. Results are organized by test type and sorted chronologically
+    (newest first), allowing for tracking changes in values over time.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -162,41 +163,88 @@ async def get_lab_tests(request: Request, user_id: uuid.UUID = Depends(validate_
                 - medicalhistory: Information about the associated medical history record
         status: 200 OK: Lab tests retrieved successfully
     """
-    user = session.get(User, user_id)
-    
-    # Get all lab tests of LabTest and their corresponding results of LabResult for the user
-    lab_tests = session.exec(select(LabTest).where(LabTest.results.any(user_id=user.id))).all()
+    # Get only the user's lab results with the columns of their test and a flag for the file of their medical history, newest first
+    # The rows are grouped under their lab test in a single pass, as dictionaries in the shape of LabTestResponse
+    lab_results = session.exec(select_labresult_rows(user_id, order_by=LabResult.date_collection)).all()
     
-    response = []
-    
-    # Iterate through the lab tests and their results
-    for test in lab_tests:
-        lab_test = LabTestResponse(
-            id = test.id,
-            name = test.name,
-            code = test.code,
-            results = []
-        )
-        
-        for result in test.results:
-            lab_result = LabResultResponse(
-                id = result.id,
-                value = result.value,
-                is_numeric = result.is_numeric,
-                unit = result.unit,
-                reference_range = result.reference_range,
-                date_collection = result.date_collection,
-                method = result.method,
-                medicalhistory = MedicalHistoryResponseLab(
-                    id = result.medicalhistory.id,
-                    file = True if result.medicalhistory.file else False,
-                )
-            )
-            
-            lab_test.results.append(lab_result)
-        
-        # Sort the results by date_collection
-        lab_test.results = sort_by_date(lab_test.results)
-        response.append(lab_test)
+    return json_response(group_lab_tests(lab_results))
 
-    return response
+
+# Get the numeric results of a single lab test for the user, used for graphing
+@router.get('/me/labtests/{test_id}/series', response_model=LabSeriesResponse, status_code=status.HTTP_200_OK)
+@rate_limit("read")
+async def get_lab_test_series(
+    request: Request,
+    test_id: uuid.UUID,
+    start: date | None = None,
+    end: date | None = None,
+    max_points: int | None = Query(default=None, ge=3),
+    user_id: uuid.UUID = Depends(validate_session),
+    session: Session = Depends(get_session)
+):
+    """ Retrieve the numeric results of a lab test for the logged in user as parallel arrays of dates and values.
+    
+    This endpoint is used to graph the history of a lab test. Only numeric results are returned, using the
+    precomputed value_numeric column so the string values don't need to be parsed on every request. Long
+    histories can be downsampled on the server with the LTTB algorithm, which keeps the shape of the graph.
+
+    Args:
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
+        test_id (uuid.UUID): ID of the lab test to get the results for.
+        start (date, optional): Only include results collected on or after this date.
+        end (date, optional): Only include results collected on or before this date.
+        max_points (int, optional): Maximum number of points to return, at least 3. The series is downsampled if it has more points.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
+        session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
+
+    Raises:
+        HTTPException: 404 NOT_FOUND if the lab test is not found.
+
+    Returns:
+        LabSeriesResponse: Object with the following fields:
+            - id: UUID of the lab test
+            - name: Name of the lab test
+            - code: Lab test code, if available
+            - unit: Unit of measurement of the most recent result
+            - dates: Collection dates of the results, oldest first
+            - values: Numeric values of the results, in the same order as the dates
+        status: 200 OK: Lab test series retrieved successfully
+    """
+    lab_test = session.get(LabTest, test_id)
+    
+    if not lab_test:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lab test not found")
+    
+    # Only select the columns needed for the graph, oldest first
+    query = (
+        select(LabResult.date_collection, LabResult.value_numeric, LabResult.unit)
+        .where(LabResult.user_id == user_id)
+        .where(LabResult.test_id == test_id)
+        .where(col(LabResult.value_numeric).is_not(None))
+        .order_by(col(LabResult.date_collection))
+    )
+    
+    if start:
+        query = query.where(LabResult.date_collection >= start)
+    if end:
+        query = query.where(LabResult.date_collection <= end)
+        
+    rows = session.exec(query).all()
+    
+    dates = [row.date_collection for row in rows]
+    values = [row.value_numeric for row in rows]
+    
+    # Downsample long histories, using the date ordinals as the x axis
+    if max_points and len(rows) > max_points:
+        indices = downsample_lttb([item.toordinal() for item in dates], values, max_points)
+        dates = [dates[i] for i in indices]
+        values = [values[i] for i in indices]
+    
+    return LabSeriesResponse(
+        id = lab_test.id,
+        name = lab_test.name,
+        code = lab_test.code,
+        unit = rows[-1].unit if rows else None,
+        dates = dates,
+        values = values
+    )
\ No newline at end of file
@@ -1,22 +1,21 @@
 from fastapi import Depends, HTTPException, status, Response, Request, APIRouter
 from sqlmodel import Session, select
 import uuid
-import os
 
 from ..models import MedicalHistory, MedicalHistoryResponse, MedicalHistoryCreate, MedicalHistoryUpdate, User, MedicalCategory, MedicalSubcategory, MedicalCategoryResponse, MedicalSubcategoryResponse, LabSubcategory, LabSubcategoryResponse
-from ..utils import get_session, validate_session, limiter
+from ..utils import get_session, validate_session, lookup_cache, lookup_response, schedule_file_deletion, rate_limit, json_response, serialize_rows, select_medicalhistory_rows, medicalhistory_row
 
 router = APIRouter()
 
 ### Medical History endpoints
 # Get all medical history records
 @router.get("/me/medicalhistory", response_model=list[MedicalHistoryResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 def get_medicalhistory(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Get all medical history records for the logged in user. This will be used to display the medical history records in the application.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -43,33 +42,22 @@ def get_medicalhistory(request: Request, user_id: uuid.UUID = Depends(validate_s
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
-    if not user.medicalhistory:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No medical history records found")
-    
-    response = []
+    # Get the user's medical history records joined with the names of their categories, serialized straight from the query results
+    response = serialize_rows(select_medicalhistory_rows(user_id), medicalhistory_row, session)
     
-    # Iterate through the user's medical history records and create a response for each one
-    for history in user.medicalhistory:
-        medhistory_response = MedicalHistoryResponse(
-            **history.model_dump(exclude={"user", "labresults", "file", "category", "subcategory", "labsubcategory", "date_consultation"}), # Using model_dump to exclude certain fields which will be added manually because of response model types
-            category = history.category.name,
-            subcategory = history.subcategory.name if history.subcategory else None,
-            labsubcategory = history.labsubcategory.name if history.labsubcategory else None,
-            file = True if history.file else False,
-            date_consultation = history.date_consultation,
-        )
-        response.append(medhistory_response)          
+    if not response:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No medical history records found")
             
-    return response
+    return json_response(response)
 
 # Add a medical history record
 @router.post("/me/medicalhistory", status_code=status.HTTP_201_CREATED, response_model=MedicalHistoryResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def create_medicalhistory(request: Request, medhistory: MedicalHistoryCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Create a new medical history record for the logged in user. This will be used to add new medical history records to the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medhistory (MedicalHistoryCreate): Contains medical history data: name, doctor_name, place, notes, category, subcategory, labsubcategory, and date_consultation.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -92,12 +80,10 @@ def create_medicalhistory(request: Request, medhistory: MedicalHistoryCreate, us
             - date_consultation: str: Date when the consultation took place
         status: 201 CREATED: Medical history record created successfully
     """
-    user = session.get(User, user_id)
-    
-    # Get the different categories and subcategories from the database based on the names provided in the request
-    category = session.exec(select(MedicalCategory).where(MedicalCategory.name == medhistory.category)).first()
-    subcategory = session.exec(select(MedicalSubcategory).where(MedicalSubcategory.name == medhistory.subcategory)).first()
-    labsubcategory = session.exec(select(LabSubcategory).where(LabSubcategory.name == medhistory.labsubcategory)).first()
+    # Get the different categories and subcategories from the lookup cache based on the names provided in the request
+    category = lookup_cache.get(MedicalCategory, medhistory.category, session)
+    subcategory = lookup_cache.get(MedicalSubcategory, medhistory.subcategory, session)
+    labsubcategory = lookup_cache.get(LabSubcategory, medhistory.labsubcategory, session)
     
     medhistory_db = session.exec(select(MedicalHistory).where(MedicalHistory.name == medhistory.name)).first()
     
@@ -111,10 +97,10 @@ def create_medicalhistory(request: Request, medhistory: MedicalHistoryCreate, us
             doctor_name = medhistory.doctor_name,
             place = medhistory.place,
             notes = medhistory.notes,
-            category = category,
-            subcategory = subcategory,
-            labsubcategory= labsubcategory,
-            user = user,
+            category_id = category["id"] if category else None,
+            subcategory_id = subcategory["id"] if subcategory else None,
+            labsubcategory_id = labsubcategory["id"] if labsubcategory else None,
+            user_id = user_id,
             date_consultation = medhistory.date_consultation,)
         
         session.add(new_medicalhistory)
@@ -127,10 +113,10 @@ def create_medicalhistory(request: Request, medhistory: MedicalHistoryCreate, us
             doctor_name = new_medicalhistory.doctor_name,
             place = new_medicalhistory.place,
             notes = new_medicalhistory.notes,
-            category = new_medicalhistory.category.name,
-            subcategory = new_medicalhistory.subcategory.name if new_medicalhistory.subcategory else None,
-            labsubcategory = new_medicalhistory.labsubcategory.name if new_medicalhistory.labsubcategory else None,
-            file = True if new_medicalhistory.file else False,
+            category = category["name"],
+            subcategory = subcategory["name"] if subcategory else None,
+            labsubcategory = labsubcategory["name"] if labsubcategory else None,
+            file = False,
             date_consultation = new_medicalhistory.date_consultation,
         )
         
@@ -143,12 +129,12 @@ def create_medicalhistory(request: Request, medhistory: MedicalHistoryCreate, us
     
 # Update a medical history record
 @router.patch("/me/medicalhistory/{medhistory_id}", status_code=status.HTTP_200_OK, response_model=MedicalHistoryResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_medicalhistory(request: Request, medhistory_id: uuid.UUID, medhistory: MedicalHistoryUpdate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Update a medical history record for the logged in user. This will be used to modify existing medical history records in the database. All fields are optional, so the user can update only the fields they want to change.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medhistory_id (uuid.UUID): ID of the medical history record to update.
         medhistory (MedicalHistoryUpdate): Contains updated medical history data with all fields as optional.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
@@ -187,35 +173,36 @@ def update_medicalhistory(request: Request, medhistory_id: uuid.UUID, medhistory
     
     try:
         # Check if user's provided different categories and subcategories exist in the database
+        # The categories are found in the lookup cache and set by their IDs
         if medhistory_data["category"] is not None:
             category_name = medhistory_data.pop("category")
-            category = session.exec(select(MedicalCategory).where(MedicalCategory.name == category_name)).first()
+            category_id = lookup_cache.get_id(MedicalCategory, category_name, session)
             
-            if category:
-                medhistory_db.category = category
+            if category_id:
+                medhistory_db.category_id = category_id
                 
                 match category_name:
                     case "Imagistică":
-                        medhistory_db.subcategory = None
-                        medhistory_db.labsubcategory = None
+                        medhistory_db.subcategory_id = None
+                        medhistory_db.labsubcategory_id = None
                     case "Laborator":
-                        medhistory_db.subcategory = None
+                        medhistory_db.subcategory_id = None
                     case "Consultație":
-                        medhistory_db.labsubcategory = None
+                        medhistory_db.labsubcategory_id = None
         
         if medhistory_data["subcategory"] is not None:
             subcategory_name = medhistory_data.pop("subcategory")
-            subcategory = session.exec(select(MedicalSubcategory).where(MedicalSubcategory.name == subcategory_name)).first()
+            subcategory_id = lookup_cache.get_id(MedicalSubcategory, subcategory_name, session)
             
-            if subcategory:
-                medhistory_db.subcategory = subcategory
+            if subcategory_id:
+                medhistory_db.subcategory_id = subcategory_id
                 
         if medhistory_data["labsubcategory"] is not None:
             labsubcategory_name = medhistory_data.pop("labsubcategory")
-            labsubcategory = session.exec(select(LabSubcategory).where(LabSubcategory.name == labsubcategory_name)).first()
+            labsubcategory_id = lookup_cache.get_id(LabSubcategory, labsubcategory_name, session)
             
-            if labsubcategory:
-                medhistory_db.labsubcategory = labsubcategory
+            if labsubcategory_id:
+                medhistory_db.labsubcategory_id = labsubcategory_id
         
         # Update the medical history record in the database
         medhistory_db.sqlmodel_update(medhistory_data)
@@ -248,12 +235,12 @@ def update_medicalhistory(request: Request, medhistory_id: uuid.UUID, medhistory
     
 # Delete a medical history record
 @router.delete("/me/medicalhistory/{medhistory_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def delete_medicalhistory(request: Request, medhistory_id: uuid.UUID, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Delete a medical history record for the logged in user. This will also delete any associated files.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medhistory_id (uuid.UUID): ID of the medical history record to delete.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -261,7 +248,6 @@ def delete_medicalhistory(request: Request, medhistory_id: uuid.UUID, user_id: u
     Raises:
         HTTPException: 404 NOT FOUND if the medical history record is not found in the database.
         HTTPException: 403 FORBIDDEN if the user ID from the session does not match the user ID of the medical history record.
-        HTTPException: 500 INTERNAL SERVER ERROR if an error occurs when deleting the associated file or folder.
 
     Returns:
         "message": Medical History record deleted successfully
@@ -275,16 +261,9 @@ def delete_medicalhistory(request: Request, medhistory_id: uuid.UUID, user_id: u
     if medhistory.user_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this medical history record")
     
+    # The file is removed from the file system by the background sweeper once the deletion is committed
     if medhistory.file:
-        file_path = medhistory.file.file_path
-        folder_path = os.path.dirname(file_path)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            try:
-                os.rmdir(folder_path)
-            except PermissionError:
-                print("Error deleting folder due to Windows permissions error")
-                # raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while deleting the folder")
+        schedule_file_deletion(medhistory.file.file_path, session)
         
     session.delete(medhistory)
     session.commit()
@@ -294,51 +273,60 @@ def delete_medicalhistory(request: Request, medhistory_id: uuid.UUID, user_id: u
 
 # Get all medical categories
 @router.get("/medicalcategories", response_model=list[MedicalCategoryResponse], status_code=status.HTTP_200_OK)
-def get_medicalcategories(session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_medicalcategories(request: Request, session: Session = Depends(get_session)):
     """ Retrieve all available medical categories from the database.
     
     This endpoint does not require authentication as it provides reference data for the application.
+    The data is served from the lookup cache with an ETag, so clients can revalidate it with If-None-Match.
     Categories typically include "Consultație", "Imagistică", and "Laborator".
 
     Args:
-        session (Session): Database session
+        request (Request): Request is used to read the If-None-Match header
+        session (Session): Database session, only used if the lookup cache is not loaded
 
     Returns:
         list[MedicalCategoryResponse]: List of all medical categories
         status: 200 OK: Medical categories retrieved successfully
     """
-    return session.exec(select(MedicalCategory)).all()
+    return lookup_response(request, MedicalCategory, MedicalCategoryResponse, session)
 
 # Get all medical subcategories
 @router.get("/medicalsubcategories", response_model=list[MedicalSubcategoryResponse], status_code=status.HTTP_200_OK)
-def get_medicalsubcategories(session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_medicalsubcategories(request: Request, session: Session = Depends(get_session)):
     """ Retrieve all available medical subcategories from the database.
     
     This endpoint does not require authentication as it provides reference data for the application.
+    The data is served from the lookup cache with an ETag, so clients can revalidate it with If-None-Match.
     Subcategories are related to consultation types (e.g., "Cardiologie", "Neurologie").
 
     Args:
-        session (Session): Database session
+        request (Request): Request is used to read the If-None-Match header
+        session (Session): Database session, only used if the lookup cache is not loaded
 
     Returns:
         list[MedicalSubcategoryResponse]: List of all medical subcategories
         status: 200 OK: Medical subcategories retrieved successfully
     """
-    return session.exec(select(MedicalSubcategory)).all()
+    return lookup_response(request, MedicalSubcategory, MedicalSubcategoryResponse, session)
 
 # Get all lab subcategories
 @router.get("/labsubcategories", response_model=list[LabSubcategoryResponse], status_code=status.HTTP_200_OK)
-def get_labsubcategories(session: Session = Depends(get_session)):
+@rate_limit("lookup")
+def get_labsubcategories(request: Request, session: Session = Depends(get_session)):
     """ Retrieve all available laboratory subcategories from the database.
     
     This endpoint does not require authentication as it provides reference data for the application.
+    The data is served from the lookup cache with an ETag, so clients can revalidate it with If-None-Match.
     Lab subcategories are specialized types of laboratory tests (e.g., "Hematologie", "Biochimie").
 
     Args:
-        session (Session): Database session
+        request (Request): Request is used to read the If-None-Match header
+        session (Session): Database session, only used if the lookup cache is not loaded
 
     Returns:
         list[LabSubcategoryResponse]: List of all laboratory subcategories
         status: 200 OK: Lab subcategories retrieved successfully
     """
-    return session.exec(select(LabSubcategory)).all()
\ No newline at end of file
+    return lookup_response(request, LabSubcategory, LabSubcategoryResponse, session)
\ No newline at end of file
@@ -1,21 +1,21 @@
 from fastapi import Depends, HTTPException, status, APIRouter, Request
-from sqlmodel import Session, select
+from sqlmodel import Session
 import uuid
 
-from ..models import User, Medication, MedicationResponse, MedicationCreate, MedicationRoute, MedicationForm, MedicationRouteResponse, MedicationFormResponse, MedicationUpdate
-from ..utils import get_session, validate_session, limiter
+from ..models import Medication, MedicationResponse, MedicationCreate, MedicationRoute, MedicationForm, MedicationRouteResponse, MedicationFormResponse, MedicationUpdate
+from ..utils import get_session, validate_session, lookup_cache, lookup_response, rate_limit, json_response, serialize_rows, select_medication_rows, medication_row
 
 router = APIRouter()
 
 ### Medication endpoints
 # Get all medications
 @router.get("/me/medications", response_model=list[MedicationResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 def get_medications(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Get all medications for the logged in user. This will be used to display the medications in the medications page of the application.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -34,39 +34,22 @@ def get_medications(request: Request, user_id: uuid.UUID = Depends(validate_sess
             - time_of_day: str: Time of day when the medication should be taken
         status: 200 OK: Medications retrieved successfully
     """
-    user = session.get(User, user_id)
+    # Get the user's medications joined with the names of their route and form, serialized straight from the query results
+    result = serialize_rows(select_medication_rows(user_id), medication_row, session)
     
-    if not user.medications:
+    if not result:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No medications found for this user")
     
-    # Need to do this because each user has multiple medications, and each medication has a route which is a string and not a MedicationRoute object in the response model
-    result = []
-    for medication in user.medications:
-        med = {
-            "id": medication.id,
-            "name": medication.name,
-            "dosage": medication.dosage,
-            "frequency": medication.frequency,
-            "date_prescribed": medication.date_prescribed,
-            "duration_days": medication.duration_days,
-            "route": medication.route.name if medication.route else None,
-            "form": medication.form.name if medication.form else None,
-            "notes": medication.notes,
-            "date_added": medication.date_added,
-            "time_of_day": medication.time_of_day
-        }
-        result.append(med)
-    
-    return result
+    return json_response(result)
 
 # Add medication
 @router.post("/me/medications", status_code=status.HTTP_201_CREATED, response_model=MedicationResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def add_medication(request: Request, medication: MedicationCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Add a medication for the logged in user. This will be used to add a new medication to the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medication (MedicationCreate): Contains medication data: name, dosage, frequency, date_prescribed, duration_days, route, form, notes, and time_of_day.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -90,16 +73,14 @@ def add_medication(request: Request, medication: MedicationCreate, user_id: uuid
             - time_of_day: str: Time of day when the medication should be taken
         status: 201 CREATED: Medication added successfully
     """
-    user = session.get(User, user_id)
-    
-    # Find the medication route using the route name
-    medication_route = session.exec(select(MedicationRoute).where(MedicationRoute.name == medication.route)).first()
+    # Find the medication route in the lookup cache using the route name
+    medication_route = lookup_cache.get(MedicationRoute, medication.route, session)
     
     if not medication_route:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Medication route not found")
     
-    # Find the medication form using the form name
-    medication_form = session.exec(select(MedicationForm).where(MedicationForm.name == medication.form)).first()
+    # Find the medication form in the lookup cache using the form name
+    medication_form = lookup_cache.get(MedicationForm, medication.form, session)
     
     if not medication_form:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Medication form not found")
@@ -112,10 +93,10 @@ def add_medication(request: Request, medication: MedicationCreate, user_id: uuid
             frequency = medication.frequency,
             date_prescribed = medication.date_prescribed,
             duration_days = medication.duration_days,
-            route = medication_route,
-            form = medication_form,
+            route_id = medication_route["id"],
+            form_id = medication_form["id"],
             notes = medication.notes,
-            user = user,
+            user_id = user_id,
             time_of_day=medication.time_of_day
             )
             
@@ -130,8 +111,8 @@ def add_medication(request: Request, medication: MedicationCreate, user_id: uuid
             frequency = new_medication.frequency,
             date_prescribed = new_medication.date_prescribed,
             duration_days = new_medication.duration_days,
-            route = new_medication.route.name,
-            form = new_medication.form.name,
+            route = medication_route["name"],
+            form = medication_form["name"],
             notes = new_medication.notes,
             date_added = new_medication.date_added,
             time_of_day = new_medication.time_of_day
@@ -146,12 +127,12 @@ def add_medication(request: Request, medication: MedicationCreate, user_id: uuid
         
 # Delete medication
 @router.delete("/me/medications/{medication_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def delete_medication(request: Request, medication_id: uuid.UUID, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Delete a medication for the logged in user. This will be used to remove a medication from the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medication_id (uuid.UUID): ID of the medication to delete.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -180,12 +161,12 @@ def delete_medication(request: Request, medication_id: uuid.UUID, user_id: uuid.
 
 # Update medication
 @router.patch("/me/medications/{medication_id}", status_code=status.HTTP_200_OK, response_model=MedicationResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_medication(request: Request, medication_id: uuid.UUID, medication_new: MedicationUpdate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Update a medication for the logged in user. This will be used to modify an existing medication in the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         medication_id (uuid.UUID): ID of the medication to update.
         medication_new (MedicationUpdate): Contains updated medication data with all fields as optional.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
@@ -222,19 +203,20 @@ def update_medication(request: Request, medication_id: uuid.UUID, medication_new
     medication_data = medication_new.model_dump(exclude_unset=True)
     
     try:
-        if medication_data["route"] is not None:
-            route_name = medication_data.pop("route")
-            route = session.exec(select(MedicationRoute).where(MedicationRoute.name == route_name)).first()
+        # Find the route and form in the lookup cache and set them by their IDs
+        route_name = medication_data.pop("route", None)
+        if route_name is not None:
+            route_id = lookup_cache.get_id(MedicationRoute, route_name, session)
             
-            if route:
-                medication_db.route = route
+            if route_id:
+                medication_db.route_id = route_id
         
-        if medication_data["form"] is not None:
-            form_name = medication_data.pop("form")
-            form = session.exec(select(MedicationForm).where(MedicationForm.name == form_name)).first()
+        form_name = medication_data.pop("form", None)
+        if form_name is not None:
+            form_id = lookup_cache.get_id(MedicationForm, form_name, session)
             
-            if form:
-                medication_db.form = form
+            if form_id:
+                medication_db.form_id = form_id
         
         medication_db.sqlmodel_update(medication_data)
         session.add(medication_db)
@@ -264,13 +246,16 @@ def update_medication(request: Request, medication_id: uuid.UUID, medication_new
     
 # Get all medication routes
 @router.get("/medications/routes", response_model=list[MedicationRouteResponse], status_code=status.HTTP_200_OK)
-def get_medication_routes(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
-    """ Retrieve all available medication routes from the database.
+@rate_limit("lookup")
+def get_medication_routes(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+    """ Retrieve all available medication routes from the lookup cache.
 
     This endpoint requires a valid user session but does not use the user_id for filtering,
-    as medication routes are global and not user-specific.
+    as medication routes are global and not user-specific. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): User ID from the validated session token (used for authorization only)
         session (Session): Database session
 
@@ -278,18 +263,20 @@ def get_medication_routes(user_id: uuid.UUID = Depends(validate_session), sessio
         list[MedicationRouteResponse]: List of all medication routes (e.g., "Oral", "Intravenous", "Topical")
         status: 200 OK: Medication routes retrieved successfully
     """
-    medication_routes = session.exec(select(MedicationRoute)).all()
-    return medication_routes
+    return lookup_response(request, MedicationRoute, MedicationRouteResponse, session)
 
 # Get all medication forms
 @router.get("/medications/forms", response_model=list[MedicationFormResponse], status_code=status.HTTP_200_OK)
-def get_medication_forms(user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
-    """ Retrieve all available medication forms from the database.
+@rate_limit("lookup")
+def get_medication_forms(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
+    """ Retrieve all available medication forms from the lookup cache.
 
     This endpoint requires a valid user session but does not use the user_id for filtering,
-    as medication forms are global and not user-specific.
+    as medication forms are global and not user-specific. The response has an ETag, so
+    clients can revalidate it with If-None-Match and get a 304 Not Modified if it did not change.
 
     Args:
+        request (Request): Request is used to read the If-None-Match header
         user_id (uuid.UUID): User ID from the validated session token (used for authorization only)
         session (Session): Database session
 
@@ -297,5 +284,4 @@ def get_medication_forms(user_id: uuid.UUID = Depends(validate_session), session
         list[MedicationFormResponse]: List of all medication forms (e.g., "Tablet", "Capsule", "Liquid")
         status: 200 OK: Medication forms retrieved successfully
     """
-    medication_forms = session.exec(select(MedicationForm)).all()
-    return medication_forms
\ No newline at end of file
+    return lookup_response(request, MedicationForm, MedicationFormResponse, session)
\ No newline at end of file
@@ -0,0 +1,34 @@
+from fastapi import HTTPException, status, Request, Response, APIRouter
+import hmac
+
+from ..utils import render_metrics, METRICS_TOKEN
+
+router = APIRouter()
+
+# Prometheus metrics endpoint, returns the request latency, database and rate limiter metrics of this process
+@router.get("/metrics", status_code=status.HTTP_200_OK, include_in_schema=False)
+def get_metrics(request: Request):
+    """ Metrics endpoint. Will be used by Prometheus to scrape the metrics of this process in the text exposition format.
+
+    Every worker process keeps its own metrics, so each worker is scraped separately. The endpoint is not rate limited,
+    so scrapes don't spend any budget and don't show up in the rate limiter statistics. The endpoint is disabled unless
+    METRICS_TOKEN is set, and Prometheus sends the token as a bearer token.
+
+    Args:
+        request (Request): Request is used to read the Authorization header with the metrics token.
+
+    Raises:
+        HTTPException: 404 NOT FOUND if METRICS_TOKEN is not set, so the endpoint looks like it does not exist.
+        HTTPException: 401 UNAUTHORIZED if the request does not have METRICS_TOKEN as a bearer token.
+
+    Returns:
+        Response: The metrics in the Prometheus text format
+    """
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    authorization = request.headers.get("authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
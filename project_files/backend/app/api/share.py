@@ -1,17 +1,19 @@
-from fastapi import Depends, HTTPException, status, APIRouter, Body, Request
+from fastapi import Depends, HTTPException, status, APIRouter, Body, Request, Response
 from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
 import uuid
-from datetime import datetime, timedelta
+import json
+from datetime import date, datetime, timedelta
 from typing import Annotated
+from pydantic import ValidationError
 
-from ..models import User, ShareToken, CreateShareToken, ShareTokenResponse, ShareItemsResponse, FileResponse
-from ..utils import get_session, validate_session, create_hash, verify_hash, get_item_data, get_connected_record, decrypt_file, limiter
+from ..models import User, ShareToken, CreateShareToken, ShareTokenResponse, ShareItemsResponse, FileResponse, AbnormalItems
+from ..utils import get_session, validate_session, create_hash, verify_share_pin, create_share_snapshot, read_share_items, get_shared_ids, get_connected_record, decrypt_file, record_file_bytes, get_abnormal_items, rate_limit
 
 router = APIRouter()
 
 @router.post("/share/create", response_model=ShareTokenResponse, status_code=status.HTTP_201_CREATED)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 async def create_share_token(
     request: Request,
     share_data: CreateShareToken,
@@ -24,7 +26,7 @@ async def create_share_token(
     selected health information with healthcare providers or family members.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         share_data (CreateShareToken): Contains sharing parameters:
             - pin: str: PIN code that will be needed to access the data
             - token_length: int: Duration in minutes that the sharing link will remain valid
@@ -34,6 +36,8 @@ async def create_share_token(
 
     Raises:
         HTTPException: 404 NOT FOUND if the user is not found in the database
+        HTTPException: 422 UNPROCESSABLE ENTITY if the shared items don't match their response models
+        HTTPException: 413 REQUEST ENTITY TOO LARGE if the compressed shared items are bigger than the size limit
         HTTPException: 500 INTERNAL SERVER ERROR if an error occurs during token creation
 
     Returns:
@@ -47,6 +51,14 @@ async def create_share_token(
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
+    # Resolve and validate the shared items once, so verifying the share link only needs to decode the stored snapshot
+    try:
+        shared_items, snapshot = create_share_snapshot(share_data.shared_items, session)
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Invalid shared items: {e}")
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Too many items selected for sharing")
+    
     # Hash the PIN created in the create share link form
     hashed_pin = create_hash(share_data.pin)
     
@@ -55,7 +67,8 @@ async def create_share_token(
         share_token = ShareToken(
             expiration_time=datetime.now() + timedelta(minutes=share_data.token_length),
             hashed_pin=hashed_pin,
-            shared_items=share_data.shared_items,
+            shared_items=shared_items,
+            snapshot=snapshot,
             user = user
         )
         
@@ -75,7 +88,7 @@ async def create_share_token(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error creating share token: {str(e)}")
         
 @router.get("/share/{share_code}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 async def check_share_token(
     request: Request,
     share_code: str,
@@ -88,7 +101,7 @@ async def check_share_token(
     share token exists.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         share_code (str): The unique code from the share token
         session (Session): Database session
 
@@ -114,7 +127,7 @@ async def check_share_token(
     }
     
 @router.post("/share/{share_code}/verify", status_code=status.HTTP_200_OK, response_model=ShareItemsResponse)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 async def verify_share_token(
     request: Request,
     share_code: str,
@@ -127,7 +140,7 @@ async def verify_share_token(
     When successful, it returns all health data that was selected for sharing.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         share_code (str): The unique code from the share token
         pin (str): PIN code associated with the share token
         session (Session): Database session
@@ -135,6 +148,7 @@ async def verify_share_token(
     Raises:
         HTTPException: 404 NOT FOUND if the share token does not exist
         HTTPException: 403 FORBIDDEN if the provided PIN does not match
+        HTTPException: 429 TOO MANY REQUESTS if the share link is locked after too many failed PIN attempts
 
     Returns:
         ShareItemsResponse: Comprehensive object containing:
@@ -148,9 +162,8 @@ async def verify_share_token(
     if not share_token:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Share token not found")
     
-    # Check the PIN against the hashed PIN stored in the database
-    if not verify_hash(pin, share_token.hashed_pin):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid PIN")
+    # Check the PIN against the hashed PIN stored in the database, share links locked after too many failed attempts are rejected before hashing
+    verify_share_pin(share_token, pin)
     
     user = session.exec(select(User).where(User.id == share_token.user_id)).first()
     
@@ -159,20 +172,20 @@ async def verify_share_token(
         "dob": user.dob.strftime("%d-%m-%Y") if user.dob else None,
     }
     
-    # Process the shared items, which are stored as a JSON string in the database
-    items_data = get_item_data(share_token.shared_items, session)
+    # The shared items are stored as a compressed snapshot already serialized for the response,
+    # so the decompressed JSON is written into the response without parsing or validating it again
+    items_json = read_share_items(share_token, session)
     
-    items_response = ShareItemsResponse(
-        expiration_time=share_token.expiration_time,
-        patient=user_data,
-        items=items_data
-    )
+    header = json.dumps({
+        "expiration_time": share_token.expiration_time.isoformat(),
+        "patient": user_data,
+    }, ensure_ascii=False)
     
-    return items_response
+    return Response(content=header[:-1].encode("utf-8") + b',"items":' + items_json + b"}", media_type="application/json")
     
     
 @router.delete("/share/{share_code}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 async def delete_share_token(
     request: Request,
     share_code: str,
@@ -185,7 +198,7 @@ async def delete_share_token(
     its natural expiration time, providing control over who can access their health data.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         share_code (str): The unique code from the share token to delete
         session (Session): Database session
         user_id (uuid.UUID): ID of the authenticated user requesting deletion
@@ -214,9 +227,61 @@ async def delete_share_token(
         "detail": "Share token deleted successfully"
     }
     
+# Get the abnormal shared items
+@router.get("/share/{share_code}/abnormal", response_model=AbnormalItems, status_code=status.HTTP_200_OK)
+@rate_limit("bcrypt")
+async def get_shared_abnormal(
+    share_code: str,
+    request: Request,
+    start: date | None = None,
+    end: date | None = None,
+    session: Session = Depends(get_session)
+):
+    """ Retrieve the shared lab results and vitals that are outside of their normal range over a date window.
+    
+    This endpoint is the share link equivalent of the abnormal items endpoint. It requires the share token's PIN
+    in the Authorization header for access, and only returns records that were selected when the share link was created.
+
+    Args:
+        share_code (str): The unique code from the share token
+        request (Request): Request object containing the Authorization header with the PIN
+        start (date, optional): Only include records on or after this date. Defaults to one year before the end date.
+        end (date, optional): Only include records on or before this date. Defaults to today.
+        session (Session): Database session
+
+    Raises:
+        HTTPException: 404 NOT FOUND if the share token does not exist
+        HTTPException: 410 GONE if the share token has expired
+        HTTPException: 403 FORBIDDEN if the PIN in the Authorization header is invalid or missing
+        HTTPException: 429 TOO MANY REQUESTS if the share link is locked after too many failed PIN attempts
+
+    Returns:
+        AbnormalItems: Object with the following fields:
+            - labresults: list: Out of range shared lab results, newest first
+            - vitals: list: Out of range shared vitals, newest first
+        status: 200 OK: Abnormal shared items retrieved successfully
+    """
+    share_token = session.exec(select(ShareToken).where(ShareToken.share_code == share_code)).first()
+    
+    if not share_token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Share token not found")
+    
+    if share_token.expiration_time < datetime.now():
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Share token has expired")
+    
+    verify_share_pin(share_token, request.headers.get('Authorization'))
+    
+    end = end or date.today()
+    start = start or end - timedelta(days=365)
+    
+    # Only the shared records can be returned, not every record of the user
+    shared_ids = get_shared_ids(share_token)
+    
+    return get_abnormal_items(share_token.user_id, start, end, session, labresult_ids=shared_ids['labresults'], healthdata_ids=shared_ids['vitals'])
+    
 # Get file metadata
 @router.get("/share/{share_code}/{record_type}/{record_id}/metadata", response_model=FileResponse, status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 async def get_file_metadata(
     share_code: str,
     record_type: str,
@@ -241,6 +306,7 @@ async def get_file_metadata(
         HTTPException: 404 NOT FOUND if the share token or file does not exist
         HTTPException: 410 GONE if the share token has expired
         HTTPException: 403 FORBIDDEN if the PIN in the Authorization header is invalid or missing
+        HTTPException: 429 TOO MANY REQUESTS if the share link is locked after too many failed PIN attempts
 
     Returns:
         FileResponse: Object containing file metadata with the following fields:
@@ -258,13 +324,7 @@ async def get_file_metadata(
     if share_token.expiration_time < datetime.now():
         raise HTTPException(status_code=status.HTTP_410_GONE, detail="Share token has expired")
     
-    pin = request.headers.get('Authorization')
-    
-    if not pin:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Authorization header missing")
-    
-    if not verify_hash(pin, share_token.hashed_pin):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid PIN")
+    verify_share_pin(share_token, request.headers.get('Authorization'))
     
     user_id = share_token.user_id
     
@@ -283,7 +343,7 @@ async def get_file_metadata(
     )
     
 @router.get("/share/{share_code}/file/{record_type}/{record_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 async def get_shared_file(
     share_code: str,
     record_type: str,
@@ -308,6 +368,7 @@ async def get_shared_file(
         HTTPException: 404 NOT FOUND if the share token or file does not exist
         HTTPException: 410 GONE if the share token has expired
         HTTPException: 403 FORBIDDEN if the PIN in the Authorization header is invalid or missing
+        HTTPException: 429 TOO MANY REQUESTS if the share link is locked after too many failed PIN attempts
 
     Returns:
         StreamingResponse: The decrypted file content streamed to the client with appropriate headers
@@ -321,13 +382,7 @@ async def get_shared_file(
     if share_token.expiration_time < datetime.now():
         raise HTTPException(status_code=status.HTTP_410_GONE, detail="Share token has expired")
     
-    pin = request.headers.get('Authorization')
-    
-    if not pin:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Authorization header missing")
-    
-    if not verify_hash(pin, share_token.hashed_pin):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid PIN")
+    verify_share_pin(share_token, request.headers.get('Authorization'))
     
     record = await get_connected_record(record_type, record_id, share_token.user_id, session)
     
@@ -345,6 +400,7 @@ async def get_shared_file(
             encrypted_content = f.read()
             
         decrypted_content = decrypt_file(encrypted_content)
+        record_file_bytes(len(decrypted_content))
 
         yield decrypted_content
         
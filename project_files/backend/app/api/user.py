@@ -1,9 +1,11 @@
 from fastapi import Depends, HTTPException, status, Response, Request, APIRouter
+from fastapi.responses import StreamingResponse
 from sqlmodel import Session
+from datetime import datetime
 import uuid
 
-from ..models import User, UserResponse, UserUpdate, UserPasswordChange
-from ..utils import get_session, validate_session, verify_hash, create_hash, limiter
+from ..models import User, UserResponse, UserUpdate, UserPasswordChange, UserDelete
+from ..utils import get_session, validate_session, verify_hash, create_hash, stream_account_export, delete_account, rate_limit
 
 router = APIRouter()
 
@@ -35,7 +37,7 @@ async def read_users_me(user_id: uuid.UUID = Depends(validate_session), session:
 
 # Update user endpoint  
 @router.patch("/update", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_user(request: Request, user_update: UserUpdate, session: Session = Depends(get_session), user_id: uuid.UUID = Depends(validate_session)):
     """ Update the currently logged in user's profile information.
     
@@ -45,7 +47,7 @@ def update_user(request: Request, user_update: UserUpdate, session: Session = De
 
     Args:
         request (Request): Request is automatically used by the endpoint and the rate limiter 
-            middleware to limit the number of requests from a single IP address.
+            middleware to limit the number of requests from a single user or IP address.
         user_update (UserUpdate): Contains the updated user data with all fields as optional:
             name as str, email as EmailStr, dob as date.
         session (Session, optional): Session is automatically used by the endpoint to access 
@@ -94,7 +96,7 @@ def update_user(request: Request, user_update: UserUpdate, session: Session = De
     
 # Update user password endpoint
 @router.patch("/update/password", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("bcrypt")
 def update_password(password_update: UserPasswordChange, request: Request, response: Response, session: Session = Depends(get_session), user_id: uuid.UUID = Depends(validate_session)):
     """ Update the password for the currently logged in user.
     
@@ -107,7 +109,7 @@ def update_password(password_update: UserPasswordChange, request: Request, respo
             - current_password: str: The user's current password for verification
             - new_password: str: The new password to set
         request (Request): Request is automatically used by the endpoint and the rate limiter 
-            middleware to limit the number of requests from a single IP address.
+            middleware to limit the number of requests from a single user or IP address.
         response (Response): Response object for the HTTP response
         session (Session, optional): Session is automatically used by the endpoint to access 
             the database by using the SQLModel ORM.
@@ -150,4 +152,96 @@ def update_password(password_update: UserPasswordChange, request: Request, respo
     except Exception as e:
         session.rollback()
         print(f"Error: {e}")
-        raise HTTPException(status_code=500, detail=f"An error occurred when updating: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"An error occurred when updating: {e}")
+
+# Export all the data of the user endpoint
+@router.get("/me/export", status_code=status.HTTP_200_OK)
+@rate_limit("export")
+def export_account(request: Request, session: Session = Depends(get_session), user_id: uuid.UUID = Depends(validate_session)):
+    """ Export everything stored for the currently logged in user as a zip archive.
+    
+    The archive contains the profile, a JSON and a CSV file for every table (vaccines, allergies, medications,
+    vitals, medical history, lab results and share links), the decrypted documents and a manifest. It is built
+    while it is streamed to the client, so the whole archive is never held in memory.
+
+    Args:
+        request (Request): Request is automatically used by the endpoint and the rate limiter 
+            middleware to limit the number of requests from a single user or IP address.
+        session (Session, optional): Session is automatically used by the endpoint to access 
+            the database by using the SQLModel ORM.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically 
+            used by the endpoint to get the user ID from the session cookie and validate for database access.
+
+    Raises:
+        HTTPException: 404 NOT FOUND if the user is not found in the database.
+
+    Returns:
+        StreamingResponse: The zip archive, as an attachment named after the export date
+        status: 200 OK: Export started successfully
+    """
+    if not session.get(User, user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    
+    filename = f"export_{datetime.now().strftime('%d%m%Y_%H%M%S')}.zip"
+    return StreamingResponse(
+        stream_account_export(user_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Delete user account endpoint
+@router.delete("/me", status_code=status.HTTP_200_OK)
+@rate_limit("bcrypt")
+def delete_user(user_delete: UserDelete, request: Request, response: Response, session: Session = Depends(get_session), user_id: uuid.UUID = Depends(validate_session)):
+    """ Delete the account of the currently logged in user, with all their records, share links, sessions and files.
+    
+    The password is confirmed before anything is deleted. The rows are removed with bulk DELETE statements
+    instead of loading every record into the session, and the uploaded files are removed in the background
+    once the deletion is committed. The session cookie is cleared from the client.
+
+    Args:
+        user_delete (UserDelete): Contains the password of the user, to confirm the deletion
+        request (Request): Request is automatically used by the endpoint and the rate limiter 
+            middleware to limit the number of requests from a single user or IP address.
+        response (Response): Response object used to delete the session cookie
+        session (Session, optional): Session is automatically used by the endpoint to access 
+            the database by using the SQLModel ORM.
+        user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically 
+            used by the endpoint to get the user ID from the session cookie and validate for database access.
+
+    Raises:
+        HTTPException: 404 NOT FOUND if the user is not found in the database.
+        HTTPException: 409 CONFLICT if the password provided is incorrect.
+        HTTPException: 500 INTERNAL SERVER ERROR if an error occurs during the deletion.
+
+    Returns:
+        "message": Account deleted successfully
+        status: 200 OK: Account deleted successfully
+    """
+    user_db = session.get(User, user_id)
+    
+    if not user_db:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    
+    if not verify_hash(user_delete.password, user_db.hashed_password):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Incorrect password")
+    
+    try:
+        delete_account(user_id, session)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"Error deleting account: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred when deleting the account")
+    
+    # The sessions of the user are deleted with the account, the cookie is removed from the client as well
+    response.delete_cookie(
+        "session_id",
+        samesite="strict",
+        secure=True,
+        httponly=True
+    )
+    
+    return {
+        "message": "Account deleted successfully"
+    }
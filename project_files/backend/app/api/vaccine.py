@@ -1,22 +1,21 @@
 from fastapi import Depends, HTTPException, status, Response, Request, APIRouter
 from sqlmodel import Session
 import uuid
-import os
 
 from ..models import Vaccine, VaccineResponse, VaccineCreate, VaccineUpdate, User
-from ..utils import get_session, validate_session, limiter
+from ..utils import get_session, validate_session, schedule_file_deletion, rate_limit, json_response, serialize_rows, select_vaccine_rows, vaccine_row
 
 router = APIRouter()
 
 ### Vaccine endpoints
 # Get all vaccines
 @router.get("/me/vaccines", response_model=list[VaccineResponse], status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("read")
 def get_vaccines(request: Request, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Get all vaccines for the logged in user. This will be used to display the vaccines in the vaccines page of the application.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
 
@@ -39,30 +38,22 @@ def get_vaccines(request: Request, user_id: uuid.UUID = Depends(validate_session
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
-    if not user.vaccines:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No vaccines found")
-    
-    vaccine_responses = []
+    # Get the user's vaccines with a flag for their certificate, serialized straight from the query results
+    vaccine_responses = serialize_rows(select_vaccine_rows(user_id), vaccine_row, session)
     
-    # Iterate through the user's vaccines and create a response for each one
-    for vaccine in user.vaccines:
-        vaccine_response = VaccineResponse(
-            **vaccine.model_dump(exclude={"user", "certificate", "date_received"}), # Will omit the user and certificate fields from the response, which will be added manually due to different field types in the response model
-            certificate=True if vaccine.certificate else False,
-            date_received=vaccine.date_received
-        )
-        vaccine_responses.append(vaccine_response)
+    if not vaccine_responses:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No vaccines found")
         
-    return vaccine_responses
+    return json_response(vaccine_responses)
 
 # Add a vaccine
 @router.post("/me/vaccines", status_code=status.HTTP_201_CREATED, response_model=VaccineResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def add_vaccine(request: Request, vaccine: VaccineCreate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Add a vaccine for the logged in user. This will be used to add a new vaccine to the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         vaccine (VaccineCreate): Contains vaccine data: name as str, provider as str, date_received as str.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -110,12 +101,12 @@ def add_vaccine(request: Request, vaccine: VaccineCreate, user_id: uuid.UUID = D
 
 # Delete a vaccine
 @router.delete("/me/vaccines/{vaccine_id}", status_code=status.HTTP_200_OK)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def delete_vaccine(request: Request, vaccine_id: uuid.UUID, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Delete a vaccine for the logged in user. This will also delete any associated certificate file.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         vaccine_id (uuid.UUID): ID of the vaccine to delete.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
         session (Session, optional): Session is automatically used by the endpoint to access the database by using the SQLModel ORM.
@@ -140,16 +131,8 @@ def delete_vaccine(request: Request, vaccine_id: uuid.UUID, user_id: uuid.UUID =
     # Delete the file associated with the vaccine
     file_record = vaccine.certificate
     if file_record:
-        # Delete file from the file system
-        file_path = file_record.file_path
-        if os.path.exists(file_path):
-            folder_path = os.path.dirname(file_path)
-            os.remove(file_path)
-            try:
-                os.rmdir(folder_path)
-            except PermissionError:
-                print("Error deleting folder due to Windows permissions error")
-                  
+        # The file is removed from the file system by the background sweeper once the deletion is committed
+        schedule_file_deletion(file_record.file_path, session)
         session.delete(file_record)
     
     session.delete(vaccine)
@@ -160,12 +143,12 @@ def delete_vaccine(request: Request, vaccine_id: uuid.UUID, user_id: uuid.UUID =
 
 # Update a vaccine
 @router.patch("/me/vaccines/{vaccine_id}", status_code=status.HTTP_200_OK, response_model=VaccineResponse)
-@limiter.limit("5/minute")
+@rate_limit("write")
 def update_vaccine(request: Request, vaccine_id: uuid.UUID, vaccine_new: VaccineUpdate, user_id: uuid.UUID = Depends(validate_session), session: Session = Depends(get_session)):
     """ Update a vaccine for the logged in user. This will be used to modify an existing vaccine in the database.
 
     Args:
-        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single IP address.
+        request (Request): Request is automatically used by the endpoint and the rate limiter middleware to limit the number of requests from a single user or IP address.
         vaccine_id (uuid.UUID): ID of the vaccine to update.
         vaccine_new (VaccineUpdate): Contains updated vaccine data with all fields as optional: name as str, provider as str, date_received as str.
         user_id (uuid.UUID, optional): User ID of the logged in user. This is automatically used by the endpoint to get the user ID from the session cookie and validate for database access.
@@ -1,16 +1,16 @@
 from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 
-from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
-from .utils import limiter
+from .utils import limiter, rate_limit_exceeded_handler
 
 from .api import get_all_routers
-from .utils import create_db_and_tables
+from .utils import create_db_and_tables, run_migrations, lookup_cache, file_deletion_sweeper, CompressionMiddleware, MetricsMiddleware, instrument_engine, ProfilerMiddleware, profile_engine, engine
+from .utils.reconcile import reconcile_job
 
 # Lifespan can be used to perform startup and shutdown tasks for the FastAPI application.
 @asynccontextmanager
@@ -21,17 +21,38 @@ async def lifespan(app: FastAPI):
         print("Database and tables created successfully")
     except Exception as e:
         print(f"Error creating database and tables: {e}")
+    
+    # Bring the database up to date, the endpoints rely on the new columns and unique indexes so startup stops if this fails
+    try:
+        run_migrations()
+    except Exception as e:
+        print(f"Error running database migrations: {e}")
+        raise
+        
+    # Load the reference tables into the lookup cache, if this fails they are loaded on the first request instead
+    try:
+        lookup_cache.load()
+    except Exception as e:
+        print(f"Error loading lookup cache: {e}")
+    
+    # Remove the files of deleted records in the background, retrying the ones that fail
+    sweeper = asyncio.create_task(file_deletion_sweeper())
+    
+    # Periodically reclaim uploaded files left without a database row
+    reconciler = asyncio.create_task(reconcile_job())
     yield
+    sweeper.cancel()
+    reconciler.cancel()
 
 # Initialise the FastAPI application
 app = FastAPI(lifespan=lifespan)
 
 # Middleware to handle rate limiting and setting exception handlers
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 
-# Middleware to compress responses for larger payloads
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Middleware to compress the larger text and JSON responses with zstd, Brotli or gzip, binary downloads are sent as they are
+app.add_middleware(CompressionMiddleware, minimum_size=1000)
 
 # Set a trusted host list for incoming requests to prevent host header attacks
 app.add_middleware(
@@ -52,6 +73,15 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Middleware to run the requests sent with the profiler token under a sampling profiler, disabled unless PROFILER_TOKEN is set
+profile_engine(engine)
+app.add_middleware(ProfilerMiddleware)
+
+# Middleware to record the latency, database queries and slow work of every request, exposed by the /metrics endpoint
+# Added last so it is the outermost middleware and its timings include the other ones
+instrument_engine(engine)
+app.add_middleware(MetricsMiddleware)
+
 # HTTPS redirect middleware to redirect HTTP requests to HTTPS
 # Will be enabled in production
 # app.add_middleware(HTTPSRedirectMiddleware)
@@ -10,13 +10,13 @@ if TYPE_CHECKING:
 # Allergen Table models for database many-to-many relationships
 # These models are used to create the many-to-many relationships between Allergy and Allergens, and Allergy and Reactions.
 class AllergyAllergensLink(SQLModel, table=True):
-    allergy_id: uuid.UUID = Field(foreign_key="allergy.id", primary_key=True)
+    allergy_id: uuid.UUID = Field(foreign_key="allergy.id", primary_key=True, ondelete="CASCADE")
     allergen_id: uuid.UUID = Field(foreign_key="allergens.id", primary_key=True)
     
 # Reactions Table models for database many-to-many relationships
 # These models are used to create the many-to-many relationships between Allergy and Allergens, and Allergy and Reactions.    
 class AllergyReactionsLink(SQLModel, table=True):
-    allergy_id: uuid.UUID = Field(foreign_key="allergy.id", primary_key=True)
+    allergy_id: uuid.UUID = Field(foreign_key="allergy.id", primary_key=True, ondelete="CASCADE")
     reaction_id: uuid.UUID = Field(foreign_key="reactions.id", primary_key=True)
 
 # Allergy model for date and serializers
@@ -33,7 +33,7 @@ class Allergy(AllergyDates, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     notes: str | None = None
         
-    user_id : uuid.UUID = Field(foreign_key="user.id")
+    user_id : uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="allergies")
     
     allergens: list["Allergens"] = Relationship(back_populates="allergies", link_model=AllergyAllergensLink)
@@ -74,13 +74,13 @@ class AllergyUpdate(SQLModel):
 # Allergens, Reactions and Severity models for database
 class Allergens(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    name: str
+    name: str = Field(index=True, unique=True)
     
     allergies: list[Allergy] = Relationship(back_populates="allergens", link_model=AllergyAllergensLink)
     
 class Reactions(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    name: str
+    name: str = Field(index=True, unique=True)
     
     allergies: list[Allergy] = Relationship(back_populates="reactions", link_model=AllergyReactionsLink)
     
@@ -1,4 +1,5 @@
 from sqlmodel import Field, SQLModel, Relationship
+from sqlalchemy import Index
 from pydantic import field_serializer
 from datetime import date, datetime
 import uuid
@@ -18,13 +19,19 @@ class HealthDataDates(SQLModel):
     
 # Health data model for database
 class HealthData(HealthDataDates, table=True):
+    # Indexes used to fetch a user's health data over a date window, for all types or for a single type
+    __table_args__ = (
+        Index("ix_healthdata_user_id_date_recorded", "user_id", "date_recorded"),
+        Index("ix_healthdata_user_id_type_id_date_recorded", "user_id", "type_id", "date_recorded"),
+    )
+    
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     value: float | None = None
     value_systolic: float | None = None
     value_diastolic: float | None = None
     notes: str | None = None
     
-    user_id : uuid.UUID = Field(foreign_key="user.id")
+    user_id : uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="healthdata")
     
     type_id : uuid.UUID = Field(foreign_key="healthdatatype.id")
@@ -42,6 +49,56 @@ class HealthDataResponse(HealthDataDates):
     normal_range: str | None = None
     trend: str | None = None     
     
+# Health data summary response model, used for API responses with the statistics of each health data type recorded by the user.
+# For compound types (blood pressure) the value statistics are for the systolic value, and the diastolic value has its own statistics.
+class HealthDataSummaryResponse(SQLModel):
+    name: str
+    unit: str
+    normal_range: str | None = None
+    count: int
+    trend: str
+    latest: HealthDataResponse
+    value_min: float | None = None
+    value_max: float | None = None
+    value_mean: float | None = None
+    value_rolling_mean: float | None = None
+    diastolic_min: float | None = None
+    diastolic_max: float | None = None
+    diastolic_mean: float | None = None
+    diastolic_rolling_mean: float | None = None
+    
+# Health data aggregate response models, used for API responses with the statistics of a health data type over time buckets.
+# For compound types (blood pressure) the value statistics are for the systolic value, and the diastolic value has its own statistics.
+class HealthDataBucket(SQLModel):
+    bucket_start: date
+    count: int
+    value_min: float | None = None
+    value_max: float | None = None
+    value_mean: float | None = None
+    diastolic_min: float | None = None
+    diastolic_max: float | None = None
+    diastolic_mean: float | None = None
+    
+    @field_serializer('bucket_start')
+    def serialize_bucket_start(self, value: date) -> str:
+        return value.strftime("%d-%m-%Y")
+    
+class HealthDataAggregateResponse(SQLModel):
+    name: str
+    unit: str
+    normal_range: str | None = None
+    bucket: str
+    buckets: list[HealthDataBucket] = []
+    
+# Health data bulk ingestion response models, used for API responses of the bulk upload with the number of inserted readings and the rows that failed
+class HealthDataBulkError(SQLModel):
+    row: int
+    detail: str
+    
+class HealthDataBulkResponse(SQLModel):
+    inserted: int
+    errors: list[HealthDataBulkError] = []
+    
 # Health data create models, used for API requests to create new health data entries. Different models for different types of health data - simple is all that have single values and blood pressure is a compound type with two values.
 class SimpleHealthDataCreate(HealthDataDates):
     name: str
@@ -77,6 +134,13 @@ class HealthDataType(SQLModel, table=True):
     is_compound: bool = False
     normal_range: str | None = None
     
+    # Bounds parsed from normal_range, for compound types (blood pressure) the main bounds are systolic
+    normal_low: float | None = None
+    normal_high: float | None = None
+    normal_low_diastolic: float | None = None
+    normal_high_diastolic: float | None = None
+    normal_range_parsed: str | None = None # normal_range the bounds were parsed from, the bounds are recomputed at startup when it changes
+    
     healthdata: list[HealthData] = Relationship(back_populates="type")
     
 # Health data type response model, used for API responses
@@ -1,4 +1,5 @@
 from sqlmodel import Field, SQLModel, Relationship
+from sqlalchemy import Index, text
 from pydantic import field_serializer
 from datetime import date, datetime
 from typing import TYPE_CHECKING, Optional, List
@@ -34,9 +35,9 @@ class MedicalHistory(MedicalHistoryDates, table=True):
     labsubcategory_id: uuid.UUID | None = Field(default=None, foreign_key="labsubcategory.id")
     labsubcategory: Optional["LabSubcategory"] = Relationship(back_populates="medicalhistory")
     
-    labresults: List["LabResult"] = Relationship(back_populates="medicalhistory", cascade_delete=True)
+    labresults: List["LabResult"] = Relationship(back_populates="medicalhistory", cascade_delete=True, passive_deletes=True)
     
-    user_id: uuid.UUID = Field(foreign_key="user.id")
+    user_id: uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="medicalhistory")
     
     file: Optional["FileUpload"] = Relationship(back_populates="medicalhistory", cascade_delete=True)
@@ -133,26 +134,41 @@ class LabDates(SQLModel):
 # Lab Test model for database - lab test are parent records that only include the name of the test and a code. The actual results are stored in the LabResult model.
 class LabTest(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    name: str 
+    name: str = Field(index=True, unique=True)
     code: str | None = None
     
     results: List["LabResult"] = Relationship(back_populates="test")
     
 # Lab Result model for database - lab result are child records that include the actual results of the lab tests. Each lab test can have multiple results.
 class LabResult(LabDates, table=True):
+    # Indexes used to fetch a user's lab results ordered by collection date, either all of them, for a single test or only the out of range ones
+    __table_args__ = (
+        Index("ix_labresult_user_id_date_collection", "user_id", "date_collection"),
+        Index("ix_labresult_user_id_test_id_date_collection", "user_id", "test_id", "date_collection"),
+        Index(
+            "ix_labresult_out_of_range", "user_id", "date_collection",
+            postgresql_where=text("value_numeric < reference_low OR value_numeric > reference_high")
+        ),
+    )
+    
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     value: str
     is_numeric: bool
+    value_numeric: float | None = None # Value parsed as a float when it is numeric, so it doesn't need to be parsed on every read
+    value_parsed: str | None = None # value the value_numeric was parsed from, so the startup backfill skips the rows already parsed
     unit: str | None = None
     reference_range: str | None = None 
+    reference_low: float | None = None # Bounds parsed from reference_range when the result is created
+    reference_high: float | None = None
+    reference_range_parsed: str | None = None # reference_range the bounds were parsed from, so the startup backfill skips the rows already parsed
     method: str | None = None
     
     # Relationships
     test_id: uuid.UUID = Field(foreign_key="labtest.id")
     test: LabTest = Relationship(back_populates="results")
-    user_id: uuid.UUID = Field(foreign_key="user.id")
+    user_id: uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="labresults")
-    medicalhistory_id: uuid.UUID = Field(foreign_key="medicalhistory.id")
+    medicalhistory_id: uuid.UUID = Field(foreign_key="medicalhistory.id", ondelete="CASCADE")
     medicalhistory: MedicalHistory = Relationship(back_populates="labresults")
     
 # Lab Result create model, used for API requests to create a new lab result
@@ -198,6 +214,19 @@ class LabTestResponse(SQLModel):
     code: str | None = None
     results: List[LabResultResponse]
     
+# Lab Test series response model, used for API responses when graphing the numeric results of a single lab test
+class LabSeriesResponse(SQLModel):
+    id: uuid.UUID
+    name: str
+    code: str | None = None
+    unit: str | None = None
+    dates: List[date]
+    values: List[float]
+    
+    @field_serializer('dates')
+    def serialize_dates(self, value: List[date]) -> List[str]:
+        return [item.strftime("%d-%m-%Y") for item in value]
+    
 # Lab Result response model for dashboard, used for API responses in the dashboard
 class LabResultResponseDashboard(LabDates):
     id: uuid.UUID
@@ -26,7 +26,7 @@ class Medication(MedicationDates, table=True):
     duration_days: int | None = None
     notes: str | None = None
     
-    user_id : uuid.UUID = Field(foreign_key="user.id")
+    user_id : uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="medications")
     
     route_id : uuid.UUID = Field(foreign_key="medicationroute.id")
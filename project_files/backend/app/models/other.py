@@ -39,4 +39,21 @@ class FileResponse(SQLModel):
     id: uuid.UUID
     name: str
     file_type: str
-    file_path: str
\ No newline at end of file
+    file_path: str
+    
+# Pending file deletion model for database, used as an outbox of files to remove from disk
+# The rows are written in the same transaction as the deleted records and processed by a background sweeper
+class PendingFileDeletion(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    file_path: str
+    is_directory: bool = False
+    created_at: datetime = Field(default_factory=datetime.now)
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=datetime.now, index=True)
+    last_error: str | None = None
+    
+# Lookup version model for database, bumped when rows are added to a reference table
+# Every worker compares the versions with the ones of its lookup cache to know which tables to reload
+class LookupVersion(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    version: int = 0
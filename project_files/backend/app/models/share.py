@@ -1,4 +1,5 @@
 from sqlmodel import Field, SQLModel, Relationship, Column, JSON
+from sqlalchemy import LargeBinary
 from pydantic import field_serializer
 from datetime import date, datetime, timedelta
 from typing import List, TYPE_CHECKING
@@ -27,9 +28,11 @@ class ShareToken(SQLModel, table=True):
     expiration_time: datetime
     created_at: datetime = Field(default_factory=datetime.now)
     hashed_pin: str
+    # References to the shared records by category, and the compressed snapshot of the shared items returned when the share link is verified
     shared_items: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    snapshot: bytes | None = Field(default=None, sa_column=Column(LargeBinary))
    
-    user_id: uuid.UUID = Field(foreign_key="user.id")
+    user_id: uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="share_tokens")
     
 # Share Token create model, used for API requests to create a new share token
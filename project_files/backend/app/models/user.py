@@ -33,13 +33,13 @@ class User(DateFormattingModel, table=True):
     email: EmailStr = Field(index=True, unique=True)
     hashed_password: str
 #   MFA_secret: str | None = None # To be added later
-    vaccines: list["Vaccine"] = Relationship(back_populates="user", cascade_delete=True)
-    allergies: list["Allergy"] = Relationship(back_populates="user", cascade_delete=True)
-    medications: list["Medication"] = Relationship(back_populates="user", cascade_delete=True)
-    healthdata: list["HealthData"] = Relationship(back_populates="user", cascade_delete=True)
-    medicalhistory: list["MedicalHistory"] = Relationship(back_populates="user", cascade_delete=True)
-    labresults: list["LabResult"] = Relationship(back_populates="user", cascade_delete=True)
-    share_tokens: list["ShareToken"] = Relationship(back_populates="user", cascade_delete=True)
+    vaccines: list["Vaccine"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    allergies: list["Allergy"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    medications: list["Medication"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    healthdata: list["HealthData"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    medicalhistory: list["MedicalHistory"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    labresults: list["LabResult"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
+    share_tokens: list["ShareToken"] = Relationship(back_populates="user", cascade_delete=True, passive_deletes=True)
 
 # User response model, used for API responses when returning basic user information
 class UserResponse(DateFormattingModel):
@@ -48,15 +48,21 @@ class UserResponse(DateFormattingModel):
     email: EmailStr
     
 # User dashboard model, used for API responses to populate user dashboard with all health data
+# The categories that are not requested are left out, and the items only have the requested fields when fields are given
 class UserDashboard(SQLModel):
     id: uuid.UUID
     name: str
-    vaccines: list["VaccineResponse"]
-    allergies: list["AllergyResponse"]
-    medications: list["MedicationResponse"]
-    vitals: list["HealthDataResponse"]
-    medicalhistory: list["MedicalHistoryResponse"]
+    vaccines: list["VaccineResponse"] | None = None
+    allergies: list["AllergyResponse"] | None = None
+    medications: list["MedicationResponse"] | None = None
+    vitals: list["HealthDataResponse"] | None = None
+    medicalhistory: list["MedicalHistoryResponse"] | None = None
+    labresults: list["LabResultResponseDashboard"] | None = None
+
+# Abnormal items model, used for API responses listing the out of range lab results and vitals of a user over a date window
+class AbnormalItems(SQLModel):
     labresults: list["LabResultResponseDashboard"]
+    vitals: list["HealthDataResponse"]
 
 # User authentication model, used for API requests during login and registration
 class UserAuth(DateFormattingModel):
@@ -69,6 +75,10 @@ class UserPasswordChange(SQLModel):
     current_password: str
     new_password: str
 
+# User delete model, used for API requests to delete the account of the user after confirming their password
+class UserDelete(SQLModel):
+    password: str
+
 # User public model, minimal user data for API responses requiring only user ID
 class UserPublic(SQLModel):
     id: uuid.UUID
@@ -23,7 +23,7 @@ class Vaccine(VaccineDates, table=True):
     name: str
     provider: str
     
-    user_id : uuid.UUID = Field(foreign_key="user.id")
+    user_id : uuid.UUID = Field(foreign_key="user.id", ondelete="CASCADE")
     user: "User" = Relationship(back_populates="vaccines")
     
     certificate: Optional["FileUpload"] = Relationship(back_populates="vaccine", cascade_delete=True)
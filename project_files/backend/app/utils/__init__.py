@@ -2,7 +2,20 @@ from .auth_utils import *
 from .database import *
 from .encrypt_utils import *
 from .file_utils import *
+from .file_outbox import *
+from .account_utils import *
 from .lab_utils import *
+from .range_utils import *
+from .abnormal_utils import *
 from .share_utils import *
 from .vitals import *
-from .limiter import *
\ No newline at end of file
+from .serialize import *
+from .ingest_utils import *
+from .export_utils import *
+from .limiter import *
+from .lockout import *
+from .compression import *
+from .metrics import *
+from .profiler import *
+from .lookup_cache import *
+from .migrations import *
\ No newline at end of file
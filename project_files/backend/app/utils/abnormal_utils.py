@@ -0,0 +1,129 @@
+from sqlmodel import Session, select, col, or_
+from sqlalchemy.orm import joinedload, contains_eager
+from datetime import date
+import uuid
+
+from ..models import LabResult, HealthData, HealthDataType, MedicalHistory, AbnormalItems, LabResultResponseDashboard, HealthDataResponse, MedicalHistoryResponseLab
+from .vitals import healthdata_trend
+
+def lab_out_of_range():
+    """
+    SQL predicate matching lab results outside of their reference range.
+    
+    The expression is the same as the one of the partial index ix_labresult_out_of_range,
+    which lets the database answer the query from the index.
+    
+    Returns:
+        The SQL expression to use in a where clause
+    """
+    return or_(
+        col(LabResult.value_numeric) < col(LabResult.reference_low),
+        col(LabResult.value_numeric) > col(LabResult.reference_high),
+    )
+    
+def healthdata_out_of_range():
+    """
+    SQL predicate matching health data outside of the normal range of its type.
+    
+    Simple types only have a value and compound types (blood pressure) only have systolic
+    and diastolic values, so comparisons against the missing values are NULL and don't match.
+    The query needs to be joined with HealthDataType.
+    
+    Returns:
+        The SQL expression to use in a where clause
+    """
+    return or_(
+        col(HealthData.value) < col(HealthDataType.normal_low),
+        col(HealthData.value) > col(HealthDataType.normal_high),
+        col(HealthData.value_systolic) < col(HealthDataType.normal_low),
+        col(HealthData.value_systolic) > col(HealthDataType.normal_high),
+        col(HealthData.value_diastolic) < col(HealthDataType.normal_low_diastolic),
+        col(HealthData.value_diastolic) > col(HealthDataType.normal_high_diastolic),
+    )
+    
+def get_abnormal_items(user_id: uuid.UUID, start: date, end: date, session: Session, labresult_ids: list | None = None, healthdata_ids: list | None = None) -> AbnormalItems:
+    """
+    Get the out of range lab results and health data of a user over a date window.
+    
+    The range checks are done in SQL against the parsed range columns, so only the
+    abnormal rows are loaded. Used by the abnormal items endpoint and its share link equivalent,
+    which restricts the results to the shared records.
+    
+    Args:
+        user_id: ID of the user owning the records
+        start: Only include records on or after this date
+        end: Only include records on or before this date
+        session: Database session for the queries
+        labresult_ids: If given, only include lab results with these IDs
+        healthdata_ids: If given, only include health data with these IDs
+        
+    Returns:
+        AbnormalItems: The out of range lab results and vitals, newest first
+    """
+    labresults_query = (
+        select(LabResult)
+        .where(LabResult.user_id == user_id)
+        .where(LabResult.date_collection >= start)
+        .where(LabResult.date_collection <= end)
+        .where(lab_out_of_range())
+        .options(
+            joinedload(LabResult.test),
+            joinedload(LabResult.medicalhistory).joinedload(MedicalHistory.file),
+        )
+        .order_by(col(LabResult.date_collection).desc())
+    )
+    
+    healthdata_query = (
+        select(HealthData, healthdata_trend())
+        .join(HealthDataType)
+        .where(HealthData.user_id == user_id)
+        .where(HealthData.date_recorded >= start)
+        .where(HealthData.date_recorded <= end)
+        .where(healthdata_out_of_range())
+        .options(contains_eager(HealthData.type))
+        .order_by(col(HealthData.date_recorded).desc())
+    )
+    
+    if labresult_ids is not None:
+        labresults_query = labresults_query.where(col(LabResult.id).in_(labresult_ids))
+    if healthdata_ids is not None:
+        healthdata_query = healthdata_query.where(col(HealthData.id).in_(healthdata_ids))
+        
+    labresults = [
+        LabResultResponseDashboard(
+            id = labresult.id,
+            value = labresult.value,
+            is_numeric = labresult.is_numeric,
+            unit = labresult.unit,
+            reference_range = labresult.reference_range,
+            date_collection = labresult.date_collection,
+            method = labresult.method,
+            name = labresult.test.name,
+            code = labresult.test.code,
+            medicalhistory = MedicalHistoryResponseLab(
+                id = labresult.medicalhistory.id,
+                file = True if labresult.medicalhistory.file else False,
+            ),
+            date_added = labresult.date_added
+        )
+        for labresult in session.exec(labresults_query).all()
+    ]
+    
+    vitals = [
+        HealthDataResponse(
+            id = data.id,
+            name = data.type.name,
+            unit = data.type.unit,
+            value = data.value,
+            value_systolic = data.value_systolic,
+            value_diastolic = data.value_diastolic,
+            date_recorded = data.date_recorded,
+            notes = data.notes,
+            date_added = data.date_added,
+            normal_range = data.type.normal_range,
+            trend = trend
+        )
+        for data, trend in session.exec(healthdata_query).all()
+    ]
+    
+    return AbnormalItems(labresults=labresults, vitals=vitals)
@@ -0,0 +1,46 @@
+from sqlmodel import Session, select, col
+from sqlalchemy import delete
+from pathlib import Path
+import uuid
+
+from ..models import User, AuthSession, Vaccine, Allergy, AllergyAllergensLink, AllergyReactionsLink, Medication, HealthData, MedicalHistory, LabResult, FileUpload, ShareToken
+from .file_utils import UPLOADS_DIR
+from .file_outbox import schedule_file_deletion
+
+def delete_account(user_id: uuid.UUID, session: Session):
+    """
+    Delete a user and everything they own with bulk DELETE statements, and schedule the removal of their uploads folder.
+
+    The rows are deleted table by table in foreign key order, children first, so no row is loaded into the session.
+    The foreign keys also have ON DELETE CASCADE, which covers any table added later. The uploads folder of the user
+    is removed by the file deletion sweeper once the transaction is committed. The caller commits the transaction.
+
+    Args:
+        user_id: ID of the user to delete
+        session: Database session of the transaction
+    """
+    vaccine_ids = select(Vaccine.id).where(Vaccine.user_id == user_id)
+    allergy_ids = select(Allergy.id).where(Allergy.user_id == user_id)
+    medhistory_ids = select(MedicalHistory.id).where(MedicalHistory.user_id == user_id)
+
+    statements = [
+        delete(FileUpload).where(col(FileUpload.vaccine_id).in_(vaccine_ids)),
+        delete(FileUpload).where(col(FileUpload.medhistory_id).in_(medhistory_ids)),
+        delete(AllergyAllergensLink).where(col(AllergyAllergensLink.allergy_id).in_(allergy_ids)),
+        delete(AllergyReactionsLink).where(col(AllergyReactionsLink.allergy_id).in_(allergy_ids)),
+        delete(LabResult).where(LabResult.user_id == user_id),
+        delete(HealthData).where(HealthData.user_id == user_id),
+        delete(Allergy).where(Allergy.user_id == user_id),
+        delete(Medication).where(Medication.user_id == user_id),
+        delete(MedicalHistory).where(MedicalHistory.user_id == user_id),
+        delete(Vaccine).where(Vaccine.user_id == user_id),
+        delete(ShareToken).where(ShareToken.user_id == user_id),
+        delete(AuthSession).where(AuthSession.user_id == user_id),
+        delete(User).where(User.id == user_id),
+    ]
+
+    # The deleted rows are not loaded, so the session is not synchronized with them
+    for statement in statements:
+        session.execute(statement.execution_options(synchronize_session=False))
+
+    schedule_file_deletion(Path(UPLOADS_DIR) / str(user_id), session, is_directory=True)
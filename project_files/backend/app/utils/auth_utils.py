@@ -6,6 +6,7 @@ import uuid
 
 from ..models import AuthSession
 from .database import get_session
+from .metrics import track_time
 
 EXPIRE_MINUTES = 60 # 1 hour by default
 
@@ -20,7 +21,8 @@ def verify_hash(plaintext_password: str, hashed_password: str) -> bool:
     Returns:
         bool: True if the password matches the hash, False otherwise
     """
-    return bcrypt.verify(plaintext_password, hashed_password)
+    with track_time("bcrypt"):
+        return bcrypt.verify(plaintext_password, hashed_password)
     
 def create_hash(plaintext_password: str) -> str:
     """
@@ -32,7 +34,8 @@ def create_hash(plaintext_password: str) -> str:
     Returns:
         str: The hashed password
     """
-    return bcrypt.hash(plaintext_password)
+    with track_time("bcrypt"):
+        return bcrypt.hash(plaintext_password)
 
 async def create_session(user_id: uuid.UUID, session: Session = Depends(get_session)):
     """
@@ -88,6 +91,9 @@ async def validate_session(request: Request, session: Session = Depends(get_sess
     if not existingAuthSession:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Session not found")  
     
+    # Stored on the request so the rate limiter can key the limits by user
+    request.state.user_id = existingAuthSession.user_id
+    
     return existingAuthSession.user_id
 
 async def end_session(request: Request, session: Session = Depends(get_session)):
@@ -0,0 +1,198 @@
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import zlib
+import brotli
+import zstandard
+
+# Responses smaller than this are sent uncompressed, the headers and CPU time would outweigh the savings
+COMPRESSION_MINIMUM_SIZE = 1000
+
+# Complete bodies larger than this are compressed in a thread, so the event loop is not blocked by them
+COMPRESSION_THREAD_SIZE = 256 * 1024
+
+# Content types worth compressing, anything else (PDFs, images, zip archives) is already compressed and sent as is
+COMPRESSIBLE_CONTENT_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "application/x-ndjson", "image/svg+xml")
+
+# Supported encodings, in order of preference when the client accepts several with the same weight
+COMPRESSION_ENCODINGS = ("zstd", "br", "gzip")
+
+# Compression levels of the responses built per request, which favour speed, and of the cached bodies compressed once, which favour size
+DYNAMIC_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+STATIC_LEVELS = {"zstd": 19, "br": 11, "gzip": 9}
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """
+    Pick the encoding of a response from the Accept-Encoding header of the request.
+
+    Args:
+        accept_encoding: Value of the Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+
+    Returns:
+        str | None: The supported encoding with the highest weight, or None to send the response uncompressed
+    """
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip()
+        if not name:
+            continue
+
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+
+    best = None
+    for encoding in COMPRESSION_ENCODINGS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = (encoding, weight)
+
+    return best[0] if best else None
+
+def is_compressible(content_type: str | None) -> bool:
+    """
+    Check if a response with this Content-Type is worth compressing.
+    """
+    return bool(content_type) and content_type.lower().startswith(COMPRESSIBLE_CONTENT_TYPES)
+
+def compressor(encoding: str, level: int):
+    """
+    Create a streaming compressor for an encoding.
+
+    Returns:
+        A function compressing a chunk of the body, and a function returning the remaining bytes once the body is complete
+    """
+    if encoding == "zstd":
+        stream = zstandard.ZstdCompressor(level=level).compressobj()
+        return stream.compress, stream.flush
+    if encoding == "br":
+        stream = brotli.Compressor(quality=level)
+        return stream.process, stream.finish
+
+    stream = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return stream.compress, stream.flush
+
+def compress(body: bytes, encoding: str, level: int | None = None) -> bytes:
+    """
+    Compress a complete body.
+
+    Args:
+        body: Bytes to compress
+        encoding: One of the COMPRESSION_ENCODINGS
+        level: Compression level, defaults to the dynamic level of the encoding
+
+    Returns:
+        bytes: The compressed body
+    """
+    level = DYNAMIC_LEVELS[encoding] if level is None else level
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level, write_content_size=True).compress(body)
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+
+    stream = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return stream.compress(body) + stream.flush()
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing the responses with zstd, Brotli or gzip, negotiated from the Accept-Encoding header.
+
+    Only text-like content types are compressed, so the decrypted documents and the export archives are streamed
+    as they are. Responses which already have a Content-Encoding, like the pre-compressed lookup bodies, are left
+    untouched. Complete bodies are compressed in one go, in a thread when they are large, and streamed bodies are
+    compressed chunk by chunk.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = CompressionResponder(self.app, encoding, self.minimum_size)
+        await responder(scope, receive, send)
+
+class CompressionResponder:
+    """
+    Compress a single response, holding back its start message until the first body chunk shows how to send it.
+    """
+
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start_message = None
+        self.passthrough = False
+        self.stream = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.start_message = message
+            self.passthrough = "content-encoding" in headers or not is_compressible(headers.get("content-type"))
+            if self.passthrough:
+                await self.send(message)
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        # First chunk of the body, decide if and how the response is compressed
+        if self.stream is None and self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start_message["headers"])
+
+            if not more_body:
+                if len(body) < self.minimum_size:
+                    await self.send(start_message)
+                    await self.send(message)
+                    return
+
+                if len(body) > COMPRESSION_THREAD_SIZE:
+                    body = await asyncio.to_thread(compress, body, self.encoding)
+                else:
+                    body = compress(body, self.encoding)
+
+                headers["Content-Encoding"] = self.encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                await self.send(start_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+
+            # The length of a streamed body is not known once compressed
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            self.stream = compressor(self.encoding, DYNAMIC_LEVELS[self.encoding])
+            await self.send(start_message)
+
+        process, finish = self.stream
+        chunk = process(body)
+        if not more_body:
+            chunk += finish()
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
@@ -0,0 +1,251 @@
+from sqlmodel import Session, select, col
+from sqlalchemy.orm import selectinload
+from datetime import datetime
+import zipfile
+import json
+import csv
+import io
+import uuid
+
+from ..models import User, UserResponse, Vaccine, Allergy, Medication, HealthData, MedicalHistory, LabResult, FileUpload, ShareToken
+from .database import engine
+from .encrypt_utils import decrypt_file
+
+# Number of rows fetched from the database at a time, and size of the chunks written to the archive
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+class ZipStreamBuffer:
+    """
+    Write-only file object collecting the bytes written by zipfile, so the archive can be streamed as it is built.
+
+    zipfile writes data descriptors after each entry when the file object can't seek, so the
+    bytes of an entry never need to be rewritten and can be sent as soon as they are produced.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        """
+        Get the bytes written since the last call and clear them.
+        """
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_user_rows(model, user_id: uuid.UUID, session: Session, order_by, *options):
+    """
+    Stream the rows of a table owned by a user, with the relationships loaded by the given options.
+    """
+    return session.exec(
+        select(model)
+        .where(model.user_id == user_id)
+        .options(*options)
+        .order_by(col(order_by))
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+def export_vaccines(user_id: uuid.UUID, session: Session):
+    for vaccine in iter_user_rows(Vaccine, user_id, session, Vaccine.date_received, selectinload(Vaccine.certificate)):
+        yield {
+            **vaccine.model_dump(mode="json", exclude={"user_id"}),
+            "certificate": vaccine.certificate.name if vaccine.certificate else None,
+        }
+
+def export_allergies(user_id: uuid.UUID, session: Session):
+    options = [selectinload(Allergy.allergens), selectinload(Allergy.reactions), selectinload(Allergy.severity)]
+    for allergy in iter_user_rows(Allergy, user_id, session, Allergy.date_diagnosed, *options):
+        yield {
+            **allergy.model_dump(mode="json", exclude={"user_id", "severity_id"}),
+            "allergens": [allergen.name for allergen in allergy.allergens],
+            "reactions": [reaction.name for reaction in allergy.reactions],
+            "severity": allergy.severity.name if allergy.severity else None,
+        }
+
+def export_medications(user_id: uuid.UUID, session: Session):
+    options = [selectinload(Medication.route), selectinload(Medication.form)]
+    for medication in iter_user_rows(Medication, user_id, session, Medication.date_prescribed, *options):
+        yield {
+            **medication.model_dump(mode="json", exclude={"user_id", "route_id", "form_id"}),
+            "route": medication.route.name if medication.route else None,
+            "form": medication.form.name if medication.form else None,
+        }
+
+def export_vitals(user_id: uuid.UUID, session: Session):
+    for data in iter_user_rows(HealthData, user_id, session, HealthData.date_recorded, selectinload(HealthData.type)):
+        yield {
+            **data.model_dump(mode="json", exclude={"user_id", "type_id"}),
+            "name": data.type.name,
+            "unit": data.type.unit,
+        }
+
+def export_medicalhistory(user_id: uuid.UUID, session: Session):
+    options = [
+        selectinload(MedicalHistory.category),
+        selectinload(MedicalHistory.subcategory),
+        selectinload(MedicalHistory.labsubcategory),
+        selectinload(MedicalHistory.file),
+    ]
+    for history in iter_user_rows(MedicalHistory, user_id, session, MedicalHistory.date_consultation, *options):
+        yield {
+            **history.model_dump(mode="json", exclude={"user_id", "category_id", "subcategory_id", "labsubcategory_id"}),
+            "category": history.category.name if history.category else None,
+            "subcategory": history.subcategory.name if history.subcategory else None,
+            "labsubcategory": history.labsubcategory.name if history.labsubcategory else None,
+            "file": history.file.name if history.file else None,
+        }
+
+def export_labresults(user_id: uuid.UUID, session: Session):
+    for labresult in iter_user_rows(LabResult, user_id, session, LabResult.date_collection, selectinload(LabResult.test)):
+        yield {
+            **labresult.model_dump(mode="json", exclude={"user_id", "test_id"}),
+            "name": labresult.test.name,
+            "code": labresult.test.code,
+        }
+
+def export_share_links(user_id: uuid.UUID, session: Session):
+    for share_token in iter_user_rows(ShareToken, user_id, session, ShareToken.created_at):
+        yield share_token.model_dump(mode="json", include={"id", "share_code", "expiration_time", "created_at", "shared_items"})
+
+# Tables included in the export, each written as a JSON and a CSV file
+EXPORT_TABLES = [
+    ("vaccines", export_vaccines),
+    ("allergies", export_allergies),
+    ("medications", export_medications),
+    ("vitals", export_vitals),
+    ("medicalhistory", export_medicalhistory),
+    ("labresults", export_labresults),
+    ("share_links", export_share_links),
+]
+
+def write_json_entry(archive: zipfile.ZipFile, buffer: ZipStreamBuffer, name: str, rows):
+    """
+    Write the rows of a table to the archive as a JSON list, one row at a time.
+
+    Returns:
+        Generator of the archive bytes produced while writing, and the number of rows as its return value
+    """
+    count = 0
+    with archive.open(name, "w", force_zip64=True) as entry:
+        entry.write(b"[")
+        for row in rows:
+            entry.write((b"," if count else b"") + json.dumps(row, ensure_ascii=False).encode("utf-8"))
+            count += 1
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.pop()
+        entry.write(b"]")
+
+    yield buffer.pop()
+    return count
+
+def write_csv_entry(archive: zipfile.ZipFile, buffer: ZipStreamBuffer, name: str, rows):
+    """
+    Write the rows of a table to the archive as a CSV file, with the keys of the first row as the header.
+    Lists, e.g. the allergens of an allergy, are joined with semicolons and dictionaries are written as JSON.
+
+    Returns:
+        Generator of the archive bytes produced while writing
+    """
+    header = None
+    count = 0
+    with archive.open(name, "w", force_zip64=True) as entry:
+        for row in rows:
+            line = io.StringIO()
+            writer = csv.writer(line)
+            if header is None:
+                header = list(row)
+                writer.writerow(header)
+            writer.writerow([
+                "; ".join(str(item) for item in value) if isinstance(value, list)
+                else json.dumps(value, ensure_ascii=False) if isinstance(value, dict)
+                else value
+                for value in (row.get(key) for key in header)
+            ])
+            entry.write(line.getvalue().encode("utf-8"))
+
+            count += 1
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.pop()
+
+    yield buffer.pop()
+
+def iter_user_files(user_id: uuid.UUID, session: Session):
+    """
+    Get the uploaded files of a user with the folder they are exported to, vaccine certificates first.
+    """
+    for file_record in session.exec(select(FileUpload).join(Vaccine).where(Vaccine.user_id == user_id)):
+        yield "documents/vaccines", file_record
+    for file_record in session.exec(select(FileUpload).join(MedicalHistory).where(MedicalHistory.user_id == user_id)):
+        yield "documents/medicalhistory", file_record
+
+def write_file_entry(archive: zipfile.ZipFile, buffer: ZipStreamBuffer, name: str, file_path: str):
+    """
+    Decrypt an uploaded file and write it to the archive in chunks.
+
+    Fernet tokens can only be decrypted whole, so a single file is held in memory at a time,
+    which is bounded by the upload size limit of validate_file.
+
+    Returns:
+        Generator of the archive bytes produced while writing
+    """
+    with open(file_path, "rb") as f:
+        content = decrypt_file(f.read())
+
+    view = memoryview(content)
+    with archive.open(name, "w", force_zip64=True) as entry:
+        for start in range(0, len(view), EXPORT_CHUNK_SIZE):
+            entry.write(view[start:start + EXPORT_CHUNK_SIZE])
+            yield buffer.pop()
+
+    yield buffer.pop()
+
+def stream_account_export(user_id: uuid.UUID):
+    """
+    Build the zip archive of everything stored for a user, yielding its bytes as they are produced.
+
+    The archive contains the profile, a JSON and a CSV file for every table, the decrypted documents and a
+    manifest with the row counts and the documents that could not be exported. The rows are streamed from
+    the database in batches and the documents are written one at a time, so the memory used does not grow
+    with the size of the account. The generator opens its own database session, as the request's session is
+    closed before the response is streamed.
+
+    Args:
+        user_id: ID of the user to export
+
+    Returns:
+        Generator of the bytes of the zip archive
+    """
+    buffer = ZipStreamBuffer()
+    manifest = {"exported_at": datetime.now().strftime("%d-%m-%Y %H:%M:%S"), "tables": {}, "documents": 0, "missing_documents": []}
+
+    with Session(engine) as session, zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        user = session.get(User, user_id)
+        archive.writestr("profile.json", json.dumps(UserResponse.model_validate(user).model_dump(mode="json"), ensure_ascii=False, indent=2))
+        yield buffer.pop()
+
+        for table, export_rows in EXPORT_TABLES:
+            manifest["tables"][table] = yield from write_json_entry(archive, buffer, f"{table}.json", export_rows(user_id, session))
+            yield from write_csv_entry(archive, buffer, f"{table}.csv", export_rows(user_id, session))
+
+        for folder, file_record in iter_user_files(user_id, session):
+            # Prefixed with the file ID, so two documents with the same name don't overwrite each other when extracted
+            entry_name = f"{folder}/{file_record.id}_{file_record.name}"
+            try:
+                yield from write_file_entry(archive, buffer, entry_name, file_record.file_path)
+                manifest["documents"] += 1
+            except Exception as e:
+                print(f"Error exporting file {file_record.id}: {e}")
+                manifest["missing_documents"].append(entry_name)
+
+        archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    # The central directory is written when the archive is closed
+    yield buffer.pop()
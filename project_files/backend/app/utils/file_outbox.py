@@ -0,0 +1,127 @@
+from sqlmodel import Session, select, col
+from datetime import datetime, timedelta
+import asyncio
+import shutil
+import os
+
+from ..models import PendingFileDeletion
+from .database import engine
+
+# Seconds between two runs of the background sweeper, and the number of files removed per run
+FILE_DELETION_SWEEP_INTERVAL = 10
+FILE_DELETION_BATCH_SIZE = 100
+
+# Delay before retrying a failed removal in seconds, doubled for every failed attempt up to the maximum
+FILE_DELETION_RETRY_BASE_SECONDS = 30
+FILE_DELETION_RETRY_MAX_SECONDS = 60 * 60
+
+def schedule_file_deletion(file_path: str, session: Session, is_directory: bool = False):
+    """
+    Record a file to remove from disk, as part of the transaction deleting the record it belongs to.
+
+    Nothing is removed until the transaction is committed, so a failed commit never leaves a record
+    pointing at a missing file, and the request does no disk I/O.
+
+    Args:
+        file_path: Path of the file to remove
+        session: Database session of the transaction deleting the record
+        is_directory: Remove the path as a whole folder, e.g. the uploads folder of a deleted user
+    """
+    session.add(PendingFileDeletion(file_path=str(file_path), is_directory=is_directory))
+
+def remove_file(file_path: str, is_directory: bool = False):
+    """
+    Remove a file from disk, along with its folder if it is left empty, or a whole folder.
+
+    A path that is already missing counts as removed, so a removal can be retried safely.
+
+    Args:
+        file_path: Path of the file or folder to remove
+        is_directory: Remove the folder and everything in it
+
+    Raises:
+        OSError: If the path exists but can't be removed
+    """
+    if is_directory:
+        try:
+            shutil.rmtree(file_path)
+        except FileNotFoundError:
+            pass
+        return
+
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+    # Each record has its own folder, which is removed once its last file is gone
+    try:
+        os.rmdir(os.path.dirname(file_path))
+    except OSError:
+        pass
+
+def process_pending_deletions(session: Session, limit: int = FILE_DELETION_BATCH_SIZE) -> int:
+    """
+    Remove the files of the pending deletions that are due, rescheduling the ones that fail with a backoff.
+
+    The rows are locked with SKIP LOCKED, so sweepers running in several workers never process the same file.
+
+    Args:
+        session: Database session for the queries
+        limit: Maximum number of pending deletions to process
+
+    Returns:
+        int: The number of files removed
+    """
+    now = datetime.now()
+    pending = session.exec(
+        select(PendingFileDeletion)
+        .where(PendingFileDeletion.next_attempt_at <= now)
+        .order_by(col(PendingFileDeletion.next_attempt_at))
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    removed = 0
+    for deletion in pending:
+        try:
+            remove_file(deletion.file_path, deletion.is_directory)
+        except OSError as e:
+            deletion.attempts += 1
+            delay = min(FILE_DELETION_RETRY_BASE_SECONDS * 2 ** (deletion.attempts - 1), FILE_DELETION_RETRY_MAX_SECONDS)
+            deletion.next_attempt_at = now + timedelta(seconds=delay)
+            deletion.last_error = str(e)
+            session.add(deletion)
+            print(f"Error deleting file {deletion.file_path}, attempt {deletion.attempts}: {e}")
+            continue
+
+        session.delete(deletion)
+        removed += 1
+
+    session.commit()
+    return removed
+
+def run_file_deletion_sweep() -> int:
+    """
+    Run a single pass of the sweeper with its own database session.
+
+    Returns:
+        int: The number of files removed
+    """
+    with Session(engine) as session:
+        return process_pending_deletions(session)
+
+async def file_deletion_sweeper():
+    """
+    Background task removing the files of the pending deletions, started with the application.
+
+    The database and disk work runs in a thread, so the event loop is never blocked by it.
+    Errors are logged and the sweeper keeps running, the failed deletions are retried on the next passes.
+    """
+    while True:
+        try:
+            await asyncio.to_thread(run_file_deletion_sweep)
+        except Exception as e:
+            print(f"Error sweeping pending file deletions: {e}")
+
+        await asyncio.sleep(FILE_DELETION_SWEEP_INTERVAL)
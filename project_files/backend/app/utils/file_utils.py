@@ -7,6 +7,9 @@ from datetime import datetime
 
 from .encrypt_utils import encrypt_file
 
+# Root folder of the uploaded files, with a folder per user and per record
+UPLOADS_DIR = "uploads"
+
 async def validate_file(file: UploadFile) -> bytes:
     """ Validate uploaded file by checking its MIME type and size.
     
@@ -93,7 +96,7 @@ def save_file(content: bytes, record_id: uuid.UUID, user_id: uuid.UUID, file_id:
     
     secure_name = f"{record_id}_{upload_time}_{file_id}{file_extension}"
     
-    upload_dir = Path("uploads") / str(user_id) / str(record_id)
+    upload_dir = Path(UPLOADS_DIR) / str(user_id) / str(record_id)
     upload_dir.mkdir(parents=True, exist_ok=True) # create directory if it doesn't exist, parents=True creates parent directories if needed and exist_ok=True doesn't raise an error if the directory already exists
     
     file_path = upload_dir / secure_name
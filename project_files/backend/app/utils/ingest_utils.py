@@ -0,0 +1,300 @@
+from sqlmodel import Session
+from sqlalchemy import insert
+from pydantic import ValidationError
+from datetime import datetime
+from collections import deque
+import asyncio
+import csv
+import json
+import uuid
+
+from ..models import HealthData, HealthDataType, SimpleHealthDataCreate, BloodPressureCreate, HealthDataBulkError
+from .lookup_cache import lookup_cache
+
+# Content types accepted by the bulk ingestion endpoint
+CSV_CONTENT_TYPES = ["text/csv"]
+NDJSON_CONTENT_TYPES = ["application/x-ndjson", "application/ndjson", "application/jsonl"]
+
+# Number of readings inserted in a single transaction
+INGEST_BATCH_SIZE = 500
+
+# Maximum number of readings and body size accepted in a single upload
+INGEST_MAX_ROWS = 10000
+INGEST_MAX_BYTES = 5 * 1024 * 1024
+
+class UploadTooLargeError(Exception):
+    """
+    Raised when a streamed upload goes over INGEST_MAX_BYTES.
+    """
+
+def decode_line(line: bytes) -> str | None:
+    """
+    Decode a line of the body as UTF-8, skipping the byte order mark of the first line.
+
+    Returns:
+        str | None: The line without its carriage return, or None if it is not valid UTF-8
+    """
+    try:
+        return line.decode("utf-8-sig").removesuffix("\r")
+    except UnicodeDecodeError:
+        return None
+
+async def iter_lines(stream):
+    """
+    Split a streamed request body into lines without reading the whole body in memory.
+
+    Args:
+        stream: Async iterator of byte chunks, e.g. request.stream()
+
+    Returns:
+        Async generator of the decoded lines of the body, including the empty ones, with None for the lines that are not valid UTF-8
+
+    Raises:
+        UploadTooLargeError: If the body is bigger than INGEST_MAX_BYTES
+    """
+    buffer = b""
+    size = 0
+
+    async for chunk in stream:
+        size += len(chunk)
+        if size > INGEST_MAX_BYTES:
+            raise UploadTooLargeError(f"Body is bigger than {INGEST_MAX_BYTES} bytes")
+
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield decode_line(line)
+
+    if buffer:
+        yield decode_line(buffer)
+
+class LineFeed:
+    """
+    Iterator of the lines given to a csv.reader, filled as the body is streamed.
+
+    The reader is only advanced once a whole record has been fed, so it never runs out of lines in the
+    middle of a record and can be reused for the whole body.
+    """
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def iter_records(lines, content_type: str):
+    """
+    Parse the lines of a CSV or NDJSON body into one dictionary per reading.
+
+    CSV bodies need a header line with the field names, e.g. name,value,value_systolic,value_diastolic,date_recorded,notes.
+    Empty CSV cells are left out so optional fields can be skipped. A single csv.reader parses the whole body, so quoted
+    fields can span several lines, e.g. notes with line breaks, and a record is parsed once its quotes are balanced.
+    Records with a line that is not valid UTF-8 are reported as rows that could not be parsed, and an invalid header
+    leaves no field names, so every row of the body is reported. Blank lines between records are skipped.
+
+    Args:
+        lines: Async iterator of lines, from iter_lines
+        content_type: Content type of the body, used to pick the parser
+
+    Returns:
+        Async generator of (row number, record) tuples. The record is None if the line could not be parsed
+    """
+    row = 0
+
+    if content_type in CSV_CONTENT_TYPES:
+        feed = LineFeed()
+        reader = csv.reader(feed)
+        header = None
+        quotes = 0
+        invalid = False
+
+        async for line in lines:
+            if line is None:
+                invalid = True
+                line = ""
+            elif quotes % 2 == 0 and not line.strip():
+                continue
+
+            feed.lines.append(line + "\n")
+            quotes += line.count('"')
+
+            # An odd number of quotes means a quoted field goes on in the next line
+            if quotes % 2:
+                continue
+
+            values = next(reader)
+            record_invalid, quotes, invalid = invalid, 0, False
+
+            if header is None:
+                header = [] if record_invalid else [value.strip() for value in values]
+                continue
+
+            row += 1
+            if record_invalid or len(values) != len(header):
+                yield row, None
+                continue
+            yield row, {key: value.strip() for key, value in zip(header, values) if value.strip()}
+
+        # The body ended in the middle of a quoted field
+        if quotes % 2 and header is not None:
+            yield row + 1, None
+    else:
+        async for line in lines:
+            if line is not None and not line.strip():
+                continue
+            row += 1
+            try:
+                record = json.loads(line) if line is not None else None
+            except json.JSONDecodeError:
+                record = None
+            yield row, record if isinstance(record, dict) else None
+
+def validate_reading(record: dict, types: dict, user_id: uuid.UUID) -> dict:
+    """
+    Validate a reading and build the health data row to insert for it.
+
+    Readings with systolic or diastolic values are validated as blood pressure, the rest as simple readings,
+    with the same models as the single reading endpoints.
+
+    Args:
+        record: The parsed reading
+        types: Dictionary mapping the health data type names to their IDs
+        user_id: ID of the user owning the reading
+
+    Returns:
+        dict: Column values of the new health data row
+
+    Raises:
+        ValidationError: If the reading is missing fields or has invalid values
+        ValueError: If the health data type does not exist
+    """
+    if "value_systolic" in record or "value_diastolic" in record:
+        reading = BloodPressureCreate.model_validate(record)
+    else:
+        reading = SimpleHealthDataCreate.model_validate(record)
+
+    type_id = types.get(reading.name)
+    if type_id is None:
+        raise ValueError(f"Health data type '{reading.name}' not found")
+
+    return {
+        "id": uuid.uuid4(),
+        "value": getattr(reading, "value", None),
+        "value_systolic": getattr(reading, "value_systolic", None),
+        "value_diastolic": getattr(reading, "value_diastolic", None),
+        "notes": reading.notes,
+        "date_recorded": reading.date_recorded,
+        "date_added": datetime.now(),
+        "user_id": user_id,
+        "type_id": type_id,
+    }
+
+def format_validation_error(error: ValidationError) -> str:
+    """
+    Turn a pydantic validation error into a short message for the per-row error report.
+
+    Args:
+        error: The validation error
+
+    Returns:
+        str: The field and message of each error, separated by semicolons
+    """
+    return "; ".join(f"{'.'.join(str(loc) for loc in item['loc'])}: {item['msg']}" for item in error.errors())
+
+def insert_batch(rows: list, session: Session) -> int:
+    """
+    Insert a batch of health data rows in its own transaction.
+
+    Args:
+        rows: Column values of the rows to insert, from validate_reading
+        session: Database session for the insert
+
+    Returns:
+        int: The number of inserted rows
+
+    Raises:
+        Exception: If the insert fails, after rolling back the batch
+    """
+    if not rows:
+        return 0
+
+    try:
+        session.execute(insert(HealthData), rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return len(rows)
+
+async def ingest_healthdata(stream, content_type: str, user_id: uuid.UUID, session: Session) -> tuple[int, list[HealthDataBulkError]]:
+    """
+    Stream-parse a CSV or NDJSON upload of health data readings and insert them in batches.
+
+    The health data types are resolved from the lookup cache. Invalid readings are skipped and reported
+    with their row number, and each batch of valid readings is committed on its own, so a failing batch
+    does not undo the ones before it. The queries and inserts are blocking, so they run in a worker
+    thread to keep the event loop free while the body is streamed. Readings after INGEST_MAX_ROWS and
+    after the body goes over INGEST_MAX_BYTES are not imported and reported with an error, so the client
+    knows which rows were stored when the batches before them are already committed.
+
+    Args:
+        stream: Async iterator of byte chunks of the body, e.g. request.stream()
+        content_type: Content type of the body, one of CSV_CONTENT_TYPES or NDJSON_CONTENT_TYPES
+        user_id: ID of the user owning the readings
+        session: Database session for the queries
+
+    Returns:
+        tuple: The number of inserted readings and the list of per-row errors
+    """
+    types = await asyncio.to_thread(lookup_cache.names, HealthDataType, session)
+
+    inserted = 0
+    errors = []
+    batch = []
+    batch_start = 1
+    row = 0
+
+    try:
+        async for row, record in iter_records(iter_lines(stream), content_type):
+            if row > INGEST_MAX_ROWS:
+                errors.append(HealthDataBulkError(row=row, detail=f"Row limit of {INGEST_MAX_ROWS} exceeded, the remaining rows were not imported"))
+                break
+
+            if record is None:
+                errors.append(HealthDataBulkError(row=row, detail="Row could not be parsed"))
+                continue
+
+            try:
+                batch.append(validate_reading(record, types, user_id))
+            except ValidationError as e:
+                errors.append(HealthDataBulkError(row=row, detail=format_validation_error(e)))
+                continue
+            except ValueError as e:
+                errors.append(HealthDataBulkError(row=row, detail=str(e)))
+                continue
+
+            if len(batch) >= INGEST_BATCH_SIZE:
+                try:
+                    inserted += await asyncio.to_thread(insert_batch, batch, session)
+                except Exception as e:
+                    print(f"Error inserting health data batch: {e}")
+                    errors.append(HealthDataBulkError(row=batch_start, detail=f"Failed to insert rows {batch_start} to {row}"))
+                batch = []
+                batch_start = row + 1
+    except UploadTooLargeError:
+        # The rows read so far are complete, so they are still inserted and the rest is reported as one error
+        errors.append(HealthDataBulkError(row=row + 1, detail=f"Upload is bigger than {INGEST_MAX_BYTES} bytes, the remaining rows were not imported"))
+
+    try:
+        inserted += await asyncio.to_thread(insert_batch, batch, session)
+    except Exception as e:
+        print(f"Error inserting health data batch: {e}")
+        errors.append(HealthDataBulkError(row=batch_start, detail=f"Failed to insert rows from {batch_start}"))
+
+    return inserted, errors
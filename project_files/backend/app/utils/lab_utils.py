@@ -1,10 +1,17 @@
 import os
+import math
+import uuid
 import aiofiles
 from fastapi import HTTPException, status
+from sqlmodel import Session, select, col
+from sqlalchemy.dialects.postgresql import insert
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 
+from ..models import LabTest
+from .metrics import track_time
+
 load_dotenv()  # Load environment variables from .env
 
 API_KEY = os.getenv("API_KEY")
@@ -71,14 +78,15 @@ def extract_with_llm(file_content: bytes, file_type: str):
     [{"test_name":"Hemoglobină","test_code":"HGB","value":"14.3","unit":"mg/dL","reference_range":"13.2-17.3", "method":""}]
     """
     
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[prompt,
-                types.Part.from_bytes(
-                data=file_content, 
-                mime_type=file_type
-                )
-            ])
+    with track_time("llm"):
+        response = client.models.generate_content(
+            model="gemini-2.0-flash",
+            contents=[prompt,
+                    types.Part.from_bytes(
+                    data=file_content, 
+                    mime_type=file_type
+                    )
+                ])
     
     return response.text
 
@@ -98,6 +106,38 @@ def check_is_numeric(value: str) -> bool:
     except ValueError:
         return False
     
+def parse_numeric(value: str) -> float | None:
+    """
+    Parse a lab result value as a float, to be stored alongside the original string value.
+    
+    Args:
+        value: The string value to parse
+        
+    Returns:
+        float | None: The parsed value, or None if the value is not a finite number
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    
+    return number if math.isfinite(number) else None
+    
+def numeric_value_columns(value: str) -> dict:
+    """
+    Get the parsed numeric value columns of a lab result from its string value.
+    
+    Args:
+        value: The string value of the lab result
+        
+    Returns:
+        dict: Values for the value_numeric column of LabResult, and value_parsed recording the value it was parsed from
+    """
+    return {
+        "value_numeric": parse_numeric(value),
+        "value_parsed": value,
+    }
+    
 def sort_by_date(results: list):
     """
     Sort a list of results by their collection date in descending order.
@@ -108,4 +148,94 @@ def sort_by_date(results: list):
     Returns:
         list: The sorted list with most recent results first
     """
-    return sorted(results, key=lambda x: x.date_collection, reverse=True)
\ No newline at end of file
+    return sorted(results, key=lambda x: x.date_collection, reverse=True)
+    
+def get_or_create_lab_tests(lab_items: list, session: Session) -> dict:
+    """
+    Resolve the names of extracted lab tests to LabTest IDs, creating any missing tests.
+    
+    All names are looked up with a single IN query, and the missing ones are created with
+    a single INSERT ... ON CONFLICT DO NOTHING statement backed by the unique index on
+    LabTest.name, so two uploads containing the same new test cannot create duplicates.
+    
+    Args:
+        lab_items: List of LabResultCreate objects containing the name and code of each test
+        session: Database session used for the queries
+        
+    Returns:
+        dict: Mapping of lab test name to LabTest ID
+    """
+    # Keep the first code seen for every name, in case the same test appears twice in the document
+    codes = {}
+    for item in lab_items:
+        codes.setdefault(item.name, item.code)
+        
+    test_ids = dict(session.exec(select(LabTest.name, LabTest.id).where(col(LabTest.name).in_(list(codes)))).all())
+    
+    missing = [name for name in codes if name not in test_ids]
+    if missing:
+        inserted = session.execute(
+            insert(LabTest)
+            .values([{"id": uuid.uuid4(), "name": name, "code": codes[name]} for name in missing])
+            .on_conflict_do_nothing(index_elements=["name"])
+            .returning(LabTest.name, LabTest.id)
+        ).all()
+        test_ids.update(inserted)
+        
+        # Rows created by a concurrent request are skipped by ON CONFLICT DO NOTHING and not returned, so fetch them separately
+        missing = [name for name in missing if name not in test_ids]
+        if missing:
+            test_ids.update(session.exec(select(LabTest.name, LabTest.id).where(col(LabTest.name).in_(missing))).all())
+            
+    return test_ids
+    
+def downsample_lttb(x: list[float], y: list[float], threshold: int) -> list[int]:
+    """
+    Downsample a series using the Largest-Triangle-Three-Buckets algorithm.
+    
+    The first and last points are always kept. The points in between are split into
+    threshold - 2 buckets, and from each bucket the point forming the largest triangle
+    with the previously kept point and the average of the next bucket is kept. This
+    preserves the peaks and troughs of the series, which matter most when graphing lab values.
+    
+    Args:
+        x: X coordinates of the series, sorted in ascending order
+        y: Y coordinates of the series
+        threshold: Maximum number of points to keep, at least 3
+        
+    Returns:
+        list[int]: Indices of the points to keep, in ascending order
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    
+    bucket_size = (n - 2) / (threshold - 2)
+    indices = [0]
+    previous = 0
+    
+    for bucket in range(threshold - 2):
+        # Average point of the next bucket, which is just the last point for the final bucket
+        next_start = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(y[next_start:next_end]) / (next_end - next_start)
+        
+        # Pick the point of the current bucket that forms the largest triangle
+        start = int(bucket * bucket_size) + 1
+        end = min(int((bucket + 1) * bucket_size) + 1, n - 1)
+        selected = start
+        max_area = -1.0
+        for i in range(start, end):
+            area = abs((x[previous] - avg_x) * (y[i] - y[previous]) - (x[previous] - x[i]) * (avg_y - y[previous]))
+            if area > max_area:
+                max_area = area
+                selected = i
+                
+        indices.append(selected)
+        previous = selected
+        
+    indices.append(n - 1)
+    return indices
\ No newline at end of file
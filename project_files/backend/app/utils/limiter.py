@@ -1,6 +1,159 @@
+from fastapi import Request
 from slowapi.util import get_remote_address
-from slowapi import Limiter
+from slowapi.errors import RateLimitExceeded
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from dotenv import load_dotenv
+import functools
+import threading
+import asyncio
+import json
+import os
 
-# Initialising rate limiting middleware that will be used to limit the number of requests from a single IP address for each endpoint
+load_dotenv()  # Load environment variables from .env
+
+# Storage of the rate limit counters, e.g. redis://localhost:6379 to share them between workers and keep them across restarts
+# Defaults to the in-memory storage of the process, which is enough for a single worker and for tests
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+
+# Budget shared by all the routes for each user or IP address, every request spends the cost of its route
+RATE_LIMIT_BUDGET = os.getenv("RATE_LIMIT_BUDGET", "120/minute")
+
+# Cost of each class of route, from cheap cached lookups to LLM extraction and account exports
+# Can be overridden with a JSON object in RATE_LIMIT_COSTS, e.g. {"llm": 120, "read": 1}
+RATE_LIMIT_COSTS = {
+    "lookup": 1,
+    "read": 2,
+    "write": 4,
+    "dashboard": 6,
+    "bcrypt": 20,
+    "llm": 60,
+    "export": 60,
+    **json.loads(os.getenv("RATE_LIMIT_COSTS", "{}")),
+}
+
+class LimiterStats:
+    """
+    Thread-safe counters of the rate limited requests of each route.
+
+    A hit is counted once for every request to a route spending the budget, by the rate_limit decorator,
+    and a rejection for every request refused with 429 Too Many Requests. The counters are kept per process.
+    """
+
+    def __init__(self):
+        self._hits = {}
+        self._rejected = {}
+        self._lock = threading.Lock()
+
+    def hit(self, route: str):
+        with self._lock:
+            self._hits[route] = self._hits.get(route, 0) + 1
+
+    def reject(self, route: str):
+        with self._lock:
+            self._rejected[route] = self._rejected.get(route, 0) + 1
+
+    def snapshot(self) -> dict:
+        """
+        Get a copy of the counters.
+
+        Returns:
+            dict: Dictionary mapping each route to its number of hits and rejections
+        """
+        with self._lock:
+            return {
+                route: {"hits": hits, "rejected": self._rejected.get(route, 0)}
+                for route, hits in self._hits.items()
+            }
+
+limiter_stats = LimiterStats()
+
+def get_route_name(request: Request) -> str:
+    """
+    Get the path template of the route handling a request, e.g. /me/vaccines/{vaccine_id}, so the counters don't grow with every ID.
+    """
+    route = request.scope.get("route")
+    return getattr(route, "path", request.url.path)
+
+def get_rate_limit_key(request: Request) -> str:
+    """
+    Get the rate limit key of a request, the user of the session for protected routes and the IP address otherwise.
+
+    The routes spend the budget shared under the 'budget' scope, and the few routes with a limit of their
+    own are counted separately, so the key only identifies the client. slowapi calls it once for every
+    limit of a route, so it has no side effects. validate_session has already run when the limit is checked and stores the user on the request state,
+    so a user keeps the same limit across IP addresses and users behind the same IP don't share one.
+
+    Args:
+        request: The incoming request
+
+    Returns:
+        str: The key of the client, 'user:<id>' or 'ip:<address>'
+    """
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is not None:
+        return f"user:{user_id}"
+
+    return f"ip:{get_remote_address(request)}"
+
+def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    """
+    Exception handler for rejected requests, counting the rejection before building slowapi's 429 response.
+    """
+    limiter_stats.reject(get_route_name(request))
+    return _rate_limit_exceeded_handler(request, exc)
+
+def get_limiter_stats() -> dict:
+    """
+    Get the hit and rejection counters of the rate limited routes of this process.
+
+    Returns:
+        dict: Dictionary mapping each route to its number of hits and rejections
+    """
+    return limiter_stats.snapshot()
+
+# Initialising rate limiting middleware that will be used to limit the number of requests from a single user or IP address for each endpoint
+# If the shared storage is unreachable the limiter falls back to in-memory counters until it is back
 # Is in a separate file to avoid circular imports
-limiter = Limiter(key_func=get_remote_address)
\ No newline at end of file
+limiter = Limiter(
+    key_func=get_rate_limit_key,
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    in_memory_fallback_enabled=True,
+    key_prefix="medapp",
+)
+
+def rate_limit(cost_class: str):
+    """
+    Rate limit a route by the cost of its class, spending the budget shared by all the routes of the user or IP address.
+
+    With the default budget of 120/minute a user can load the cached reference tables 120 times a minute,
+    but only run two lab extractions, so expensive routes spend the budget much faster than cheap ones.
+    Each request is counted once in the limiter statistics, even if the route has other limits.
+
+    Args:
+        cost_class: Cost class of the route, one of the keys of RATE_LIMIT_COSTS
+
+    Returns:
+        The limiter decorator of the route
+
+    Raises:
+        KeyError: If the cost class is not in RATE_LIMIT_COSTS
+    """
+    limit = limiter.shared_limit(RATE_LIMIT_BUDGET, scope="budget", cost=RATE_LIMIT_COSTS[cost_class])
+
+    def decorator(func):
+        limited = limit(func)
+
+        if asyncio.iscoroutinefunction(limited):
+            @functools.wraps(limited)
+            async def counted(*args, **kwargs):
+                limiter_stats.hit(get_route_name(kwargs["request"]))
+                return await limited(*args, **kwargs)
+        else:
+            @functools.wraps(limited)
+            def counted(*args, **kwargs):
+                limiter_stats.hit(get_route_name(kwargs["request"]))
+                return limited(*args, **kwargs)
+
+        return counted
+
+    return decorator
@@ -0,0 +1,92 @@
+from fastapi import HTTPException, status
+from limits.storage import storage_from_string
+import math
+import time
+
+from ..models import ShareToken
+from .auth_utils import verify_hash
+from .limiter import RATE_LIMIT_STORAGE_URI
+
+# Storage of the failed PIN attempts and lockouts of share links, checked before bcrypt so rejected guesses never reach it
+# Uses the same storage as the rate limiter, so the lockouts are shared between workers when it is a shared server
+lockout_storage = storage_from_string(RATE_LIMIT_STORAGE_URI)
+
+# Number of failed PIN attempts allowed for a share link within the failure window before it is locked
+LOCKOUT_THRESHOLD = 5
+LOCKOUT_FAILURE_WINDOW = 15 * 60
+
+# Lockout duration in seconds, doubled for every failed attempt after the threshold up to the maximum
+LOCKOUT_BASE_SECONDS = 30
+LOCKOUT_MAX_SECONDS = 60 * 60
+
+def check_share_lockout(share_code: str):
+    """
+    Check whether a share link is locked because of too many failed PIN attempts.
+
+    Args:
+        share_code: The unique code of the share token
+
+    Raises:
+        HTTPException: 429 TOO MANY REQUESTS with a Retry-After header if the share link is locked
+    """
+    lock_key = f"share-lock:{share_code}"
+
+    if lockout_storage.get(lock_key):
+        retry_after = max(1, math.ceil(lockout_storage.get_expiry(lock_key) - time.time()))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed attempts, try again later",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+def record_share_failure(share_code: str):
+    """
+    Record a failed PIN attempt for a share link, locking it once the threshold is reached.
+
+    Every failure after the threshold doubles the lockout duration, up to LOCKOUT_MAX_SECONDS.
+
+    Args:
+        share_code: The unique code of the share token
+    """
+    failures = lockout_storage.incr(f"share-failures:{share_code}", LOCKOUT_FAILURE_WINDOW)
+
+    if failures >= LOCKOUT_THRESHOLD:
+        lock_seconds = min(LOCKOUT_BASE_SECONDS * 2 ** (failures - LOCKOUT_THRESHOLD), LOCKOUT_MAX_SECONDS)
+        lock_key = f"share-lock:{share_code}"
+
+        # The expiry of a key is only set when it is created, so the old lock is cleared to start the new one
+        lockout_storage.clear(lock_key)
+        lockout_storage.incr(lock_key, lock_seconds)
+
+def reset_share_failures(share_code: str):
+    """
+    Clear the failed PIN attempts of a share link after a successful attempt.
+
+    Args:
+        share_code: The unique code of the share token
+    """
+    lockout_storage.clear(f"share-failures:{share_code}")
+    lockout_storage.clear(f"share-lock:{share_code}")
+
+def verify_share_pin(share_token: ShareToken, pin: str | None):
+    """
+    Verify the PIN of a share link, with the lockout checked before any bcrypt work.
+
+    Args:
+        share_token: The share token to verify the PIN of
+        pin: The PIN provided by the client
+
+    Raises:
+        HTTPException: 429 TOO MANY REQUESTS if the share link is locked
+        HTTPException: 403 FORBIDDEN if the PIN is missing or does not match
+    """
+    check_share_lockout(share_token.share_code)
+
+    if not pin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Authorization header missing")
+
+    if not verify_hash(pin, share_token.hashed_pin):
+        record_share_failure(share_token.share_code)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid PIN")
+
+    reset_share_failures(share_token.share_code)
@@ -0,0 +1,372 @@
+from fastapi import Request, Response, status
+from sqlmodel import Session, SQLModel, select, col
+from sqlalchemy.dialects.postgresql import insert
+import argparse
+import hashlib
+import json
+import threading
+import uuid
+
+from ..models import LookupVersion, HealthDataType, Severity, Allergens, Reactions, MedicationRoute, MedicationForm, MedicalCategory, MedicalSubcategory, LabSubcategory
+from .database import engine
+from .compression import negotiate_encoding, compress, COMPRESSION_MINIMUM_SIZE, STATIC_LEVELS
+
+# Reference tables which are near-static and shared by all users, cached by name for the whole process
+LOOKUP_MODELS = [HealthDataType, Severity, Allergens, Reactions, MedicationRoute, MedicationForm, MedicalCategory, MedicalSubcategory, LabSubcategory]
+
+# Cache-Control header sent with the reference table responses, the ETag is used to revalidate them
+LOOKUP_CACHE_CONTROL = "private, max-age=300"
+
+class LookupCache:
+    """
+    Process-wide cache of the reference tables, mapping the names of their rows to the rows.
+
+    The rows are stored as plain dictionaries rather than ORM objects, so they are never attached
+    to a request's session and routers set the *_id foreign keys from them. The cache is loaded at
+    startup and a name missing from the cache falls back to the database and is added to the cache.
+
+    Each worker process has its own cache, so adding rows to a reference table bumps the version of
+    the table in the LookupVersion table, in the same transaction as the new rows. Every read of the
+    cache first compares those versions with the ones the cache was loaded at, once per database session,
+    and reloads the tables changed by another worker, so the rows are never older than the last bump.
+    Reference data seeded or edited directly in the database must bump the version of its table too,
+    with python -m app.utils.lookup_cache <table> or the statement in bump(), or the workers keep the
+    old rows until they restart. The serialized bodies are kept along with their compressed versions,
+    so they are only compressed once per version.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._rows = {}
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def load(self, session: Session | None = None):
+        """
+        Load all the reference tables into the cache.
+
+        Args:
+            session: Database session for the queries, a new one is opened if not given
+        """
+        if session is None:
+            with Session(engine) as session:
+                return self.load(session)
+
+        # The versions are read first, so rows added while loading are picked up by the next sync
+        versions = self._read_versions(session)
+        rows = {
+            model.__tablename__: {row.name: row.model_dump() for row in session.exec(select(model)).all()}
+            for model in LOOKUP_MODELS
+        }
+
+        with self._lock:
+            self._versions = versions
+            self._rows = rows
+            self._bodies = {}
+
+    def _read_versions(self, session: Session) -> dict:
+        """
+        Get the versions of the reference tables, a table without a version row is at version 0.
+        """
+        return dict(session.exec(select(LookupVersion.name, LookupVersion.version)).all())
+
+    def sync(self, session: Session):
+        """
+        Reload the reference tables changed by another worker since they were loaded, with a single query
+        on the small LookupVersion table when nothing changed.
+
+        Args:
+            session: Database session for the queries
+        """
+        versions = self._read_versions(session)
+        changed = [
+            model for model in LOOKUP_MODELS
+            if versions.get(model.__tablename__, 0) != self._versions.get(model.__tablename__, 0)
+        ]
+        if not changed:
+            return
+
+        rows = {model.__tablename__: {row.name: row.model_dump() for row in session.exec(select(model)).all()} for model in changed}
+
+        with self._lock:
+            self._rows.update(rows)
+            for model in changed:
+                self._versions[model.__tablename__] = versions.get(model.__tablename__, 0)
+                self._bodies.pop(model.__tablename__, None)
+
+    def bump(self, model: type[SQLModel], session: Session):
+        """
+        Bump the version of a reference table in the request's transaction, so the other workers reload it once it is committed.
+
+        Changes made directly in the database bump the version with the same statement:
+        INSERT INTO lookupversion (name, version) VALUES ('<table>', 1) ON CONFLICT (name) DO UPDATE SET version = lookupversion.version + 1
+
+        Args:
+            model: Table model the rows were added to or changed in
+            session: Database session of the transaction adding the rows
+        """
+        session.execute(
+            insert(LookupVersion)
+            .values(name=model.__tablename__, version=1)
+            .on_conflict_do_update(index_elements=["name"], set_={"version": LookupVersion.version + 1})
+        )
+
+    def remember(self, model: type[SQLModel], rows: list[dict]):
+        """
+        Add rows created or found outside of the cache, e.g. new allergens added by users.
+
+        Args:
+            model: Table model of the rows
+            rows: The rows as dictionaries, with at least their name and id
+        """
+        if not rows:
+            return
+
+        with self._lock:
+            table = dict(self._rows.get(model.__tablename__, {}))
+            table.update({row["name"]: row for row in rows})
+            self._rows[model.__tablename__] = table
+            self._bodies.pop(model.__tablename__, None)
+
+    def _table(self, model: type[SQLModel], session: Session) -> dict:
+        """
+        Get the cached rows of a table, loading the cache if it was not loaded at startup.
+
+        The versions are checked on the first read of each session, so a request sees the tables changed
+        by the other workers with a single small query however many lookups it does.
+        """
+        if model.__tablename__ not in self._rows:
+            self.load(session)
+        elif not session.info.get("lookup_cache_synced"):
+            self.sync(session)
+        session.info["lookup_cache_synced"] = True
+        return self._rows.get(model.__tablename__, {})
+
+    def get(self, model: type[SQLModel], name: str | None, session: Session) -> dict | None:
+        """
+        Get a row of a reference table by its name.
+
+        Args:
+            model: Table model to look up
+            name: Name of the row
+            session: Database session, used if the name is not cached
+
+        Returns:
+            dict | None: The row as a dictionary, or None if there is no row with this name
+        """
+        if name is None:
+            return None
+
+        row = self._table(model, session).get(name)
+        if row is None:
+            row_db = session.exec(select(model).where(col(model.name) == name)).first()
+            if row_db is None:
+                return None
+            row = row_db.model_dump()
+            self.remember(model, [row])
+
+        return row
+
+    def get_id(self, model: type[SQLModel], name: str | None, session: Session):
+        """
+        Get the ID of a row of a reference table by its name.
+
+        Args:
+            model: Table model to look up
+            name: Name of the row
+            session: Database session, used if the name is not cached
+
+        Returns:
+            uuid.UUID | None: The ID of the row, or None if there is no row with this name
+        """
+        row = self.get(model, name, session)
+        return row["id"] if row else None
+
+    def get_ids(self, model: type[SQLModel], names: list[str], session: Session) -> dict:
+        """
+        Get the IDs of many rows of a reference table by their names, with one query for all the names missing from the cache.
+
+        Args:
+            model: Table model to look up
+            names: Names of the rows
+            session: Database session, used if some names are not cached
+
+        Returns:
+            dict: Dictionary mapping the names that exist to their IDs
+        """
+        table = self._table(model, session)
+        missing = [name for name in set(names) if name not in table]
+
+        if missing:
+            rows = [row.model_dump() for row in session.exec(select(model).where(col(model.name).in_(missing))).all()]
+            self.remember(model, rows)
+            table = self._rows.get(model.__tablename__, {})
+
+        return {name: table[name]["id"] for name in names if name in table}
+
+    def get_or_create_ids(self, model: type[SQLModel], names: list[str], session: Session) -> dict:
+        """
+        Get the IDs of many rows of a reference table by their names, creating the rows that don't exist.
+
+        The names missing from the cache are looked up with a single IN query, and the ones missing from
+        the database are created with a single INSERT ... ON CONFLICT DO NOTHING statement backed by the
+        unique index on the name, so concurrent requests with the same new name cannot create duplicates.
+        The new rows are part of the request's transaction, so they are not added to the cache here and
+        the caller adds them with remember() once the transaction is committed. The version of the table
+        is bumped in the same transaction, so the other workers reload it.
+
+        Args:
+            model: Table model to look up, which needs a unique index on its name
+            names: Names of the rows
+            session: Database session for the queries and the insert
+
+        Returns:
+            dict: Dictionary mapping every name to its ID, in the order of the names
+        """
+        ids = self.get_ids(model, names, session)
+
+        missing = list(dict.fromkeys(name for name in names if name not in ids))
+        if missing:
+            inserted = session.execute(
+                insert(model)
+                .values([{"id": uuid.uuid4(), "name": name} for name in missing])
+                .on_conflict_do_nothing(index_elements=["name"])
+                .returning(model.name, model.id)
+            ).all()
+            ids.update(inserted)
+            if inserted:
+                self.bump(model, session)
+
+            # Rows created by a concurrent request are skipped by ON CONFLICT DO NOTHING and not returned, so fetch them separately
+            missing = [name for name in missing if name not in ids]
+            if missing:
+                ids.update(session.exec(select(model.name, model.id).where(col(model.name).in_(missing))).all())
+
+        return {name: ids[name] for name in names if name in ids}
+
+    def names(self, model: type[SQLModel], session: Session) -> dict:
+        """
+        Get the IDs of all the rows of a reference table.
+
+        Args:
+            model: Table model to look up
+            session: Database session, used if the cache is not loaded
+
+        Returns:
+            dict: Dictionary mapping the names of the rows to their IDs
+        """
+        return {name: row["id"] for name, row in self._table(model, session).items()}
+
+    def all(self, model: type[SQLModel], session: Session) -> list[dict]:
+        """
+        Get all the rows of a reference table.
+
+        Args:
+            model: Table model to look up
+            session: Database session, used if the cache is not loaded
+
+        Returns:
+            list[dict]: The rows as dictionaries, in the order they were loaded from the database
+        """
+        return list(self._table(model, session).values())
+
+    def body(self, model: type[SQLModel], response_model: type[SQLModel], session: Session) -> tuple[bytes, str]:
+        """
+        Get the serialized JSON list of a reference table and its ETag, computed once per table version.
+
+        Args:
+            model: Table model to serialize
+            response_model: Response model used to pick the fields of each row
+            session: Database session, used to check the table versions and if the cache is not loaded
+
+        Returns:
+            tuple: The JSON body and its ETag, a hash of the body and the table version
+        """
+        table = self._table(model, session)
+        cached = self._bodies.get(model.__tablename__)
+        if cached is None:
+            items = [response_model.model_validate(row).model_dump(mode="json") for row in table.values()]
+            body = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            etag = f'"{self._versions.get(model.__tablename__, 0)}-{hashlib.sha256(body).hexdigest()[:32]}"'
+            cached = (body, etag)
+            with self._lock:
+                self._bodies[model.__tablename__] = cached
+
+        return cached
+
+    def encoded_body(self, model: type[SQLModel], response_model: type[SQLModel], session: Session, encoding: str) -> bytes:
+        """
+        Get the serialized JSON list of a reference table compressed with an encoding, compressed once per table version.
+
+        Args:
+            model: Table model to serialize
+            response_model: Response model used to pick the fields of each row
+            session: Database session, used if the cache is not loaded
+            encoding: One of the compression encodings
+
+        Returns:
+            bytes: The compressed JSON body
+        """
+        body, _ = self.body(model, response_model, session)
+        key = (model.__tablename__, encoding)
+
+        encoded = self._bodies.get(key)
+        if encoded is None or encoded[0] is not body:
+            # Keyed to the uncompressed body, so a body rebuilt after a change is compressed again
+            encoded = (body, compress(body, encoding, STATIC_LEVELS[encoding]))
+            with self._lock:
+                self._bodies[key] = encoded
+
+        return encoded[1]
+
+# Shared cache instance used by all routers
+lookup_cache = LookupCache()
+
+def lookup_response(request: Request, model: type[SQLModel], response_model: type[SQLModel], session: Session) -> Response:
+    """
+    Build the response of a reference table endpoint from the lookup cache.
+
+    The tables changed by another worker are reloaded first. The response has an ETag and a
+    Cache-Control header, and a request with a matching If-None-Match header gets an empty 304
+    Not Modified response. The body is sent pre-compressed with the encoding accepted by the
+    client, so the compression middleware leaves it untouched.
+
+    Args:
+        request: The incoming request, used to read the If-None-Match and Accept-Encoding headers
+        model: Table model to return
+        response_model: Response model used to pick the fields of each row
+        session: Database session, used to check the table versions and if the cache is not loaded
+
+    Returns:
+        Response: The JSON list of the rows, or an empty 304 response
+    """
+    body, etag = lookup_cache.body(model, response_model, session)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", "")) if len(body) >= COMPRESSION_MINIMUM_SIZE else None
+    headers = {"Cache-Control": LOOKUP_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+
+    # Each encoding of the body has its own strong ETag
+    if encoding is not None:
+        etag = f'{etag[:-1]}-{encoding}"'
+        headers["Content-Encoding"] = encoding
+        body = lookup_cache.encoded_body(model, response_model, session, encoding)
+    headers["ETag"] = etag
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+if __name__ == "__main__":
+    # Command line tool, run from the backend folder after seeding or editing reference data with: python -m app.utils.lookup_cache <table> [<table> ...]
+    models = {model.__tablename__: model for model in LOOKUP_MODELS}
+    parser = argparse.ArgumentParser(description="Bump the lookup cache version of reference tables changed in the database, so every worker reloads them")
+    parser.add_argument("tables", nargs="+", choices=list(models), help="reference tables to reload")
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        for table in args.tables:
+            lookup_cache.bump(models[table], session)
+        session.commit()
+    print(f"Bumped the lookup cache version of {', '.join(args.tables)}")
@@ -0,0 +1,254 @@
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+import threading
+import bisect
+import time
+import os
+
+from .limiter import get_limiter_stats
+
+load_dotenv()  # Load environment variables from .env
+
+# Add a Server-Timing header with the database, bcrypt and LLM time of each request, shown by the browser dev tools
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "false").lower() == "true"
+
+# Bearer token required to read /metrics, the endpoint answers 404 if it is not set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Upper bounds of the histogram buckets, for durations in seconds and for the number of queries of a request
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+# Route label of the requests that did not match any route, so unknown paths don't create new series
+UNMATCHED_ROUTE = "unmatched"
+
+class RequestMetrics:
+    """
+    Counters of the work done by a single request, shared with the threads the request runs code in.
+    """
+    __slots__ = ("db_queries", "db_seconds", "bcrypt_seconds", "llm_seconds", "file_bytes")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self.llm_seconds = 0.0
+        self.file_bytes = 0
+
+# Metrics of the request being handled, set by the middleware and copied into the threads of sync endpoints
+current_request_metrics: ContextVar[RequestMetrics | None] = ContextVar("current_request_metrics", default=None)
+
+class Histogram:
+    """
+    Prometheus histogram with one series per set of label values.
+    """
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...], buckets: tuple):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label_values, list(counts), count, total) for label_values, (counts, count, total) in self._series.items()]
+
+        for label_values, counts, count, total in sorted(series):
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (str(bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Counter:
+    """
+    Prometheus counter with one series per set of label values.
+    """
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, *label_values: str):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + value
+
+    def set_all(self, series: dict):
+        """
+        Replace every series, for counters kept elsewhere like the rate limiter statistics.
+        """
+        with self._lock:
+            self._series = dict(series)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        lines.extend(f"{self.name}{format_labels(self.labels, label_values)} {value}" for label_values, value in series)
+        return lines
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    """
+    Format the labels of a series, e.g. {route="/me",method="GET"}, escaping the values.
+    """
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+# Metrics of the whole process, exposed by the /metrics endpoint
+REQUEST_DURATION = Histogram("medapp_request_duration_seconds", "Time spent handling requests, until the last byte of the body is sent.", ("route", "method", "status"), DURATION_BUCKETS)
+REQUEST_DB_QUERIES = Histogram("medapp_request_db_queries", "Number of database queries run by a request.", ("route",), QUERY_COUNT_BUCKETS)
+REQUEST_DB_DURATION = Histogram("medapp_request_db_duration_seconds", "Time spent running database queries per request.", ("route",), DURATION_BUCKETS)
+DB_QUERIES = Counter("medapp_db_queries_total", "Database queries run, including the ones of background tasks.")
+DB_SECONDS = Counter("medapp_db_duration_seconds_total", "Time spent running database queries, including the ones of background tasks.")
+BCRYPT_SECONDS = Counter("medapp_bcrypt_duration_seconds_total", "Time spent hashing and verifying passwords.", ("route",))
+LLM_SECONDS = Counter("medapp_llm_duration_seconds_total", "Time spent waiting for the LLM extraction of lab results.", ("route",))
+FILE_BYTES = Counter("medapp_file_bytes_streamed_total", "Bytes of decrypted documents streamed to clients.", ("route",))
+RATE_LIMIT_HITS = Counter("medapp_rate_limit_hits_total", "Requests checked by the rate limiter.", ("route",))
+RATE_LIMIT_REJECTIONS = Counter("medapp_rate_limit_rejections_total", "Requests rejected by the rate limiter.", ("route",))
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start
+    DB_QUERIES.inc()
+    DB_SECONDS.inc(elapsed)
+
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.db_queries += 1
+        metrics.db_seconds += elapsed
+
+def instrument_engine(engine: Engine):
+    """
+    Time every query run by an engine, counting them for the whole process and for the current request.
+    """
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+@contextmanager
+def track_time(kind: str):
+    """
+    Time a block of slow work done by a request, e.g. with track_time("bcrypt"): ...
+
+    Args:
+        kind: Kind of work, 'bcrypt' or 'llm'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_request_metrics.get()
+        if metrics is not None:
+            setattr(metrics, f"{kind}_seconds", getattr(metrics, f"{kind}_seconds") + time.perf_counter() - start)
+
+def record_file_bytes(count: int):
+    """
+    Count the bytes of a document streamed by the current request.
+    """
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.file_bytes += count
+
+def server_timing(metrics: RequestMetrics, elapsed: float) -> str:
+    """
+    Build the Server-Timing header of a request, with the durations in milliseconds.
+    """
+    entries = [f'db;dur={metrics.db_seconds * 1000:.1f};desc="{metrics.db_queries} queries"']
+    if metrics.bcrypt_seconds:
+        entries.append(f"bcrypt;dur={metrics.bcrypt_seconds * 1000:.1f}")
+    if metrics.llm_seconds:
+        entries.append(f"llm;dur={metrics.llm_seconds * 1000:.1f}")
+    entries.append(f"app;dur={elapsed * 1000:.1f}")
+    return ", ".join(entries)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, database queries and slow work of every request by route.
+
+    The metrics of the request are kept in a context variable, which is copied into the threads that
+    run sync endpoints and streamed bodies, so the SQLAlchemy events and the timers can find them.
+    The route label is the path template of the matched route, e.g. /vaccines/{vaccine_id}.
+    """
+
+    def __init__(self, app: ASGIApp, server_timing: bool = METRICS_SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = current_request_metrics.set(metrics)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_metrics(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    MutableHeaders(raw=message["headers"]).append("Server-Timing", server_timing(metrics, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_request_metrics.reset(token)
+            route = scope["route"].path if "route" in scope else UNMATCHED_ROUTE
+            REQUEST_DURATION.observe(time.perf_counter() - start, route, scope["method"], str(status_code))
+            REQUEST_DB_QUERIES.observe(metrics.db_queries, route)
+            REQUEST_DB_DURATION.observe(metrics.db_seconds, route)
+            if metrics.bcrypt_seconds:
+                BCRYPT_SECONDS.inc(metrics.bcrypt_seconds, route)
+            if metrics.llm_seconds:
+                LLM_SECONDS.inc(metrics.llm_seconds, route)
+            if metrics.file_bytes:
+                FILE_BYTES.inc(metrics.file_bytes, route)
+
+def render_metrics() -> str:
+    """
+    Render the metrics of this process in the Prometheus text format, along with the rate limiter statistics.
+
+    Returns:
+        str: The metrics, one sample per line
+    """
+    limiter_stats = get_limiter_stats()
+    RATE_LIMIT_HITS.set_all({(route,): stats["hits"] for route, stats in limiter_stats.items()})
+    RATE_LIMIT_REJECTIONS.set_all({(route,): stats["rejected"] for route, stats in limiter_stats.items()})
+
+    lines = []
+    for metric in (REQUEST_DURATION, REQUEST_DB_QUERIES, REQUEST_DB_DURATION, DB_QUERIES, DB_SECONDS, BCRYPT_SECONDS, LLM_SECONDS, FILE_BYTES, RATE_LIMIT_HITS, RATE_LIMIT_REJECTIONS):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
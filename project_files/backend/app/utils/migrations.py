@@ -0,0 +1,235 @@
+from sqlmodel import select
+from sqlalchemy import text, update, bindparam
+
+from ..models import LabResult, HealthDataType
+from .database import engine
+from .lab_utils import numeric_value_columns
+from .range_utils import lab_range_columns, healthdata_range_columns
+
+def cascade_foreign_key(table: str, column: str, referenced_table: str) -> str:
+    """
+    Build a statement recreating a foreign key with ON DELETE CASCADE, if it was created without it.
+    
+    The constraint keeps the default PostgreSQL name, and pg_constraint is checked first so the
+    constraint is only rebuilt and validated once.
+    
+    Args:
+        table: Table holding the foreign key
+        column: Column of the foreign key
+        referenced_table: Table referenced by the foreign key, by its id column
+        
+    Returns:
+        str: The statement to run
+    """
+    constraint = f"{table}_{column}_fkey"
+    return (
+        f"DO $$ BEGIN "
+        f"IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{constraint}' AND confdeltype <> 'c') THEN "
+        f'ALTER TABLE "{table}" DROP CONSTRAINT {constraint}, '
+        f'ADD CONSTRAINT {constraint} FOREIGN KEY ({column}) REFERENCES "{referenced_table}" (id) ON DELETE CASCADE; '
+        f"END IF; END $$"
+    )
+
+def merge_duplicate_names(table: str, references: list[tuple[str, str, str | None]]) -> list[str]:
+    """
+    Build the statements merging the rows of a reference table that share a name into a single row.
+    
+    The row with the lowest ID is kept for each name, the references to the other rows are moved to it
+    and the other rows are deleted, so a unique index can be created on the name. Link tables have the
+    reference in their primary key, so their rows are copied to the kept row, skipping the links that
+    already exist, and the old links are deleted. The statements do nothing once the names are unique.
+    
+    Args:
+        table: Reference table with a name column
+        references: Tables referencing it, as (table, column, other primary key column of a link table or None)
+        
+    Returns:
+        list[str]: The statements to run, in order
+    """
+    duplicates = (
+        f"WITH duplicate AS (SELECT id, keep_id FROM ("
+        f'SELECT id, first_value(id) OVER (PARTITION BY name ORDER BY id) AS keep_id FROM "{table}"'
+        f") ranked WHERE id <> keep_id) "
+    )
+    
+    statements = []
+    for referencing_table, column, link_column in references:
+        if link_column is None:
+            statements.append(
+                duplicates + f'UPDATE "{referencing_table}" SET {column} = duplicate.keep_id FROM duplicate WHERE "{referencing_table}".{column} = duplicate.id'
+            )
+        else:
+            statements.append(
+                duplicates + f'INSERT INTO "{referencing_table}" ({link_column}, {column}) '
+                f'SELECT DISTINCT link.{link_column}, duplicate.keep_id FROM "{referencing_table}" link JOIN duplicate ON link.{column} = duplicate.id '
+                f"ON CONFLICT DO NOTHING"
+            )
+            statements.append(
+                duplicates + f'DELETE FROM "{referencing_table}" link USING duplicate WHERE link.{column} = duplicate.id'
+            )
+    
+    statements.append(duplicates + f'DELETE FROM "{table}" target USING duplicate WHERE target.id = duplicate.id')
+    return statements
+
+# Foreign keys to the user and to the records owned by the user, which delete the rows with them
+CASCADE_FOREIGN_KEYS = [
+    ("vaccine", "user_id", "user"),
+    ("allergy", "user_id", "user"),
+    ("allergyallergenslink", "allergy_id", "allergy"),
+    ("allergyreactionslink", "allergy_id", "allergy"),
+    ("medication", "user_id", "user"),
+    ("healthdata", "user_id", "user"),
+    ("medicalhistory", "user_id", "user"),
+    ("labresult", "user_id", "user"),
+    ("labresult", "medicalhistory_id", "medicalhistory"),
+    ("sharetoken", "user_id", "user"),
+]
+
+# create_all only creates tables that don't exist yet, so columns and indexes added to existing tables
+# after the first deployment are applied here. Every statement must be idempotent, as they are run on each startup.
+SCHEMA_UPDATES = [
+    # Unique index on the lab test name, needed by the INSERT ... ON CONFLICT upsert used when creating lab tests
+    # Lab tests created twice with the same name before the index existed are merged first
+    *merge_duplicate_names("labtest", [("labresult", "test_id", None)]),
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_labtest_name ON labtest (name)",
+    # Composite index for fetching a user's lab results ordered by collection date
+    "CREATE INDEX IF NOT EXISTS ix_labresult_user_id_date_collection ON labresult (user_id, date_collection)",
+    # Numeric lab result values, used for graphing lab results over time
+    "ALTER TABLE labresult ADD COLUMN IF NOT EXISTS value_numeric DOUBLE PRECISION",
+    # Value the numeric value was parsed from, so the values that aren't finite numbers are only parsed once
+    "ALTER TABLE labresult ADD COLUMN IF NOT EXISTS value_parsed VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_labresult_user_id_test_id_date_collection ON labresult (user_id, test_id, date_collection)",
+    # Numeric bounds parsed from the free-text reference ranges of lab results and health data types
+    "ALTER TABLE labresult ADD COLUMN IF NOT EXISTS reference_low DOUBLE PRECISION",
+    "ALTER TABLE labresult ADD COLUMN IF NOT EXISTS reference_high DOUBLE PRECISION",
+    "ALTER TABLE healthdatatype ADD COLUMN IF NOT EXISTS normal_low DOUBLE PRECISION",
+    "ALTER TABLE healthdatatype ADD COLUMN IF NOT EXISTS normal_high DOUBLE PRECISION",
+    "ALTER TABLE healthdatatype ADD COLUMN IF NOT EXISTS normal_low_diastolic DOUBLE PRECISION",
+    "ALTER TABLE healthdatatype ADD COLUMN IF NOT EXISTS normal_high_diastolic DOUBLE PRECISION",
+    # Range strings the bounds were parsed from, so only the new and changed ranges are parsed again
+    "ALTER TABLE labresult ADD COLUMN IF NOT EXISTS reference_range_parsed VARCHAR",
+    "ALTER TABLE healthdatatype ADD COLUMN IF NOT EXISTS normal_range_parsed VARCHAR",
+    # Indexes for finding out of range lab results and health data over a date window
+    "CREATE INDEX IF NOT EXISTS ix_labresult_out_of_range ON labresult (user_id, date_collection) WHERE value_numeric < reference_low OR value_numeric > reference_high",
+    "CREATE INDEX IF NOT EXISTS ix_healthdata_user_id_date_recorded ON healthdata (user_id, date_recorded)",
+    # Index for aggregating a single health data type of a user over time
+    "CREATE INDEX IF NOT EXISTS ix_healthdata_user_id_type_id_date_recorded ON healthdata (user_id, type_id, date_recorded)",
+    # Unique indexes on the allergen and reaction names, needed by the INSERT ... ON CONFLICT used when creating allergies
+    *merge_duplicate_names("allergens", [("allergyallergenslink", "allergen_id", "allergy_id")]),
+    *merge_duplicate_names("reactions", [("allergyreactionslink", "reaction_id", "allergy_id")]),
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_allergens_name ON allergens (name)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_reactions_name ON reactions (name)",
+    # Compressed snapshot of the shared items of a share link
+    "ALTER TABLE sharetoken ADD COLUMN IF NOT EXISTS snapshot BYTEA",
+    # Directory removals in the file deletion outbox, used when deleting an account
+    "ALTER TABLE pendingfiledeletion ADD COLUMN IF NOT EXISTS is_directory BOOLEAN NOT NULL DEFAULT FALSE",
+    # ON DELETE CASCADE on the foreign keys of the user's records, so deleting an account is done by the database
+    *[cascade_foreign_key(table, column, referenced_table) for table, column, referenced_table in CASCADE_FOREIGN_KEYS],
+]
+
+def backfill_lab_numeric_values(connection):
+    """
+    Fill in value_numeric for numeric lab results created before the column existed.
+    
+    value_parsed is written along with it, even for the values that can't be parsed such as nan or text
+    flagged as numeric, so every row is only parsed once per value.
+    
+    Args:
+        connection: Database connection of the migration transaction
+    """
+    table = LabResult.__table__
+    rows = connection.execute(
+        select(table.c.id, table.c.value)
+        .where(table.c.is_numeric)
+        .where(table.c.value.is_distinct_from(table.c.value_parsed))
+    ).all()
+    
+    # Bind parameters can't share the name of the columns being updated, so they are prefixed
+    values = [{"row_id": row.id, **{f"row_{column}": value for column, value in numeric_value_columns(row.value).items()}} for row in rows]
+    
+    if values:
+        connection.execute(
+            update(table).where(table.c.id == bindparam("row_id")).values(value_numeric=bindparam("row_value_numeric"), value_parsed=bindparam("row_value_parsed")),
+            values
+        )
+
+def backfill_range_columns(connection, table, range_column, source_column, parse_columns):
+    """
+    Fill in the parsed range columns of rows whose range string is different from the one their bounds were parsed from.
+    
+    This covers the rows created before the columns existed and the ranges edited directly in the database.
+    The source column is written along with the bounds, even when the range can't be parsed, so every row is
+    only parsed once per range string.
+    
+    Args:
+        connection: Database connection of the migration transaction
+        table: Table containing the range string and the parsed columns
+        range_column: Name of the column holding the range string
+        source_column: Name of the column holding the range string the bounds were parsed from
+        parse_columns: Function returning the parsed column values for a range string, including the source column
+    """
+    columns = list(parse_columns(None))
+    rows = connection.execute(
+        select(table.c.id, table.c[range_column])
+        .where(table.c[range_column].is_distinct_from(table.c[source_column]))
+    ).all()
+    
+    # Bind parameters can't share the name of the columns being updated, so they are prefixed
+    values = [{"row_id": row[0], **{f"row_{column}": value for column, value in parse_columns(row[1]).items()}} for row in rows]
+    
+    if values:
+        connection.execute(
+            update(table).where(table.c.id == bindparam("row_id")).values({column: bindparam(f"row_{column}") for column in columns}),
+            values
+        )
+        
+def backfill_lab_ranges(connection):
+    """
+    Fill in reference_low and reference_high for lab results created before the columns existed or with an unparsed range.
+    
+    Args:
+        connection: Database connection of the migration transaction
+    """
+    backfill_range_columns(connection, LabResult.__table__, "reference_range", "reference_range_parsed", lab_range_columns)
+    
+def backfill_healthdata_type_ranges(connection):
+    """
+    Fill in the normal range bounds of the health data types, which are seeded and edited directly in the database,
+    so the bounds of an edited normal range are recomputed on the next startup.
+    
+    Args:
+        connection: Database connection of the migration transaction
+    """
+    backfill_range_columns(connection, HealthDataType.__table__, "normal_range", "normal_range_parsed", healthdata_range_columns)
+
+# Data backfills for new columns, run after the schema updates. Like the schema updates, they must be safe to run on each startup.
+BACKFILLS = [
+    backfill_lab_numeric_values,
+    backfill_lab_ranges,
+    backfill_healthdata_type_ranges,
+]
+
+# Key of the PostgreSQL advisory lock taken by the migration transaction, so the workers starting together run it one at a time
+MIGRATION_LOCK_ID = 726_154_390
+
+def run_migrations():
+    """
+    Bring an existing database up to date with the current models.
+    
+    This function is called in the main app file after create_db_and_tables,
+    and applies the schema updates followed by the data backfills in a single transaction.
+    The transaction is rolled back if any of them fails, and the error is raised so the app does not start
+    without the indexes and columns the endpoints rely on.
+    
+    Every worker runs the migrations at startup, so the transaction first takes an advisory lock, which
+    is released when it ends. The other workers wait for it and then find the schema up to date, instead
+    of creating the same indexes and constraints concurrently and deadlocking.
+    """
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        
+        for statement in SCHEMA_UPDATES:
+            connection.execute(text(statement))
+            
+        for backfill in BACKFILLS:
+            backfill(connection)
@@ -0,0 +1,203 @@
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextvars import ContextVar
+from datetime import datetime
+from dotenv import load_dotenv
+from pathlib import Path
+import threading
+import asyncio
+import hmac
+import json
+import time
+import uuid
+import sys
+import os
+
+load_dotenv()  # Load environment variables from .env
+
+# Token enabling the profiler, a request sent with it in the X-Profile header is profiled. The profiler is disabled if it is not set
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN")
+
+# Folder the profiles are written to, and the interval between two stack samples in seconds
+PROFILES_DIR = os.getenv("PROFILES_DIR", "profiles")
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+
+# Frames a thread sits in while it has nothing to do, the samples ending in them are dropped
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get")}
+
+class RequestProfile:
+    """
+    Profile of a single request, with the sampled stacks of every busy thread and the SQL statements it ran.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.stacks = {}
+        self.samples = 0
+        self.statements = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """
+        Take one sample of the stacks of all the threads of the process, except the sampler thread.
+        """
+        sampler = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler:
+                continue
+
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(PROFILER_INTERVAL):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        """
+        Get the sampled stacks in the folded format read by flamegraph.pl and speedscope, one 'frame;frame;... count' line per stack.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def save(self, status_code: int, duration: float, folder: str = PROFILES_DIR) -> Path:
+        """
+        Write the folded stacks and a JSON summary with the SQL statements to the profiles folder.
+
+        The parameters of the statements are not written, as they hold the health data of the user.
+
+        Returns:
+            Path: Path of the JSON summary, the folded stacks are written next to it
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        (folder / f"{self.id}.folded").write_text(self.folded(), encoding="utf-8")
+        summary = {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": status_code,
+            "duration_ms": round(duration * 1000, 2),
+            "interval_ms": PROFILER_INTERVAL * 1000,
+            "samples": self.samples,
+            "sql_count": len(self.statements),
+            "sql_duration_ms": round(sum(statement["duration_ms"] for statement in self.statements), 2),
+            "sql": self.statements,
+            "folded": f"{self.id}.folded",
+        }
+        summary_path = folder / f"{self.id}.json"
+        summary_path.write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+        return summary_path
+
+# Profile of the request being handled, copied into the threads of sync endpoints so their queries are recorded
+current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+
+# Only one request is profiled at a time, as the sampler sees every thread of the process
+profiler_lock = threading.Lock()
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        context._profile_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.statements.append({
+            "statement": statement,
+            "duration_ms": round((time.perf_counter() - context._profile_start) * 1000, 3),
+            "thread": threading.current_thread().name,
+        })
+
+def profile_engine(engine: Engine):
+    """
+    Record the SQL statements run by an engine during the profiled requests.
+    """
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+def is_profile_requested(headers: Headers) -> bool:
+    """
+    Check if a request asks to be profiled, with the profiler token in its X-Profile header.
+    """
+    token = headers.get("x-profile")
+    return bool(PROFILER_TOKEN) and token is not None and hmac.compare_digest(token.encode(), PROFILER_TOKEN.encode())
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware running the requests sent with the profiler token under a sampling profiler.
+
+    A sampler thread records the stacks of every busy thread of the process at a fixed interval, like py-spy,
+    so the time spent in lazy loads, validation or serialization shows up without instrumenting the code. The
+    profile is written to the profiles folder as folded stacks, ready for flamegraph.pl or speedscope, and a JSON
+    summary with the SQL statements of the request, and its ID is returned in the X-Profile-Id header.
+
+    The sampler sees all the threads, so the profiled request should be sent to a quiet worker. A request asking
+    for a profile while another one is profiled runs normally, without the X-Profile-Id header.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not is_profile_requested(Headers(scope=scope)):
+            await self.app(scope, receive, send)
+            return
+
+        if not profiler_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+        status_code = 500
+
+        async def send_with_profile(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(raw=message["headers"]).append("X-Profile-Id", profile.id)
+            await send(message)
+
+        start = time.perf_counter()
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            duration = time.perf_counter() - start
+            profile.stop()
+            current_profile.reset(token)
+            profiler_lock.release()
+
+            try:
+                await asyncio.to_thread(profile.save, status_code, duration)
+            except Exception as e:
+                print(f"Error saving profile {profile.id}: {e}")
@@ -0,0 +1,107 @@
+import re
+
+# A number with an optional minus sign (e.g. base excess "-2 - 3") and either a period or a comma as the decimal separator,
+# and one or more numbers separated by slashes (e.g. blood pressure "120/80")
+NUMBER_PATTERN = r"[-−]?\d+(?:[.,]\d+)?"
+VALUES_PATTERN = rf"{NUMBER_PATTERN}(?:\s*/\s*{NUMBER_PATTERN})*"
+
+# Ranges such as "13.2-17.3", "3,5 - 5,1 mmol/L", "-2.0 – 2.0" or "90/60 - 120/80 mmHg"
+RANGE_REGEX = re.compile(rf"^\s*({VALUES_PATTERN})\s*[-–]\s*({VALUES_PATTERN})")
+# One sided ranges such as "< 5.7" or ">= 40"
+BOUND_REGEX = re.compile(rf"^\s*(<=|>=|≤|≥|<|>)\s*({VALUES_PATTERN})")
+
+def split_values(values: str) -> list[float]:
+    """
+    Split a string of one or more numbers separated by slashes into floats.
+    
+    Args:
+        values: String such as "13.2", "3,5", "-2" or "120/80"
+        
+    Returns:
+        list[float]: The parsed numbers
+    """
+    return [float(value.strip().replace(",", ".").replace("−", "-")) for value in values.split("/")]
+
+def parse_range(range_str: str | None) -> list[tuple[float | None, float | None]]:
+    """
+    Parse a free-text reference range into numeric low and high bounds.
+    
+    Compound ranges, such as blood pressure, have one pair of bounds per component, so
+    "90/60 - 120/80 mmHg" is parsed as [(90, 120), (60, 80)]. One sided ranges have
+    None as the missing bound, so "< 5.7" is parsed as [(None, 5.7)]. Bounds can be
+    negative, so "-2 - 3" is parsed as [(-2, 3)]. Any unit after the range is ignored.
+    
+    Args:
+        range_str: The reference range as written in the lab document or the health data type
+        
+    Returns:
+        list[tuple]: List of (low, high) pairs, empty if the range could not be parsed
+    """
+    if not range_str:
+        return []
+    
+    match = RANGE_REGEX.match(range_str)
+    if match:
+        lows = split_values(match.group(1))
+        highs = split_values(match.group(2))
+        
+        if len(lows) != len(highs):
+            return []
+        
+        return list(zip(lows, highs))
+    
+    match = BOUND_REGEX.match(range_str)
+    if match:
+        bounds = split_values(match.group(2))
+        
+        if match.group(1) in ("<", "<=", "≤"):
+            return [(None, bound) for bound in bounds]
+        return [(bound, None) for bound in bounds]
+    
+    return []
+
+def lab_range_columns(range_str: str | None) -> dict:
+    """
+    Get the parsed reference range columns of a lab result from its reference range string.
+    
+    Args:
+        range_str: The reference range of the lab result
+        
+    Returns:
+        dict: Values for the reference_low and reference_high columns of LabResult, and reference_range_parsed
+              recording the range they were parsed from
+    """
+    bounds = parse_range(range_str)
+    low, high = bounds[0] if bounds else (None, None)
+    
+    return {
+        "reference_low": low,
+        "reference_high": high,
+        "reference_range_parsed": range_str,
+    }
+    
+def healthdata_range_columns(range_str: str | None) -> dict:
+    """
+    Get the parsed normal range columns of a health data type from its normal range string.
+    
+    The diastolic columns are only filled for compound types such as blood pressure,
+    the main columns hold the systolic range for those.
+    
+    Args:
+        range_str: The normal range of the health data type
+        
+    Returns:
+        dict: Values for the normal_low, normal_high, normal_low_diastolic and normal_high_diastolic columns of HealthDataType,
+              and normal_range_parsed recording the range they were parsed from
+    """
+    bounds = parse_range(range_str)
+    low, high = bounds[0] if bounds else (None, None)
+    low_diastolic, high_diastolic = bounds[1] if len(bounds) > 1 else (None, None)
+    
+    return {
+        "normal_low": low,
+        "normal_high": high,
+        "normal_low_diastolic": low_diastolic,
+        "normal_high_diastolic": high_diastolic,
+        "normal_range_parsed": range_str,
+    }
@@ -0,0 +1,265 @@
+from sqlmodel import Session, select, col
+from sqlalchemy import delete
+from datetime import datetime
+import argparse
+import asyncio
+import os
+import time
+
+from ..models import FileUpload, PendingFileDeletion
+from .database import engine
+from .file_utils import UPLOADS_DIR
+from .file_outbox import schedule_file_deletion
+
+# Number of files or rows checked against the other side with a single query, which bounds the memory used by a scan
+RECONCILE_BATCH_SIZE = 1000
+
+# Files newer than this are never reported as orphans, as their upload may still be committing
+RECONCILE_GRACE_SECONDS = 60 * 60
+
+# Seconds between two runs of the periodic reconciliation job
+RECONCILE_INTERVAL = 6 * 60 * 60
+
+def iter_upload_files(root: str = UPLOADS_DIR):
+    """
+    Walk the uploads folder with os.scandir, without listing the whole tree in memory.
+
+    Args:
+        root: Folder to walk
+
+    Returns:
+        Generator of os.DirEntry objects of the files in the folder and its subfolders
+    """
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+def iter_batches(items, size: int = RECONCILE_BATCH_SIZE):
+    """
+    Group the items of an iterator into lists of at most size items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def stored_path(path: str, root: str = UPLOADS_DIR) -> str:
+    """
+    Get the path of a file under the scanned folder as it is stored in FileUpload.file_path.
+
+    The rows store the paths relative to the backend folder, e.g. uploads/<user>/<record>/<file>, so the
+    path is made relative to the scanned folder and joined to UPLOADS_DIR. This way the scan matches the
+    rows whether the folder is given as an absolute path or the tool is run from another folder.
+    """
+    return os.path.normpath(os.path.join(UPLOADS_DIR, os.path.relpath(path, root)))
+
+def find_orphan_files(session: Session, grace_seconds: int = RECONCILE_GRACE_SECONDS, root: str = UPLOADS_DIR):
+    """
+    Find the files on disk that have no FileUpload row and are not already pending deletion.
+
+    The orphans are returned with their path as stored in the rows, which is also the path the file outbox
+    deletes them from.
+
+    Args:
+        session: Database session for the queries
+        grace_seconds: Files modified more recently than this are skipped
+        root: Uploads folder to scan
+
+    Returns:
+        Generator of (orphans, scanned, matched) tuples, one per batch of scanned files, the orphans being (file path, size in bytes)
+        tuples and matched the number of files of the batch with a row
+    """
+    cutoff = time.time() - grace_seconds
+
+    for batch in iter_batches(iter_upload_files(root)):
+        paths = {stored_path(entry.path, root): entry for entry in batch}
+
+        known = set(session.exec(select(FileUpload.file_path).where(col(FileUpload.file_path).in_(list(paths)))).all())
+        known.update(session.exec(select(PendingFileDeletion.file_path).where(col(PendingFileDeletion.file_path).in_(list(paths)))).all())
+        known = {os.path.normpath(path) for path in known}
+        matched = len(known & paths.keys())
+
+        orphans = []
+        for path, entry in paths.items():
+            if path in known:
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime < cutoff:
+                orphans.append((path, stat.st_size))
+
+        yield orphans, len(batch), matched
+
+def find_missing_files(session: Session, root: str = UPLOADS_DIR):
+    """
+    Find the FileUpload rows whose file is missing from disk, streaming the rows from the database.
+
+    Args:
+        session: Database session for the queries
+        root: Uploads folder the stored paths are looked up in
+
+    Returns:
+        Generator of (missing, scanned) tuples, one per batch of rows, the missing files being (file id, file path) tuples
+    """
+    rows = session.exec(
+        select(FileUpload.id, FileUpload.file_path).execution_options(yield_per=RECONCILE_BATCH_SIZE)
+    )
+
+    for batch in iter_batches(rows):
+        yield [
+            (file_id, file_path) for file_id, file_path in batch
+            if not os.path.exists(os.path.join(root, os.path.relpath(file_path, UPLOADS_DIR)))
+        ], len(batch)
+
+def reconcile_uploads(
+    session: Session,
+    reclaim_orphans: bool = False,
+    reclaim_missing: bool = False,
+    grace_seconds: int = RECONCILE_GRACE_SECONDS,
+    root: str = UPLOADS_DIR,
+    verbose: bool = False,
+) -> dict:
+    """
+    Reconcile the uploads folder with the FileUpload rows, reporting and optionally reclaiming the differences.
+
+    Orphan files are files on disk without a row, e.g. from an upload whose commit failed or a user deleted with
+    all their records. They are reclaimed by scheduling their deletion through the file outbox. Missing files are
+    rows whose file is gone from disk, they are reclaimed by deleting the rows so the records don't link to them.
+    Both sides are checked in batches of RECONCILE_BATCH_SIZE, so memory use does not grow with the number of files.
+    A batch of files where none has a row is more likely a wrong root than lost rows, so its orphans are only reported.
+
+    Args:
+        session: Database session for the queries
+        reclaim_orphans: Schedule the deletion of the orphan files
+        reclaim_missing: Delete the rows of the missing files
+        grace_seconds: Files modified more recently than this are never reported as orphans
+        root: Uploads folder to scan
+        verbose: Print every orphan and missing file
+
+    Returns:
+        dict: Statistics of the scan, the number of scanned files and rows, the orphan and missing files found
+              and reclaimed, the orphan bytes, the batches not reclaimed and the elapsed time and throughput
+    """
+    start = time.perf_counter()
+    stats = {
+        "files_scanned": 0,
+        "rows_scanned": 0,
+        "orphan_files": 0,
+        "orphan_bytes": 0,
+        "orphans_reclaimed": 0,
+        "batches_skipped": 0,
+        "missing_files": 0,
+        "missing_reclaimed": 0,
+    }
+
+    for orphans, scanned, matched in find_orphan_files(session, grace_seconds, root):
+        stats["files_scanned"] += scanned
+        stats["orphan_files"] += len(orphans)
+        stats["orphan_bytes"] += sum(size for _, size in orphans)
+
+        reclaim_batch = reclaim_orphans and bool(orphans)
+        if reclaim_batch and matched == 0:
+            print(f"Not reclaiming {len(orphans)} orphan files, none of the {scanned} files of the batch has a FileUpload row")
+            stats["batches_skipped"] += 1
+            reclaim_batch = False
+
+        for path, size in orphans:
+            if verbose:
+                print(f"Orphan file: {path} ({size} bytes)")
+            if reclaim_batch:
+                schedule_file_deletion(path, session)
+
+        if reclaim_batch:
+            session.commit()
+            stats["orphans_reclaimed"] += len(orphans)
+
+    # The uploads folder missing entirely is more likely a missing mount than lost files, so no rows are deleted then
+    reclaim_missing = reclaim_missing and os.path.isdir(root)
+
+    missing_ids = []
+    for missing, scanned in find_missing_files(session, root):
+        stats["rows_scanned"] += scanned
+        stats["missing_files"] += len(missing)
+
+        for file_id, path in missing:
+            if verbose:
+                print(f"Missing file: {path} (FileUpload {file_id})")
+        if reclaim_missing:
+            missing_ids.extend(file_id for file_id, _ in missing)
+
+    # The rows are deleted after the streaming query is done, in batches
+    for batch in iter_batches(missing_ids):
+        session.execute(delete(FileUpload).where(col(FileUpload.id).in_(batch)))
+        session.commit()
+        stats["missing_reclaimed"] += len(batch)
+
+    elapsed = time.perf_counter() - start
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["files_per_second"] = round(stats["files_scanned"] / elapsed, 1) if elapsed else 0.0
+    stats["rows_per_second"] = round(stats["rows_scanned"] / elapsed, 1) if elapsed else 0.0
+
+    return stats
+
+def format_reconcile_stats(stats: dict) -> str:
+    """
+    Format the statistics of a reconciliation scan as a single line for the logs.
+    """
+    return (
+        f"Scanned {stats['files_scanned']} files and {stats['rows_scanned']} rows in {stats['elapsed_seconds']}s "
+        f"({stats['files_per_second']} files/s, {stats['rows_per_second']} rows/s): "
+        f"{stats['orphan_files']} orphan files ({stats['orphan_bytes']} bytes, {stats['orphans_reclaimed']} reclaimed, {stats['batches_skipped']} batches skipped), "
+        f"{stats['missing_files']} missing files ({stats['missing_reclaimed']} reclaimed)"
+    )
+
+def run_reconcile(**kwargs) -> dict:
+    """
+    Run a reconciliation scan with its own database session, see reconcile_uploads for the arguments.
+    """
+    with Session(engine) as session:
+        return reconcile_uploads(session, **kwargs)
+
+async def reconcile_job():
+    """
+    Background task reconciling the uploads periodically, started with the application.
+
+    The periodic job only reclaims orphan files, which is safe because of the grace period and the outbox.
+    Missing files are only reported, their rows are deleted with the command line tool after checking the disk.
+    """
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+
+        try:
+            stats = await asyncio.to_thread(run_reconcile, reclaim_orphans=True)
+            print(f"Uploads reconciliation at {datetime.now():%d-%m-%Y %H:%M:%S}: {format_reconcile_stats(stats)}")
+        except Exception as e:
+            print(f"Error reconciling uploads: {e}")
+
+if __name__ == "__main__":
+    # Command line tool, run from the backend folder with: python -m app.utils.reconcile [--reclaim-orphans] [--reclaim-missing]
+    parser = argparse.ArgumentParser(description="Reconcile the uploads folder with the FileUpload rows")
+    parser.add_argument("--reclaim-orphans", action="store_true", help="schedule the deletion of files without a FileUpload row")
+    parser.add_argument("--reclaim-missing", action="store_true", help="delete the FileUpload rows whose file is missing")
+    parser.add_argument("--grace", type=int, default=RECONCILE_GRACE_SECONDS, help="skip files modified in the last GRACE seconds")
+    parser.add_argument("--root", default=UPLOADS_DIR, help="uploads folder to scan")
+    parser.add_argument("--verbose", action="store_true", help="print every orphan and missing file")
+    args = parser.parse_args()
+
+    stats = run_reconcile(
+        reclaim_orphans=args.reclaim_orphans,
+        reclaim_missing=args.reclaim_missing,
+        grace_seconds=args.grace,
+        root=args.root,
+        verbose=args.verbose,
+    )
+    print(format_reconcile_stats(stats))
@@ -0,0 +1,273 @@
+from fastapi import Response, status
+from sqlmodel import Session, select, col
+from sqlalchemy.dialects.postgresql import array_agg
+from datetime import date
+import orjson
+import uuid
+
+from ..models import Vaccine, Allergy, Allergens, Reactions, Severity, AllergyAllergensLink, AllergyReactionsLink, Medication, MedicationRoute, MedicationForm, HealthData, HealthDataType, MedicalHistory, MedicalCategory, MedicalSubcategory, LabSubcategory, LabResult, LabTest, FileUpload
+from .vitals import healthdata_trend
+
+# The list endpoints build their rows as plain dictionaries straight from the columns of the query results,
+# in the same shape and field order as their response models, and encode them with orjson. The responses are
+# returned directly so FastAPI does not validate them again against the response model, which is kept for the docs.
+
+def format_date(value: date | None) -> str | None:
+    """
+    Format a date as dd-mm-yyyy, like the field serializers of the models, without going through strftime.
+    """
+    if value is None:
+        return None
+    return f"{value.day:02d}-{value.month:02d}-{value.year:04d}"
+
+def dumps(content) -> bytes:
+    """
+    Encode content as JSON with orjson, which handles UUIDs and datetimes natively.
+
+    Datetimes are written in ISO 8601 format, as pydantic writes them.
+    """
+    return orjson.dumps(content)
+
+def json_response(content, status_code: int = status.HTTP_200_OK) -> Response:
+    """
+    Build a JSON response from rows that are already serialized, skipping the response model validation.
+    """
+    return Response(content=dumps(content), status_code=status_code, media_type="application/json")
+
+# File flags, true if the record has an uploaded file
+vaccine_has_file = select(FileUpload.id).where(FileUpload.vaccine_id == Vaccine.id).exists()
+medicalhistory_has_file = select(FileUpload.id).where(FileUpload.medhistory_id == MedicalHistory.id).exists()
+labresult_has_file = select(FileUpload.id).where(FileUpload.medhistory_id == LabResult.medicalhistory_id).exists()
+
+def select_vaccine_rows(user_id: uuid.UUID):
+    return (
+        select(Vaccine.id, Vaccine.name, Vaccine.provider, Vaccine.date_received, Vaccine.date_added, vaccine_has_file.label("certificate"))
+        .where(Vaccine.user_id == user_id)
+        .order_by(col(Vaccine.date_added).desc())
+    )
+
+def vaccine_row(row) -> dict:
+    return {
+        "date_received": format_date(row.date_received),
+        "date_added": row.date_added,
+        "id": row.id,
+        "name": row.name,
+        "provider": row.provider,
+        "certificate": row.certificate,
+    }
+
+def select_allergy_rows(user_id: uuid.UUID, severities: list[str] | None = None):
+    allergens = (
+        select(array_agg(Allergens.name))
+        .join(AllergyAllergensLink, AllergyAllergensLink.allergen_id == Allergens.id)
+        .where(AllergyAllergensLink.allergy_id == Allergy.id)
+        .scalar_subquery()
+    )
+    reactions = (
+        select(array_agg(Reactions.name))
+        .join(AllergyReactionsLink, AllergyReactionsLink.reaction_id == Reactions.id)
+        .where(AllergyReactionsLink.allergy_id == Allergy.id)
+        .scalar_subquery()
+    )
+
+    query = (
+        select(Allergy.id, Allergy.date_diagnosed, Allergy.date_added, Allergy.notes, Severity.name.label("severity"), allergens.label("allergens"), reactions.label("reactions"))
+        .join(Severity, Allergy.severity_id == Severity.id)
+        .where(Allergy.user_id == user_id)
+        .order_by(col(Allergy.date_added).desc())
+    )
+    if severities is not None:
+        query = query.where(col(Severity.name).in_(severities))
+    return query
+
+def allergy_row(row) -> dict:
+    return {
+        "date_diagnosed": format_date(row.date_diagnosed),
+        "date_added": row.date_added,
+        "id": row.id,
+        "severity": row.severity,
+        "allergens": row.allergens or [],
+        "reactions": row.reactions or [],
+        "notes": row.notes,
+    }
+
+def select_medication_rows(user_id: uuid.UUID):
+    return (
+        select(
+            Medication.id, Medication.name, Medication.dosage, Medication.frequency, Medication.time_of_day, Medication.duration_days,
+            Medication.date_prescribed, Medication.date_added, Medication.notes,
+            MedicationRoute.name.label("route"), MedicationForm.name.label("form"),
+        )
+        .outerjoin(MedicationRoute, Medication.route_id == MedicationRoute.id)
+        .outerjoin(MedicationForm, Medication.form_id == MedicationForm.id)
+        .where(Medication.user_id == user_id)
+        .order_by(col(Medication.date_added).desc())
+    )
+
+def medication_row(row) -> dict:
+    return {
+        "date_prescribed": format_date(row.date_prescribed),
+        "date_added": row.date_added,
+        "id": row.id,
+        "name": row.name,
+        "dosage": row.dosage,
+        "frequency": row.frequency,
+        "time_of_day": row.time_of_day,
+        "duration_days": row.duration_days,
+        "route": row.route,
+        "form": row.form,
+        "notes": row.notes,
+    }
+
+def select_healthdata_rows(user_id: uuid.UUID):
+    return (
+        select(
+            HealthData.id, HealthData.value, HealthData.value_systolic, HealthData.value_diastolic, HealthData.notes,
+            HealthData.date_recorded, HealthData.date_added,
+            HealthDataType.name, HealthDataType.unit, HealthDataType.normal_range, healthdata_trend().label("trend"),
+        )
+        .join(HealthDataType, HealthData.type_id == HealthDataType.id)
+        .where(HealthData.user_id == user_id)
+        .order_by(col(HealthData.date_recorded).desc())
+    )
+
+def healthdata_row(row) -> dict:
+    return {
+        "date_recorded": format_date(row.date_recorded),
+        "date_added": row.date_added,
+        "id": row.id,
+        "name": row.name,
+        "unit": row.unit,
+        "value": row.value,
+        "value_systolic": row.value_systolic,
+        "value_diastolic": row.value_diastolic,
+        "notes": row.notes,
+        "normal_range": row.normal_range,
+        "trend": row.trend,
+    }
+
+def select_medicalhistory_rows(user_id: uuid.UUID):
+    return (
+        select(
+            MedicalHistory.id, MedicalHistory.name, MedicalHistory.doctor_name, MedicalHistory.place, MedicalHistory.notes,
+            MedicalHistory.date_consultation, MedicalHistory.date_added,
+            MedicalCategory.name.label("category"), MedicalSubcategory.name.label("subcategory"), LabSubcategory.name.label("labsubcategory"),
+            medicalhistory_has_file.label("file"),
+        )
+        .join(MedicalCategory, MedicalHistory.category_id == MedicalCategory.id)
+        .outerjoin(MedicalSubcategory, MedicalHistory.subcategory_id == MedicalSubcategory.id)
+        .outerjoin(LabSubcategory, MedicalHistory.labsubcategory_id == LabSubcategory.id)
+        .where(MedicalHistory.user_id == user_id)
+        .order_by(col(MedicalHistory.date_added).desc())
+    )
+
+def medicalhistory_row(row) -> dict:
+    return {
+        "date_consultation": format_date(row.date_consultation),
+        "date_added": row.date_added,
+        "id": row.id,
+        "name": row.name,
+        "doctor_name": row.doctor_name,
+        "place": row.place,
+        "notes": row.notes,
+        "category": row.category,
+        "subcategory": row.subcategory,
+        "labsubcategory": row.labsubcategory,
+        "file": row.file,
+    }
+
+def select_labresult_rows(user_id: uuid.UUID, order_by=LabResult.date_added):
+    return (
+        select(
+            LabResult.id, LabResult.value, LabResult.is_numeric, LabResult.unit, LabResult.reference_range, LabResult.method,
+            LabResult.date_collection, LabResult.date_added, LabResult.medicalhistory_id, LabResult.test_id,
+            LabTest.name, LabTest.code, labresult_has_file.label("file"),
+        )
+        .join(LabTest, LabResult.test_id == LabTest.id)
+        .where(LabResult.user_id == user_id)
+        .order_by(col(order_by).desc())
+    )
+
+def labresult_row(row) -> dict:
+    return {
+        "date_collection": format_date(row.date_collection),
+        "date_added": row.date_added,
+        "id": row.id,
+        "value": row.value,
+        "is_numeric": row.is_numeric,
+        "unit": row.unit,
+        "reference_range": row.reference_range,
+        "method": row.method,
+        "medicalhistory": {"id": row.medicalhistory_id, "file": row.file},
+    }
+
+def labresult_dashboard_row(row) -> dict:
+    return {**labresult_row(row), "name": row.name, "code": row.code}
+
+def group_lab_tests(rows) -> list[dict]:
+    """
+    Group lab result rows under their lab test, in the shape of LabTestResponse, keeping the order of the rows.
+    """
+    lab_tests = {}
+    for row in rows:
+        lab_test = lab_tests.get(row.test_id)
+        if lab_test is None:
+            lab_test = {"id": row.test_id, "name": row.name, "code": row.code, "results": []}
+            lab_tests[row.test_id] = lab_test
+        lab_test["results"].append(labresult_row(row))
+
+    return list(lab_tests.values())
+
+# Response fields built from several columns of the query rows, the other fields come from the column of the same name
+FIELD_COLUMNS = {"medicalhistory": ("medicalhistory_id", "file")}
+
+class PartialRow:
+    """
+    Row of a query narrowed to some of its columns, the columns that were not selected read as None.
+    """
+    __slots__ = ("_mapping",)
+
+    def __init__(self, row):
+        self._mapping = row._mapping
+
+    def __getattr__(self, name):
+        return self._mapping.get(name)
+
+def select_fields(query, fields: set[str]):
+    """
+    Narrow a select_*_rows query to the columns of the given response fields and the ID.
+
+    The joins, filters and ordering of the query are kept, and the expensive columns like the
+    trend or the file flags are only computed by the database when their field is requested.
+    """
+    columns = {"id"}
+    for field in fields:
+        columns.update(FIELD_COLUMNS.get(field, (field,)))
+
+    return query.with_only_columns(*[column for column in query.selected_columns if column.key in columns])
+
+def serialize_rows(query, row_serializer, session: Session, fields: set[str] | None = None, limit: int | None = None) -> list[dict]:
+    """
+    Run a query and serialize its rows with a row serializer, e.g. select_vaccine_rows and vaccine_row.
+
+    Args:
+        query: Select statement of the columns needed by the row serializer
+        row_serializer: Function building the response dictionary of a row
+        session: Database session for the query
+        fields: Only select and return these fields of each row, along with the ID. Defaults to all of them.
+        limit: Maximum number of rows to return, applied by the database
+
+    Returns:
+        list[dict]: The serialized rows, ready to be encoded with dumps
+    """
+    if limit is not None:
+        query = query.limit(limit)
+
+    if fields is None:
+        return [row_serializer(row) for row in session.exec(query)]
+
+    keys = fields | {"id"}
+    return [
+        {key: value for key, value in row_serializer(PartialRow(row)).items() if key in keys}
+        for row in session.exec(select_fields(query, fields))
+    ]
@@ -1,78 +1,187 @@
-from sqlmodel import Session, select
-from ..models import LabTest, LabTestResponse, LabResultResponse, MedicalHistoryResponseLab
-import datetime
+from sqlmodel import Session, select, col
+import json
+import uuid
+import zlib
 
-def get_item_data(grouped_items: dict, session: Session):
+from ..models import LabTest, LabTestResponse, LabResultResponse, LabResultResponseDashboard, ShareCategories, ShareToken
+
+# Version of the JSON snapshot stored in ShareToken.shared_items by older share links
+SHARE_SNAPSHOT_VERSION = 1
+
+# Format byte of the binary snapshot stored in ShareToken.snapshot, zlib compressed JSON
+SNAPSHOT_FORMAT_ZLIB_JSON = 1
+SNAPSHOT_COMPRESSION_LEVEL = 6
+
+# Maximum size of the binary snapshot of a share link
+SHARE_SNAPSHOT_MAX_BYTES = 256 * 1024
+
+def resolve_share_items(grouped_items: dict, session: Session) -> ShareCategories:
     """
-    Process shared items for a share link to conform to the ShareCategories model.
-    
+    Process shared items for a share link into the ShareCategories model.
+
     This function takes the JSON of shared items from a dashboard API response and
-    processes them appropriately based on their category. Most items are processed
-    as-is, but lab results require special handling - they are sent as individual
-    lab results from the dashboard, but need to be reorganized as lab tests with
-    their respective results as children.
-    
+    validates them against their response models. Most items are validated as-is, but
+    lab results are sent as individual lab results from the dashboard and need to be
+    reorganized as lab tests with their respective results as children. The lab results are
+    validated as dashboard items first, so a result without a test name is rejected, then all
+    the lab tests are found with a single IN query and the results are grouped with a dictionary.
+
     Args:
         grouped_items: Dictionary of items grouped by their category type
         session: Database session for querying lab test information
-        
+
     Returns:
-        dict: Processed data structure with items organized by category,
-              with lab results properly nested under their respective lab tests
+        ShareCategories: The validated items organized by category, with lab results
+                         nested under their respective lab tests
+
+    Raises:
+        ValidationError: If an item does not match the response model of its category
     """
-    items_data = {}
-    
-    for type_name, items in grouped_items.items():
-        if type_name != "labresults":
-            items_data[type_name] = items
-            continue
-        
-        items_data['labtests'] = []
-        
-        for result in items:
-            lab_test = session.exec(select(LabTest).where(LabTest.name == result['name'])).first()
-            
+    items_data = {type_name: items for type_name, items in grouped_items.items() if type_name != "labresults"}
+
+    labresults = [LabResultResponseDashboard.model_validate(result) for result in grouped_items.get("labresults", [])]
+    if labresults:
+        names = list({result.name for result in labresults})
+        lab_tests = {lab_test.name: lab_test for lab_test in session.exec(select(LabTest).where(col(LabTest.name).in_(names))).all()}
+
+        # Group the results by lab test, keeping the order in which the tests first appear
+        # Results for tests that don't exist anymore are skipped
+        grouped_results = {}
+        for result in labresults:
+            lab_test = lab_tests.get(result.name)
             if lab_test:
-                found = False
-                for test_response in items_data['labtests']:
-                    if test_response.id == lab_test.id:
-                        test_response.results.append(LabResultResponse(
-                            id=result['id'],
-                            value=result['value'],
-                            is_numeric=result['is_numeric'],
-                            unit=result['unit'],
-                            reference_range=result['reference_range'],
-                            method=result['method'],
-                            date_collection=datetime.datetime.strptime(result['original_date_collection'], "%d-%m-%Y").date(),
-                            medicalhistory=MedicalHistoryResponseLab(
-                                id=result['medicalhistory']['id'],
-                                file=result['medicalhistory']['file']
-                            )
-                        ))
-                        found = True
-                        break
-                if not found:
-                    print("\n" + "-" * 20, result)
-                    items_data['labtests'].append(LabTestResponse(
-                        id=lab_test.id,
-                        name=lab_test.name,
-                        code=lab_test.code,
-                        results=[LabResultResponse(
-                            id=result['id'],
-                            value=result['value'],
-                            is_numeric=result['is_numeric'],
-                            unit=result['unit'],
-                            reference_range=result['reference_range'],
-                            method=result['method'],
-                            date_collection=datetime.datetime.strptime(result['original_date_collection'], "%d-%m-%Y").date(),
-                            medicalhistory=MedicalHistoryResponseLab(
-                                id=result['medicalhistory']['id'],
-                                file=result['medicalhistory']['file']
-                            )
-                        )]
-                    ))
-            else:
-                # Do something if lab_test is not found
-                pass
-                
-    return items_data
+                grouped_results.setdefault(lab_test.id, (lab_test, []))[1].append(LabResultResponse.model_validate(result, from_attributes=True))
+
+        items_data["labtests"] = [
+            LabTestResponse(id=lab_test.id, name=lab_test.name, code=lab_test.code, results=results)
+            for lab_test, results in grouped_results.values()
+        ]
+
+    return ShareCategories.model_validate(items_data)
+
+def encode_share_snapshot(items: dict) -> bytes:
+    """
+    Serialize the shared items into the compact binary snapshot stored in ShareToken.snapshot.
+
+    The snapshot is a format byte followed by the zlib compressed JSON of the items, so the
+    format can change later without breaking the share links that already exist.
+
+    Args:
+        items: The serialized ShareCategories items
+
+    Returns:
+        bytes: The snapshot
+
+    Raises:
+        ValueError: If the snapshot is bigger than SHARE_SNAPSHOT_MAX_BYTES
+    """
+    payload = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    snapshot = bytes([SNAPSHOT_FORMAT_ZLIB_JSON]) + zlib.compress(payload, SNAPSHOT_COMPRESSION_LEVEL)
+
+    if len(snapshot) > SHARE_SNAPSHOT_MAX_BYTES:
+        raise ValueError(f"Shared items snapshot is bigger than {SHARE_SNAPSHOT_MAX_BYTES} bytes")
+
+    return snapshot
+
+def decode_share_snapshot(snapshot: bytes) -> bytes:
+    """
+    Get the JSON of the shared items from a binary snapshot, without parsing it.
+
+    Args:
+        snapshot: The snapshot from ShareToken.snapshot
+
+    Returns:
+        bytes: The JSON of the serialized ShareCategories items
+
+    Raises:
+        ValueError: If the snapshot format is not supported
+    """
+    if snapshot[0] == SNAPSHOT_FORMAT_ZLIB_JSON:
+        return zlib.decompress(snapshot[1:])
+
+    raise ValueError(f"Unsupported shared items snapshot format {snapshot[0]}")
+
+def create_share_snapshot(grouped_items: dict, session: Session) -> tuple[dict, bytes]:
+    """
+    Resolve the shared items once, when the share link is created, into references and a binary snapshot.
+
+    The references are the IDs of the shared records by category, which are small and used to
+    check which records a share link gives access to. The snapshot holds the items already serialized
+    as they are returned to the frontend, so verifying the share link only needs to decompress it.
+
+    Args:
+        grouped_items: Dictionary of items grouped by their category type, from the dashboard
+        session: Database session for querying lab test information
+
+    Returns:
+        tuple: The references to store in ShareToken.shared_items and the snapshot to store in ShareToken.snapshot
+
+    Raises:
+        ValidationError: If an item does not match the response model of its category
+        ValueError: If the snapshot is bigger than SHARE_SNAPSHOT_MAX_BYTES
+    """
+    items = resolve_share_items(grouped_items, session)
+
+    refs = {
+        category: [str(item.id) for item in getattr(items, category)]
+        for category in ShareCategories.model_fields
+        if category != "labtests" and getattr(items, category)
+    }
+    labresults = [str(result.id) for test in items.labtests for result in test.results]
+    if labresults:
+        refs["labresults"] = labresults
+
+    return refs, encode_share_snapshot(items.model_dump(mode="json"))
+
+def read_share_items(share_token: ShareToken, session: Session) -> bytes:
+    """
+    Get the JSON of the serialized items of a share link.
+
+    Share links created before the binary snapshot have their items stored in shared_items,
+    either as a JSON snapshot or, for the oldest ones, as the raw dashboard items which are resolved here.
+
+    Args:
+        share_token: The share token to read the items of
+        session: Database session, only used for the oldest share links
+
+    Returns:
+        bytes: The JSON of the serialized ShareCategories items
+    """
+    if share_token.snapshot is not None:
+        return decode_share_snapshot(share_token.snapshot)
+
+    shared_items = share_token.shared_items
+    if shared_items.get("version") == SHARE_SNAPSHOT_VERSION:
+        items = shared_items["items"]
+    else:
+        items = resolve_share_items(shared_items, session).model_dump(mode="json")
+
+    return json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def get_shared_ids(share_token: ShareToken) -> dict:
+    """
+    Get the IDs of the shared lab results and vitals of a share link.
+
+    Args:
+        share_token: The share token, with its items stored as references or in one of the older formats
+
+    Returns:
+        dict: The lab result IDs under 'labresults' and the health data IDs under 'vitals'
+    """
+    shared_items = share_token.shared_items
+
+    if share_token.snapshot is not None:
+        labresults = shared_items.get("labresults", [])
+        vitals = shared_items.get("vitals", [])
+    elif shared_items.get("version") == SHARE_SNAPSHOT_VERSION:
+        items = shared_items["items"]
+        labresults = [result["id"] for test in items.get("labtests", []) for result in test["results"]]
+        vitals = [item["id"] for item in items.get("vitals", [])]
+    else:
+        labresults = [result["id"] for result in shared_items.get("labresults", [])]
+        vitals = [item["id"] for item in shared_items.get("vitals", [])]
+
+    return {
+        "labresults": [uuid.UUID(str(item_id)) for item_id in labresults],
+        "vitals": [uuid.UUID(str(item_id)) for item_id in vitals],
+    }
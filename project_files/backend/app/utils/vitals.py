@@ -1,71 +1,193 @@
-from ..models import HealthData
+from sqlmodel import Session, select, col, func, case
+from sqlalchemy import Date, cast, literal_column
+from datetime import date
+import uuid
 
-def group_compare_healthdata(healthdata: list[HealthData]):
+from ..models import HealthData, HealthDataType, HealthDataResponse, HealthDataSummaryResponse, HealthDataBucket
+
+# Health data types which are always shown as stable, as they have no meaningful normal range
+NO_TREND_TYPES = ["Înălțime", "Greutate"]
+
+# Number of most recent readings used for the rolling averages
+ROLLING_WINDOW = 7
+
+# Time buckets supported by the health data aggregation, as date_trunc fields
+AGGREGATE_BUCKETS = ["day", "week", "month"]
+
+def healthdata_trend(value=HealthData.value, value_systolic=HealthData.value_systolic, value_diastolic=HealthData.value_diastolic):
     """
-    Process health data records and determine trends based on normal ranges.
+    SQL expression comparing a health data measurement against the normal range of its type.
     
-    This function groups health data by type, analyzes the most recent value 
-    for each type, and determines whether it falls within the normal range.
-    It then assigns a trend indicator ('up', 'down', or 'stable') based on 
-    the comparison with normal ranges.
-    
-    The function handles both simple health data types (like height, weight)
-    and complex ones (like blood pressure) which require special processing.
+    Compound types (blood pressure) are compared on the systolic value first and then on the
+    diastolic value. The query needs to be joined with HealthDataType. The value columns can be
+    swapped for the columns of a subquery selecting from HealthData.
     
     Args:
-        healthdata: List of HealthData objects to process
+        value: Column with the value of simple health data types
+        value_systolic: Column with the systolic value of compound health data types
+        value_diastolic: Column with the diastolic value of compound health data types
         
     Returns:
-        list: A list of dictionaries containing the latest health data item
-              for each type and its associated trend indicator
+        The SQL expression, evaluating to 'up' if the value is above the range, 'down' if it is below the range and 'stable' otherwise
     """
-    grouped_data = {}
+    measured = func.coalesce(value, value_systolic)
     
-    for data in healthdata:
-        if data.type.name not in grouped_data:
-            grouped_data[data.type.name] = []
-        grouped_data[data.type.name].append(data)
+    return case(
+        (col(HealthDataType.name).in_(NO_TREND_TYPES), "stable"),
+        (measured > HealthDataType.normal_high, "up"),
+        (measured < HealthDataType.normal_low, "down"),
+        (value_diastolic > HealthDataType.normal_high_diastolic, "up"),
+        (value_diastolic < HealthDataType.normal_low_diastolic, "down"),
+        else_="stable",
+    )
+
+def get_vitals_summary(user_id: uuid.UUID, session: Session) -> list[HealthDataSummaryResponse]:
+    """
+    Compute the statistics of each health data type recorded by a user.
+    
+    All the statistics are computed by the database in a single query using window functions
+    partitioned by health data type: the latest reading and its trend, the number of readings,
+    the min, max and mean of all readings, and the mean of the most recent readings. For compound
+    types (blood pressure) the main statistics are for the systolic value and the diastolic value
+    has its own statistics.
+    
+    Args:
+        user_id: ID of the user to compute the statistics for
+        session: Database session for the query
         
-    data_trends = []        
-    for key, values in grouped_data.items():
-        if not values:
-            continue
+    Returns:
+        list[HealthDataSummaryResponse]: One summary for each health data type the user has recorded
+    """
+    measured = func.coalesce(HealthData.value, HealthData.value_systolic)
+    by_type = {"partition_by": HealthData.type_id}
+    newest_first = {
+        "partition_by": HealthData.type_id,
+        "order_by": (col(HealthData.date_recorded).desc(), col(HealthData.date_added).desc()),
+    }
+    # The current row and the ones after it, which are the older readings as the window is sorted newest first
+    rolling = {**newest_first, "rows": (0, ROLLING_WINDOW - 1)}
+    
+    readings = (
+        select(
+            HealthData.id,
+            HealthData.type_id,
+            HealthData.value,
+            HealthData.value_systolic,
+            HealthData.value_diastolic,
+            HealthData.date_recorded,
+            HealthData.date_added,
+            HealthData.notes,
+            func.row_number().over(**newest_first).label("position"),
+            func.count().over(**by_type).label("count"),
+            func.min(measured).over(**by_type).label("value_min"),
+            func.max(measured).over(**by_type).label("value_max"),
+            func.avg(measured).over(**by_type).label("value_mean"),
+            func.avg(measured).over(**rolling).label("value_rolling_mean"),
+            func.min(HealthData.value_diastolic).over(**by_type).label("diastolic_min"),
+            func.max(HealthData.value_diastolic).over(**by_type).label("diastolic_max"),
+            func.avg(HealthData.value_diastolic).over(**by_type).label("diastolic_mean"),
+            func.avg(HealthData.value_diastolic).over(**rolling).label("diastolic_rolling_mean"),
+        )
+        .where(HealthData.user_id == user_id)
+        .subquery()
+    )
+    
+    # Only keep the latest reading of each type, which carries the statistics of the whole type
+    rows = session.exec(
+        select(
+            readings,
+            HealthDataType.name,
+            HealthDataType.unit,
+            HealthDataType.normal_range,
+            healthdata_trend(readings.c.value, readings.c.value_systolic, readings.c.value_diastolic).label("trend"),
+        )
+        .join(HealthDataType, HealthDataType.id == readings.c.type_id)
+        .where(readings.c.position == 1)
+        .order_by(HealthDataType.name)
+    ).all()
+    
+    return [
+        HealthDataSummaryResponse(
+            name = row.name,
+            unit = row.unit,
+            normal_range = row.normal_range,
+            count = row.count,
+            trend = row.trend,
+            latest = HealthDataResponse(
+                id = row.id,
+                name = row.name,
+                unit = row.unit,
+                value = row.value,
+                value_systolic = row.value_systolic,
+                value_diastolic = row.value_diastolic,
+                date_recorded = row.date_recorded,
+                notes = row.notes,
+                date_added = row.date_added,
+                normal_range = row.normal_range,
+                trend = row.trend
+            ),
+            value_min = row.value_min,
+            value_max = row.value_max,
+            value_mean = row.value_mean,
+            value_rolling_mean = row.value_rolling_mean,
+            diastolic_min = row.diastolic_min,
+            diastolic_max = row.diastolic_max,
+            diastolic_mean = row.diastolic_mean,
+            diastolic_rolling_mean = row.diastolic_rolling_mean
+        )
+        for row in rows
+    ]
+
+def get_vitals_aggregate(user_id: uuid.UUID, type_id: uuid.UUID, bucket: str, session: Session, start: date | None = None, end: date | None = None) -> list[HealthDataBucket]:
+    """
+    Compute the statistics of a health data type of a user over time buckets.
+    
+    The readings are grouped with date_trunc in the database, which can use the
+    (user_id, type_id, date_recorded) index, so only one row per bucket is loaded.
+    For compound types (blood pressure) the value statistics are for the systolic value
+    and the diastolic value has its own statistics.
+    
+    Args:
+        user_id: ID of the user owning the health data
+        type_id: ID of the health data type to aggregate
+        bucket: Size of the buckets, one of AGGREGATE_BUCKETS
+        session: Database session for the query
+        start: If given, only include readings on or after this date
+        end: If given, only include readings on or before this date
         
-        latest = values[0]
-        trend = "stable"
+    Returns:
+        list[HealthDataBucket]: The statistics of each bucket with readings, oldest first
         
-        if latest.type.name in ["Înălțime", "Greutate"]:
-            trend = "stable"
-
-        elif latest.type.name == "Tensiune arterială":
-            range_str = latest.type.normal_range
-            if range_str:
-                low, high = range_str.split(" - ")
-                low_sys = float(low.split("/")[0].strip())
-                high_sys = float(high.split(' ')[0].split("/")[0].strip())
-                
-                if latest.value_systolic > high_sys:
-                    trend = "up"
-                elif latest.value_systolic < low_sys:
-                    trend = "down"
+    Raises:
+        ValueError: If the bucket is not supported
+    """
+    if bucket not in AGGREGATE_BUCKETS:
+        raise ValueError(f"Unsupported bucket '{bucket}'")
+    
+    # The bucket is inlined rather than bound, so the grouped and selected expressions are identical
+    bucket_start = cast(func.date_trunc(literal_column(f"'{bucket}'"), HealthData.date_recorded), Date)
+    measured = func.coalesce(HealthData.value, HealthData.value_systolic)
+    
+    query = (
+        select(
+            bucket_start.label("bucket_start"),
+            func.count().label("count"),
+            func.min(measured).label("value_min"),
+            func.max(measured).label("value_max"),
+            func.avg(measured).label("value_mean"),
+            func.min(HealthData.value_diastolic).label("diastolic_min"),
+            func.max(HealthData.value_diastolic).label("diastolic_max"),
+            func.avg(HealthData.value_diastolic).label("diastolic_mean"),
+        )
+        .where(HealthData.user_id == user_id)
+        .where(HealthData.type_id == type_id)
+        .group_by(bucket_start)
+        .order_by(bucket_start)
+    )
+    
+    if start:
+        query = query.where(HealthData.date_recorded >= start)
+    if end:
+        query = query.where(HealthData.date_recorded <= end)
         
-        elif latest.type.normal_range:
-            range_str = latest.type.normal_range
-            try:
-                low, high = range_str.split(" - ")
-                range_min = float(low.strip())
-                range_max = float(high.split(" ")[0].strip())                
-                
-                if latest.value > range_max:
-                    trend = "up"
-                elif latest.value < range_min:
-                    trend = "down"
-            except (ValueError, AttributeError):
-                trend = "stable"
-            
-        data_trends.append({
-            "healthdata": latest,
-            "trend": trend,
-        })
-          
-    return data_trends
\ No newline at end of file
+    return [HealthDataBucket.model_validate(row._mapping) for row in session.exec(query).all()]
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Benchmark of the dashboard serialization, comparing the response model path with the serialize.py fast path.
+
+The response model path builds a response object per row, which FastAPI validates again against the response
+model before encoding it with the json module. The fast path builds dictionaries straight from the query rows
+and encodes them with orjson. Both are fed the same synthetic rows, so the database is not part of the timings.
+
+Run from the backend folder with: python -m benchmarks.bench_serialization [--rows 10000] [--repeat 5]
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+import argparse
+import json
+import os
+import random
+import timeit
+import uuid
+
+# The app reads the database URL when it is imported, no connection is made by the benchmark
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/benchmark")
+
+from pydantic import TypeAdapter
+
+from app.models import UserDashboard, VaccineResponse, AllergyResponse, MedicationResponse, HealthDataResponse, MedicalHistoryResponse, LabResultResponseDashboard, MedicalHistoryResponseLab
+from app.utils import dumps, vaccine_row, allergy_row, medication_row, healthdata_row, medicalhistory_row, labresult_dashboard_row
+
+# Rows with the columns selected by the select_*_rows queries of serialize.py
+VaccineRow = namedtuple("VaccineRow", "id name provider date_received date_added certificate")
+AllergyRow = namedtuple("AllergyRow", "id date_diagnosed date_added notes severity allergens reactions")
+MedicationRow = namedtuple("MedicationRow", "id name dosage frequency time_of_day duration_days date_prescribed date_added notes route form")
+HealthDataRow = namedtuple("HealthDataRow", "id value value_systolic value_diastolic notes date_recorded date_added name unit normal_range trend")
+MedicalHistoryRow = namedtuple("MedicalHistoryRow", "id name doctor_name place notes date_consultation date_added category subcategory labsubcategory file")
+LabResultRow = namedtuple("LabResultRow", "id value is_numeric unit reference_range method date_collection date_added medicalhistory_id test_id name code file")
+
+# Share of the rows of each category in the synthetic dashboard
+ROW_SHARES = {"vitals": 0.4, "labresults": 0.4, "medications": 0.08, "medicalhistory": 0.06, "vaccines": 0.04, "allergies": 0.02}
+
+def random_date(rng: random.Random) -> date:
+    return date(2015, 1, 1) + timedelta(days=rng.randrange(3650))
+
+def random_datetime(rng: random.Random) -> datetime:
+    return datetime(2020, 1, 1) + timedelta(seconds=rng.randrange(5 * 365 * 24 * 3600), microseconds=rng.randrange(1000000))
+
+def make_rows(total: int, seed: int = 42) -> dict:
+    """
+    Build the synthetic query rows of a dashboard with about total rows.
+    """
+    rng = random.Random(seed)
+    counts = {category: max(1, int(total * share)) for category, share in ROW_SHARES.items()}
+
+    return {
+        "vaccines": [
+            VaccineRow(uuid.uuid4(), f"Vaccin {i}", "Spitalul Județean", random_date(rng), random_datetime(rng), rng.random() < 0.5)
+            for i in range(counts["vaccines"])
+        ],
+        "allergies": [
+            AllergyRow(uuid.uuid4(), random_date(rng), random_datetime(rng), None, "Severă", ["Polen", "Praf"], ["Urticarie"])
+            for _ in range(counts["allergies"])
+        ],
+        "medications": [
+            MedicationRow(uuid.uuid4(), f"Medicament {i}", "500 mg", "De 2 ori pe zi", "Dimineața", rng.randrange(1, 30), random_date(rng), random_datetime(rng), None, "Oral", "Tabletă")
+            for i in range(counts["medications"])
+        ],
+        "vitals": [
+            HealthDataRow(uuid.uuid4(), round(rng.uniform(50, 120), 1), None, None, None, random_date(rng), random_datetime(rng), "Puls", "bpm", "60-100", rng.choice(["up", "down", "stable"]))
+            for _ in range(counts["vitals"])
+        ],
+        "medicalhistory": [
+            MedicalHistoryRow(uuid.uuid4(), f"Consultație {i}", "Dr. Popescu", "Clinica", "Control anual", random_date(rng), random_datetime(rng), "Consultație", "Cardiologie", None, rng.random() < 0.5)
+            for i in range(counts["medicalhistory"])
+        ],
+        "labresults": [
+            LabResultRow(uuid.uuid4(), f"{rng.uniform(1, 200):.1f}", True, "mg/dL", "70-110", None, random_date(rng), random_datetime(rng), uuid.uuid4(), uuid.uuid4(), "Glucoză", "GLU", rng.random() < 0.5)
+            for _ in range(counts["labresults"])
+        ],
+    }
+
+def response_model_path(user_id: uuid.UUID, rows: dict, adapter: TypeAdapter) -> bytes:
+    """
+    Serialize the dashboard like before the fast path: response objects per row, validated again and encoded with json.
+    """
+    dashboard = UserDashboard(
+        id=user_id,
+        name="Pacient",
+        vaccines=[VaccineResponse(id=row.id, name=row.name, provider=row.provider, date_received=row.date_received, certificate=row.certificate, date_added=row.date_added) for row in rows["vaccines"]],
+        allergies=[AllergyResponse(id=row.id, date_diagnosed=row.date_diagnosed, allergens=row.allergens, reactions=row.reactions, severity=row.severity, notes=row.notes, date_added=row.date_added) for row in rows["allergies"]],
+        medications=[MedicationResponse(id=row.id, name=row.name, dosage=row.dosage, frequency=row.frequency, time_of_day=row.time_of_day, date_prescribed=row.date_prescribed, duration_days=row.duration_days, route=row.route, form=row.form, notes=row.notes, date_added=row.date_added) for row in rows["medications"]],
+        vitals=[HealthDataResponse(id=row.id, name=row.name, unit=row.unit, value=row.value, value_systolic=row.value_systolic, value_diastolic=row.value_diastolic, date_recorded=row.date_recorded, notes=row.notes, date_added=row.date_added, normal_range=row.normal_range, trend=row.trend) for row in rows["vitals"]],
+        medicalhistory=[MedicalHistoryResponse(id=row.id, name=row.name, doctor_name=row.doctor_name, place=row.place, notes=row.notes, category=row.category, subcategory=row.subcategory, labsubcategory=row.labsubcategory, file=row.file, date_consultation=row.date_consultation, date_added=row.date_added) for row in rows["medicalhistory"]],
+        labresults=[LabResultResponseDashboard(id=row.id, value=row.value, is_numeric=row.is_numeric, unit=row.unit, reference_range=row.reference_range, date_collection=row.date_collection, method=row.method, name=row.name, code=row.code, date_added=row.date_added, medicalhistory=MedicalHistoryResponseLab(id=row.medicalhistory_id, file=row.file)) for row in rows["labresults"]],
+    )
+
+    # What FastAPI does with the returned object: validate it against the response model, dump it and encode it
+    content = adapter.dump_python(adapter.validate_python(dashboard), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(user_id: uuid.UUID, rows: dict) -> bytes:
+    """
+    Serialize the dashboard like get_dashboard does now: dictionaries built from the rows and encoded with orjson.
+    """
+    return dumps({
+        "id": user_id,
+        "name": "Pacient",
+        "vaccines": [vaccine_row(row) for row in rows["vaccines"]],
+        "allergies": [allergy_row(row) for row in rows["allergies"]],
+        "medications": [medication_row(row) for row in rows["medications"]],
+        "vitals": [healthdata_row(row) for row in rows["vitals"]],
+        "medicalhistory": [medicalhistory_row(row) for row in rows["medicalhistory"]],
+        "labresults": [labresult_dashboard_row(row) for row in rows["labresults"]],
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard serialization")
+    parser.add_argument("--rows", type=int, default=10000, help="number of rows in the synthetic dashboard")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs of each path, the best one is reported")
+    args = parser.parse_args()
+
+    user_id = uuid.uuid4()
+    rows = make_rows(args.rows)
+    adapter = TypeAdapter(UserDashboard)
+
+    # Both paths must produce the same JSON, apart from the formatting of the encoders
+    baseline = response_model_path(user_id, rows, adapter)
+    fast = fast_path(user_id, rows)
+    assert json.loads(baseline) == json.loads(fast), "The fast path output differs from the response model output"
+
+    total = sum(len(category_rows) for category_rows in rows.values())
+    baseline_time = min(timeit.repeat(lambda: response_model_path(user_id, rows, adapter), number=1, repeat=args.repeat))
+    fast_time = min(timeit.repeat(lambda: fast_path(user_id, rows), number=1, repeat=args.repeat))
+
+    print(f"Dashboard with {total} rows, {len(fast)} bytes, best of {args.repeat} runs")
+    print(f"Response models + json: {baseline_time * 1000:8.1f} ms")
+    print(f"Row dicts + orjson:     {fast_time * 1000:8.1f} ms")
+    print(f"Speedup:                {baseline_time / fast_time:8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Synthetic patients for the API benchmarks, written straight to the database without going through the endpoints.
+
+Every patient gets a session, so the benchmarks can call the protected endpoints without logging in, and the
+number of records of each category, lab results per test and uploaded documents are configurable. The names of
+the reference rows are shared by all the runs, the patients and their records are unique to a run.
+"""
+from datetime import date, datetime, timedelta
+import random
+import uuid
+
+from sqlmodel import Session, select, col
+
+from app.models import (
+    User, AuthSession, Vaccine, Allergy, Allergens, Reactions, Severity, AllergyAllergensLink, AllergyReactionsLink,
+    Medication, MedicationRoute, MedicationForm, HealthData, HealthDataType, MedicalHistory, MedicalCategory,
+    LabTest, LabResult, FileUpload,
+)
+from app.utils import create_hash, save_file, lab_range_columns, healthdata_range_columns, numeric_value_columns, delete_account, lookup_cache, LOOKUP_MODELS
+
+# Password of the synthetic patients, who are given a session instead of logging in
+PATIENT_PASSWORD = "benchmark-password"
+
+# Reference rows used by the synthetic records, created once and reused by the next runs
+HEALTHDATA_TYPES = [("Puls", "bpm", "60-100"), ("Glicemie", "mg/dL", "70-110"), ("Greutate", "kg", None), ("Temperatură", "°C", "36.1-37.2")]
+SEVERITIES = ["Severă", "Moderată", "Ușoară"]
+ALLERGENS = ["Polen", "Praf", "Arahide", "Penicilină"]
+REACTIONS = ["Urticarie", "Strănut", "Edem"]
+ROUTES = ["Oral", "Intravenos"]
+FORMS = ["Tabletă", "Sirop"]
+CATEGORIES = ["Consultație", "Analize"]
+
+def get_or_create(session: Session, model, name: str, **fields):
+    """
+    Get a reference row by its name, creating it if it doesn't exist.
+
+    Creating a row of a cached reference table bumps its version, so running servers reload it.
+    """
+    row = session.exec(select(model).where(col(model.name) == name)).first()
+    if row is None:
+        row = model(name=name, **fields)
+        session.add(row)
+        session.flush()
+        if model in LOOKUP_MODELS:
+            lookup_cache.bump(model, session)
+    return row
+
+def seed_reference_rows(session: Session) -> dict:
+    """
+    Create the reference rows used by the synthetic records.
+
+    Returns:
+        dict: The IDs of the reference rows by table
+    """
+    reference = {
+        "healthdata_types": [get_or_create(session, HealthDataType, name, unit=unit, normal_range=normal_range, **healthdata_range_columns(normal_range)).id for name, unit, normal_range in HEALTHDATA_TYPES],
+        "severities": [get_or_create(session, Severity, name).id for name in SEVERITIES],
+        "allergens": [get_or_create(session, Allergens, name).id for name in ALLERGENS],
+        "reactions": [get_or_create(session, Reactions, name).id for name in REACTIONS],
+        "routes": [get_or_create(session, MedicationRoute, name).id for name in ROUTES],
+        "forms": [get_or_create(session, MedicationForm, name).id for name in FORMS],
+        "categories": [get_or_create(session, MedicalCategory, name).id for name in CATEGORIES],
+    }
+    session.commit()
+    return reference
+
+def seed_lab_tests(session: Session, count: int) -> list[uuid.UUID]:
+    """
+    Create the lab tests shared by the synthetic patients.
+    """
+    ids = [get_or_create(session, LabTest, f"Benchmark test {index}", code=f"BT{index}").id for index in range(count)]
+    session.commit()
+    return ids
+
+def random_day(rng: random.Random, years: int = 5) -> date:
+    return date.today() - timedelta(days=rng.randrange(years * 365))
+
+def seed_patient(session: Session, run_id: str, index: int, sizes: dict, reference: dict, lab_tests: list[uuid.UUID], hashed_password: str, rng: random.Random) -> dict:
+    """
+    Create a synthetic patient with a valid session and all their records.
+
+    Args:
+        session: Database session, committed once the patient is created
+        run_id: ID of the benchmark run, used to make the emails and unique names of the run
+        index: Number of the patient in the run
+        sizes: Number of records of each category, see DEFAULT_SIZES in bench_api
+        reference: IDs of the reference rows, from seed_reference_rows
+        lab_tests: IDs of the lab tests, from seed_lab_tests
+        hashed_password: Password hash shared by the patients, so bcrypt runs once per run
+        rng: Random generator of the run, seeded so the data is the same between runs
+
+    Returns:
+        dict: The patient's user ID, session ID, the records used by the scenarios and the vaccines left without a document for the uploads
+    """
+    user = User(name=f"Pacient {index}", email=f"bench-{run_id}-{index}@example.com", hashed_password=hashed_password)
+    auth_session = AuthSession(user_id=user.id, expires_at=datetime.now() + timedelta(days=1))
+    session.add_all([user, auth_session])
+    session.flush()
+
+    vaccines = [
+        Vaccine(name=f"Vaccin {number}", provider="Spitalul Județean", date_received=random_day(rng), user_id=user.id)
+        for number in range(sizes["vaccines"] + sizes["upload_targets"])
+    ]
+    medicalhistory = [
+        MedicalHistory(name=f"Consultație {run_id}-{index}-{number}", doctor_name="Dr. Popescu", place="Clinica", date_consultation=random_day(rng), category_id=rng.choice(reference["categories"]), user_id=user.id)
+        for number in range(max(sizes["medicalhistory"], 1))
+    ]
+    allergies = [
+        Allergy(date_diagnosed=random_day(rng, 20), severity_id=rng.choice(reference["severities"]), user_id=user.id)
+        for _ in range(sizes["allergies"])
+    ]
+    session.add_all(vaccines + medicalhistory + allergies)
+    session.flush()
+
+    links = []
+    for allergy in allergies:
+        links.extend(AllergyAllergensLink(allergy_id=allergy.id, allergen_id=allergen_id) for allergen_id in rng.sample(reference["allergens"], 2))
+        links.append(AllergyReactionsLink(allergy_id=allergy.id, reaction_id=rng.choice(reference["reactions"])))
+
+    medications = [
+        Medication(name=f"Medicament {number}", dosage="500 mg", frequency="De 2 ori pe zi", duration_days=rng.randrange(1, 30), date_prescribed=random_day(rng), route_id=rng.choice(reference["routes"]), form_id=rng.choice(reference["forms"]), user_id=user.id)
+        for number in range(sizes["medications"])
+    ]
+    vitals = [
+        HealthData(value=round(rng.uniform(50, 130), 1), date_recorded=random_day(rng, 2), type_id=rng.choice(reference["healthdata_types"]), user_id=user.id)
+        for _ in range(sizes["vitals"])
+    ]
+
+    labresults = []
+    for test_id in lab_tests:
+        for _ in range(sizes["results_per_test"]):
+            value = f"{rng.uniform(40, 160):.1f}"
+            labresults.append(LabResult(
+                value=value, is_numeric=True, **numeric_value_columns(value), unit="mg/dL", reference_range="70-110", **lab_range_columns("70-110"),
+                date_collection=random_day(rng), test_id=test_id, medicalhistory_id=rng.choice(medicalhistory).id, user_id=user.id,
+            ))
+    session.add_all(links + medications + vitals + labresults)
+
+    # Encrypted documents of random bytes, which don't compress, attached to the first vaccines
+    file_vaccines = [vaccine.id for vaccine in vaccines[:min(sizes["files"], sizes["vaccines"])]]
+    for vaccine_id in file_vaccines:
+        content = rng.randbytes(sizes["file_kb"] * 1024)
+        file_id = uuid.uuid4()
+        secure_name, file_path = save_file(content, vaccine_id, user.id, file_id, "certificat.pdf")
+        session.add(FileUpload(id=file_id, name=secure_name, file_path=str(file_path), file_type="application/pdf", file_size=len(content), vaccine_id=vaccine_id))
+
+    # The IDs are read before the commit, which expires the objects and would reload each of them
+    patient = {
+        "user_id": user.id,
+        "session_id": auth_session.id,
+        "file_vaccines": file_vaccines,
+        "upload_targets": [vaccine.id for vaccine in vaccines[sizes["vaccines"]:]],
+        "lab_tests": lab_tests,
+    }
+    session.commit()
+
+    return patient
+
+def seed_patients(session: Session, run_id: str, count: int, sizes: dict, seed: int = 42) -> list[dict]:
+    """
+    Create the synthetic patients of a benchmark run.
+
+    Args:
+        session: Database session for the inserts
+        run_id: ID of the benchmark run
+        count: Number of patients
+        sizes: Number of records of each category, see DEFAULT_SIZES in bench_api
+        seed: Seed of the random data
+
+    Returns:
+        list[dict]: The patients, see seed_patient
+    """
+    rng = random.Random(seed)
+    reference = seed_reference_rows(session)
+    lab_tests = seed_lab_tests(session, sizes["lab_tests"])
+    hashed_password = create_hash(PATIENT_PASSWORD)
+
+    return [seed_patient(session, run_id, index, sizes, reference, lab_tests, hashed_password, rng) for index in range(count)]
+
+def delete_patients(session: Session, patients: list[dict]):
+    """
+    Delete the synthetic patients and everything they own, their documents are removed by the file deletion sweep.
+    """
+    for patient in patients:
+        delete_account(patient["user_id"], session)
+    session.commit()